@@ -1,24 +1,49 @@
 import datetime
+import hashlib
+import io
 import json
 import os
 import tempfile
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, as_completed, wait
 
 import numpy as np
 
 from backend.shared import (
+    PDF_BATCH_PAGES,
+    ChunkMetadata,
     add_vectors,
-    chunk_text,
     create_index,
     create_metadata,
-    download_object,
+    delete_object,
+    deserialize_index,
     embed_texts,
-    extract_pdf,
-    extract_txt,
+    encode_vector,
+    extract_chunks,
+    extract_pdf_chunks,
+    find_duplicates,
+    get_embedding_cache,
+    get_encoder,
+    get_object_bytes,
     get_s3_client,
-    list_objects,
-    save_index,
-    save_metadata,
-    upload_file,
+    if_object,
+    index_format,
+    index_quantization,
+    keep_ids,
+    list_object_details,
+    load_signatures,
+    loads_metadata,
+    pack_lexical,
+    pack_metadata,
+    pack_signatures,
+    pdf_page_count,
+    process_pool,
+    put_bytes,
+    reconstruct_all,
+    serialize_index,
+    session_centroid,
+    thread_pool,
 )
 
 # get bucket name, namespace from env vars
@@ -26,6 +51,561 @@ BUCKET = os.environ["BUCKET"]
 NAMESPACE = os.environ.get("NAMESPACE", "default") # default to "default"
 # session prefix path
 SESSION_PREFIX = f"{NAMESPACE}/sessions"
+# one centroid entry per session, for routing searches across sessions
+ROUTING_PREFIX = f"{NAMESPACE}/routing/centroids"
+# embedding model, vectors from different models can't share an index
+EMBED_MODEL = os.environ.get("EMBED_MODEL", "text-embedding-3-small")
+# load the tokenizer during lambda init instead of the first request
+get_encoder()
+
+# concurrent s3 downloads and parallel extract/chunk workers
+DOWNLOAD_WORKERS = int(os.environ.get("INGEST_DOWNLOAD_WORKERS", "8"))
+EXTRACT_WORKERS = int(os.environ.get("INGEST_EXTRACT_WORKERS", "0")) or os.cpu_count() or 1
+# extraction tasks queued per worker, more wait until one finishes
+EXTRACT_QUEUE = int(os.environ.get("INGEST_EXTRACT_QUEUE", "2"))
+# documents chunked and embedded between checkpoints
+WINDOW_DOCS = int(os.environ.get("INGEST_WINDOW_DOCS", "16"))
+# time kept in reserve for the final merge and upload before lambda's timeout
+RESERVE_MS = int(os.environ.get("INGEST_RESERVE_MS", "120000"))
+# keep a full precision copy of the vectors next to a quantized index for query-time rescoring
+RESCORE = os.environ.get("INDEX_RESCORE", "off").lower() in ("on", "1", "true")
+# compaction merges segments and drops tombstoned vectors once this share of
+# stored vectors is dead, or once a session has more than INDEX_MAX_SEGMENTS
+COMPACT_RATIO = float(os.environ.get("INDEX_COMPACT_RATIO", "0.25"))
+MAX_SEGMENTS = int(os.environ.get("INDEX_MAX_SEGMENTS", "8"))
+# bm25 index of each segment's chunk text, for hybrid and lexical-only queries
+LEXICAL = os.environ.get("INDEX_LEXICAL", "on").lower() in ("on", "1", "true")
+# local testing: pretend time ran out after this many documents per invocation
+SIMULATE_TIMEOUT_AFTER = int(os.environ.get("INGEST_SIMULATE_TIMEOUT_AFTER", "0"))
+
+
+# reads a json object from s3, none if it does not exist
+def _read_json(key: str):
+    return _read_json_version(key)[0]
+
+
+# reads a json object from s3 with its etag, (none, none) if it does not exist
+def _read_json_version(key: str):
+    s3 = get_s3_client()
+    try:
+        response = s3.get_object(Bucket=BUCKET, Key=key)
+    except s3.exceptions.NoSuchKey:
+        return None, None
+    return json.loads(response["Body"].read().decode("utf-8")), response.get("ETag")
+
+
+# writes a json object to s3
+# returns the etag of the written object
+def _put_json(key: str, data):
+    response = get_s3_client().put_object(
+        Bucket=BUCKET,
+        Key=key,
+        Body=json.dumps(data).encode("utf-8"),
+        ContentType="application/json",
+    )
+    return response.get("ETag")
+
+
+# writes a json object only if it still has the etag it was read with, or only if it
+# still doesn't exist when etag is none; returns the new etag, none when another
+# writer got there first
+def _put_json_if(key: str, data, etag):
+    s3 = get_s3_client()
+    try:
+        response = s3.put_object(
+            Bucket=BUCKET,
+            Key=key,
+            Body=json.dumps(data).encode("utf-8"),
+            ContentType="application/json",
+            **({"IfMatch": etag} if etag else {"IfNoneMatch": "*"}),
+        )
+    except s3.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] in ("PreconditionFailed", "ConditionalRequestConflict"):
+            return None
+        raise
+    return response.get("ETag")
+
+
+# writes a numpy array to s3 in .npy format
+def _put_array(key: str, array: np.ndarray):
+    buf = io.BytesIO()
+    np.save(buf, array)
+    put_bytes(BUCKET, key, buf.getvalue())
+
+
+# reads a .npy array from s3
+def _read_array(key: str) -> np.ndarray:
+    return np.load(io.BytesIO(get_object_bytes(BUCKET, key)))
+
+
+# segments of a session index, each an immutable faiss index + metadata over a range of ids
+# sessions indexed before segments existed have one legacy segment over faiss.index
+def _segments(manifest, index_prefix: str):
+    if "segments" in manifest:
+        return [dict(seg) for seg in manifest["segments"]]
+    end = max((s["end"] for s in manifest.get("sources", {}).values()), default=0)
+    if not end:
+        return []
+    return [{
+        "id": "legacy",
+        "start": 0,
+        "end": end,
+        "indexFile": "faiss.index",
+        "metaFile": "meta.bin" if if_object(BUCKET, f"{index_prefix}/meta.bin") else "meta.json",
+        "vectorsFile": "vectors.f32" if if_object(BUCKET, f"{index_prefix}/vectors.f32") else None,
+        "format": manifest.get("index") or {},
+    }]
+
+
+# files (relative to the index prefix) that make up a segment
+def _segment_files(seg):
+    return [seg[f] for f in ("indexFile", "metaFile", "vectorsFile", "lexicalFile", "dedupeFile") if seg.get(f)]
+
+
+# segment holding a global vector id
+def _segment_of(segments, gid: int):
+    return next(seg for seg in segments if seg["start"] <= gid < seg["end"])
+
+
+# vector id ranges a source holds: its own rows, then rows it took over from removed
+# sources that it duplicated ("adopted")
+def _ranges(src):
+    own = [[src["start"], src["end"]]] if src["end"] > src["start"] else []
+    return own + [list(r) for r in src.get("adopted", [])]
+
+
+# number of vectors a source holds
+def _count(src) -> int:
+    return sum(b - a for a, b in _ranges(src))
+
+
+# global id of a source's offset-th vector, counted across its ranges
+def _gid(src, offset: int) -> int:
+    for a, b in _ranges(src):
+        if offset < b - a:
+            return a + offset
+        offset -= b - a
+    raise IndexError(offset)
+
+
+# sets a source's ranges, the first is its own and the rest are adopted
+def _set_ranges(src, ranges, empty_at: int = 0):
+    src = {k: v for k, v in src.items() if k != "adopted"}
+    merged = []
+    for a, b in ranges:
+        if merged and merged[-1][1] == a:
+            merged[-1][1] = b
+        else:
+            merged.append([a, b])
+    src["start"], src["end"] = merged[0] if merged else (empty_at, empty_at)
+    if len(merged) > 1:
+        src["adopted"] = merged[1:]
+    return src
+
+
+# sorted ids as [start, end) runs that don't cross a segment boundary
+def _runs(ids, segments):
+    runs = []
+    for gid in sorted(ids):
+        if runs and runs[-1][1] == gid and _segment_of(segments, gid)["start"] < gid:
+            runs[-1][1] = gid + 1
+        else:
+            runs.append([gid, gid + 1])
+    return runs
+
+
+# metadata rows of a segment as {local id: row}
+def _segment_rows(index_prefix: str, seg):
+    meta = loads_metadata(get_object_bytes(BUCKET, f"{index_prefix}/{seg['metaFile']}"))
+    if isinstance(meta, ChunkMetadata):
+        return meta.to_dict()
+    return {int(i): row for i, row in meta.items()}
+
+
+# dedupe signatures of a segment as (exact keys, minhash signatures) in local id order
+# segments written before signatures were stored get them from their rows, once
+def _segment_signatures(index_prefix: str, seg):
+    if seg.get("dedupeFile"):
+        return load_signatures(get_object_bytes(BUCKET, f"{index_prefix}/{seg['dedupeFile']}"))
+    rows = _segment_rows(index_prefix, seg)
+    data = pack_signatures([(rows.get(i) or {}).get("text") or "" for i in range(seg["end"] - seg["start"])])
+    seg["dedupeFile"] = f"segments/{seg['id']}.sig"
+    put_bytes(BUCKET, f"{index_prefix}/{seg['dedupeFile']}", data)
+    return load_signatures(data)
+
+
+# vectors of a segment in id order
+# the full precision copy when one is kept, otherwise the index's own (possibly lossy) vectors
+def _segment_vectors(index_prefix: str, seg) -> np.ndarray:
+    index = deserialize_index(get_object_bytes(BUCKET, f"{index_prefix}/{seg['indexFile']}"))
+    if seg.get("vectorsFile"):
+        data = get_object_bytes(BUCKET, f"{index_prefix}/{seg['vectorsFile']}")
+        vectors = np.frombuffer(data, dtype="float32").reshape(-1, index.d)
+        if len(vectors) == index.ntotal:
+            return vectors
+    return reconstruct_all(index)
+
+
+# writes one new segment over ids [start, start + len(rows)) and returns its manifest entry
+# vectors must be normalized; the index family follows the segment size
+# an already built index can be passed instead, vectors then only give the centroid
+# (they are decoded from lossy codes, so no rescoring copy is written from them)
+def _write_segment(index_prefix: str, start: int, vectors: np.ndarray, rows, index=None):
+    seg_id = uuid.uuid4().hex[:12]
+    prebuilt = index is not None
+    if not prebuilt:
+        index = create_index(vectors.shape[1], len(vectors))
+        add_vectors(index, vectors.copy())
+    data = serialize_index(index)
+    seg = {
+        "id": seg_id,
+        "start": start,
+        "end": start + len(rows),
+        "indexFile": f"segments/{seg_id}.index",
+        "metaFile": f"segments/{seg_id}.meta.bin",
+        "vectorsFile": None,
+        "lexicalFile": f"segments/{seg_id}.bm25" if LEXICAL else None,
+        "dedupeFile": f"segments/{seg_id}.sig",
+        "format": dict(index_format(index), bytes=len(data)),
+        # mean vector, combined into the session centroid for routing
+        "centroid": encode_vector(vectors.mean(axis=0)),
+    }
+    put_bytes(BUCKET, f"{index_prefix}/{seg['indexFile']}", data)
+    put_bytes(BUCKET, f"{index_prefix}/{seg['metaFile']}", pack_metadata(dict(enumerate(rows))))
+    if seg["lexicalFile"]:
+        put_bytes(BUCKET, f"{index_prefix}/{seg['lexicalFile']}", pack_lexical([row.get("text") or "" for row in rows]))
+    put_bytes(BUCKET, f"{index_prefix}/{seg['dedupeFile']}", pack_signatures([row.get("text") or "" for row in rows]))
+    # rescoring only helps when the index stores lossy codes
+    if RESCORE and not prebuilt and index_quantization(index) != "none":
+        seg["vectorsFile"] = f"segments/{seg_id}.f32"
+        put_bytes(BUCKET, f"{index_prefix}/{seg['vectorsFile']}", np.ascontiguousarray(vectors, dtype="float32").tobytes())
+    seg["format"]["rescore"] = bool(seg["vectorsFile"])
+    return seg
+
+
+# share of stored vectors that are tombstoned
+def _fragmentation(segments, tombstones) -> float:
+    stored = sum(seg["end"] - seg["start"] for seg in segments)
+    dead = sum(end - start for start, end in tombstones)
+    return dead / stored if stored else 0.0
+
+
+# true when a segment's vectors can be read back at full precision
+# (a rescoring copy, or an index that stores float32 vectors)
+def _exact(seg) -> bool:
+    return bool(seg.get("vectorsFile")) or (seg.get("format") or {}).get("quantization", "none") == "none"
+
+
+# true when compaction can drop a segment's tombstoned vectors
+# (exact segments are merged, flat ones keep their codes)
+def _removable(seg) -> bool:
+    return _exact(seg) or (seg.get("format") or {}).get("kind", "flat") == "flat"
+
+
+# true when compacting would drop enough tombstoned vectors or merge enough segments;
+# tombstones of lossy ivf/hnsw segments and segments that can't be merged don't count,
+# compaction would keep them and be due again on every call
+def _compaction_due(segments, tombstones) -> bool:
+    removable = [
+        [a, b] for a, b in tombstones
+        if any(seg["start"] <= a < seg["end"] and _removable(seg) for seg in segments)
+    ]
+    merged = sum(_exact(seg) for seg in segments)
+    return _fragmentation(segments, removable) > COMPACT_RATIO or (merged > 1 and len(segments) > MAX_SEGMENTS)
+
+
+# merges segments, dropping tombstoned vectors and renumbering ids
+# lossy codes are never decoded and quantized again: segments that can be read back at
+# full precision merge into one new segment, flat sq/pq/fp16 segments without a full
+# precision copy drop their tombstoned codes in place, and ivf/hnsw ones without it
+# are kept as they are, renumbered, with their tombstones
+# returns the new sources, segments, tombstones and the files that are no longer referenced
+def _compact(index_prefix: str, segments, sources, tombstones):
+    exact = [seg for seg in segments if _exact(seg)]
+    with thread_pool(DOWNLOAD_WORKERS) as pool:
+        vectors = dict(zip(
+            (seg["id"] for seg in exact), pool.map(lambda seg: _segment_vectors(index_prefix, seg), exact)
+        ))
+        rows = dict(zip(
+            (seg["id"] for seg in segments), pool.map(lambda seg: _segment_rows(index_prefix, seg), segments)
+        ))
+
+    names = {s["name"] for s in sources.values()}
+
+    # metadata row with mentions of removed documents dropped for good
+    def _row(seg, i):
+        row = dict(rows[seg["id"]][i])
+        if "sources" in row:
+            row["sources"] = [s for s in row["sources"] if s["source"] in names]
+        return row
+
+    # id ranges of every source, in id order, with the segment holding each one
+    order = sorted(sources, key=lambda k: sources[k]["start"])
+    pieces = {k: [(_segment_of(segments, a), a, b) for a, b in _ranges(sources[k])] for k in order}
+    new_ranges = {k: [] for k in order}
+    new_segments, new_tombstones, retired = [], [], []
+
+    # empty sources go with the merged segment
+    parts, merged_rows, empty_at = [], [], {}
+    for key in order:
+        empty_at[key] = len(merged_rows)
+        for seg, a, b in pieces[key]:
+            if not _exact(seg):
+                continue
+            lo, hi = a - seg["start"], b - seg["start"]
+            parts.append(vectors[seg["id"]][lo:hi])
+            new_ranges[key].append([len(merged_rows), len(merged_rows) + hi - lo])
+            merged_rows.extend(_row(seg, i) for i in range(lo, hi))
+    retired += [f for seg in exact for f in _segment_files(seg)]
+    if merged_rows:
+        new_segments.append(_write_segment(index_prefix, 0, np.concatenate(parts), merged_rows))
+    next_id = len(merged_rows)
+
+    for seg in segments:
+        if _exact(seg):
+            continue
+        # in id order, flat codes keep their order when the others are removed
+        held = sorted(((k, a, b) for k in order for s, a, b in pieces[k] if s is seg), key=lambda p: p[1])
+        if _removable(seg):
+            # flat codes are removed in place, later codes move down without being decoded
+            index = keep_ids(
+                deserialize_index(get_object_bytes(BUCKET, f"{index_prefix}/{seg['indexFile']}")),
+                np.concatenate([np.arange(a, b) - seg["start"] for _, a, b in held]),
+            )
+            seg_rows, offset = [], next_id
+            for k, a, b in held:
+                seg_rows.extend(_row(seg, i) for i in range(a - seg["start"], b - seg["start"]))
+                new_ranges[k].append([offset, offset + b - a])
+                offset += b - a
+            new_segments.append(_write_segment(index_prefix, next_id, reconstruct_all(index), seg_rows, index=index))
+            retired += _segment_files(seg)
+            next_id = offset
+            continue
+        # ivf and hnsw keep their files, only their ids shift and their metadata is cleaned
+        shift = next_id - seg["start"]
+        for k, a, b in held:
+            new_ranges[k].append([a + shift, b + shift])
+        new_tombstones += [[a + shift, b + shift] for a, b in tombstones if seg["start"] <= a < seg["end"]]
+        kept = dict(seg, start=seg["start"] + shift, end=seg["end"] + shift)
+        retired.append(seg["metaFile"])
+        kept["metaFile"] = f"segments/{seg['id']}.{uuid.uuid4().hex[:6]}.meta.bin"
+        put_bytes(BUCKET, f"{index_prefix}/{kept['metaFile']}", pack_metadata(
+            {i: _row(seg, i) for i in range(seg["end"] - seg["start"])}
+        ))
+        new_segments.append(kept)
+        next_id = kept["end"]
+    # adopted rows next to a source's own ones become part of its own range again
+    compacted = {k: _set_ranges(sources[k], new_ranges[k], empty_at[k]) for k in order}
+    return compacted, new_segments, new_tombstones, retired
+
+
+# checkpoint file stem for one version of one upload
+def _doc_file(key: str, etag: str) -> str:
+    return hashlib.sha1(f"{key}\0{etag}".encode("utf-8")).hexdigest()
+
+
+# true when this invocation should checkpoint and stop
+# uses lambda's remaining time, or the simulated limit when set
+def _out_of_time(context, processed: int) -> bool:
+    if SIMULATE_TIMEOUT_AFTER and processed >= SIMULATE_TIMEOUT_AFTER:
+        return True
+    if context is None or not hasattr(context, "get_remaining_time_in_millis"):
+        return False
+    return context.get_remaining_time_in_millis() < RESERVE_MS
+
+
+# progress summary returned while a job is unfinished
+# segments are the session's current ones, the job's own segment is written at the end
+def _progress(job, segments):
+    docs = job.get("docs", {}).values()
+    return {
+        "status": "in_progress",
+        "documents": len(docs),
+        "embedded": sum(d["stage"] == "embedded" for d in docs),
+        "chunked": sum(d["stage"] == "chunked" for d in docs),
+        "invocations": job.get("invocations", 0),
+        "startedAt": job.get("startedAt"),
+        # index family, vector storage and size, read by query when loading
+        "index": [dict(seg.get("format") or {}, id=seg["id"]) for seg in segments],
+    }
+
+
+# waits for embedding cache writes still running in the background,
+# lambda freezes the container once the handler returns
+def _flush_embeddings():
+    cache = get_embedding_cache()
+    if cache:
+        cache.flush()
+
+
+# saves job state and tells the caller to call again
+def _pause(job_key: str, job, segments):
+    _flush_embeddings()
+    # release the lease so a retry or the next call picks up right away
+    job["lease"] = None
+    _put_json(job_key, job)
+    return {
+        "statusCode": 202,
+        "body": json.dumps({"ok": True, "job": _progress(job, segments)}),
+    }
+
+
+# rows of removed or replaced sources that a surviving upload also contains, as
+# {global id: (source key, occurrence)}; the first surviving occurrence takes the row
+# over, so its vector stays and nothing is embedded again. only sources with surviving
+# aliases are looked at, their segments' metadata is the only thing read
+def _promotions(index_prefix: str, segments, sources, stale):
+    stale = set(stale)
+    survivors = {s["name"]: k for k, s in sources.items() if k not in stale}
+    ranges = [r for k in stale if any(a not in stale for a in sources[k].get("aliases", [])) for r in _ranges(sources[k])]
+    if not ranges:
+        return {}
+    touched = [seg for seg in segments if any(seg["start"] <= a < seg["end"] for a, _ in ranges)]
+    with thread_pool(DOWNLOAD_WORKERS) as pool:
+        rows = dict(zip((seg["id"] for seg in touched), pool.map(lambda seg: _segment_rows(index_prefix, seg), touched)))
+    promoted = {}
+    for a, b in ranges:
+        seg = _segment_of(segments, a)
+        for gid in range(a, b):
+            row = rows[seg["id"]][gid - seg["start"]]
+            entry = next((e for e in row.get("sources") or [] if e["source"] in survivors), None)
+            if entry:
+                promoted[gid] = (survivors[entry["source"]], entry)
+    return promoted
+
+
+# sources with the rows they take over from promotions added as adopted ranges
+def _adopt(sources, promoted, segments):
+    taken = {}
+    for gid, (key, _) in promoted.items():
+        taken.setdefault(key, []).append(gid)
+    return {
+        k: _set_ranges(s, _ranges(s) + _runs(taken[k], segments)) if k in taken else s
+        for k, s in sources.items()
+    }
+
+
+# rewrites a promoted row so the occurrence that took it over is its source,
+# mentions of sources that are gone are dropped
+def _promote_row(row, entry, names):
+    row = dict(row)
+    length = row["end_index"] - row["start_index"] if row.get("end_index") is not None else None
+    row.update(source=entry["source"], page=entry.get("page"), start_index=entry.get("start_index", 0))
+    if length is not None:
+        row["end_index"] = row["start_index"] + length
+    rest = list(row.get("sources") or [])
+    if entry in rest:
+        rest.remove(entry)
+    rest = [e for e in rest if e["source"] in names]
+    if rest:
+        row["sources"] = [entry] + rest
+    else:
+        row.pop("sources", None)
+    return row
+
+
+# adds a duplicate's source to a row's list of occurrences
+def _add_source(row, entry):
+    row.setdefault("sources", [{
+        "source": row.get("source"), "page": row.get("page"), "start_index": row.get("start_index"),
+    }])
+    row["sources"].append(entry)
+
+
+# next batch of documents to work on
+# honors the simulated limit so a forced stop lands mid-job
+def _next_window(todo, processed: int):
+    size = WINDOW_DOCS
+    if SIMULATE_TIMEOUT_AFTER:
+        size = max(1, min(size, SIMULATE_TIMEOUT_AFTER - processed))
+    return todo[:size], todo[size:]
+
+
+# marks chunks that duplicate an earlier chunk, existing rows included
+# existing rows are matched through the signatures stored with their segment
+# ({segment id: (exact keys, minhash signatures)}), their text is not read
+# a duplicate gets dupOf = [source key, offset] of the vector it collapses into,
+# offsets count only the vectors (non-duplicate chunks) of that source, across its ranges
+def _dedupe(changed, loaded, sources, segments, signatures):
+    keys, sigs, refs = [], [], []
+    for k in sorted(sources, key=lambda k: sources[k]["start"]):
+        offset = 0
+        for a, b in _ranges(sources[k]):
+            seg = _segment_of(segments, a)
+            lo, hi = a - seg["start"], b - seg["start"]
+            keys.extend(signatures[seg["id"]][0][lo:hi])
+            sigs.append(signatures[seg["id"]][1][lo:hi])
+            refs.extend([k, offset + j] for j in range(hi - lo))
+            offset += hi - lo
+    existing = len(refs)
+    texts = [c["text"] for k in changed for c in loaded[k]]
+    refs.extend([None] * len(texts))
+
+    reps = find_duplicates(texts, known=(keys, np.concatenate(sigs)) if sigs else None)
+    stats = {"chunks": len(texts), "duplicates": 0, "tokensSaved": 0}
+    pos = existing
+    for k in changed:
+        offset = 0
+        for c in loaded[k]:
+            if reps[pos] == pos:
+                c["dupOf"] = None
+                refs[pos] = [k, offset]
+                offset += 1
+            else:
+                # representatives come first, so their ref is already set
+                c["dupOf"] = refs[reps[pos]]
+                stats["duplicates"] += 1
+                stats["tokensSaved"] += c.get("tokens", 0)
+            pos += 1
+    stats["ratio"] = round(stats["duplicates"] / stats["chunks"], 4) if stats["chunks"] else 0.0
+    return stats
+
+
+# reads one upload straight into memory
+def _fetch(key: str) -> bytes:
+    return get_object_bytes(BUCKET, key)
+
+
+# pipelined fetch -> extract -> chunk over the given upload keys
+# downloads run on a thread pool, extraction and chunking on a process pool,
+# each document is handed to the cpu stage as soon as its download finishes
+# pdfs are split into page batches so one large book uses every worker; the pdf is
+# written to /tmp once and tasks get its path and page range, not its bytes, and
+# at most EXTRACT_QUEUE tasks per worker are queued at a time
+# returns chunk lists in the same order as keys
+def _load_chunks(keys):
+    if not keys:
+        return []
+    parts = [[] for _ in keys]
+    with tempfile.TemporaryDirectory(prefix="ingest-") as tmp, \
+            thread_pool(min(DOWNLOAD_WORKERS, len(keys))) as io, process_pool(EXTRACT_WORKERS) as cpu:
+        downloads = {io.submit(_fetch, key): i for i, key in enumerate(keys)}
+
+        # (document position, task) in download order
+        def _tasks():
+            for fut in as_completed(downloads):
+                i = downloads[fut]
+                name = keys[i].rsplit("/", 1)[-1]
+                content = fut.result()
+                if name.endswith(".pdf"):
+                    path = os.path.join(tmp, f"{i}.pdf")
+                    with open(path, "wb") as f:
+                        f.write(content)
+                    pages = pdf_page_count(content)
+                    for start in range(0, pages, PDF_BATCH_PAGES):
+                        yield i, (extract_pdf_chunks, name, path, start, start + PDF_BATCH_PAGES, 1000, 150)
+                else:
+                    yield i, (extract_chunks, name, content, 1000, 150)
+
+        running = set()
+        for i, task in _tasks():
+            if len(running) >= EXTRACT_QUEUE * EXTRACT_WORKERS:
+                _, running = wait(running, return_when=FIRST_COMPLETED)
+            fut = cpu.submit(*task)
+            parts[i].append(fut)
+            running.add(fut)
+        # page batches are stitched back in page order
+        return [[c for part in doc for c in part.result()] for doc in parts]
 
 
 def handler(event, context):
@@ -44,93 +624,370 @@ def handler(event, context):
     # prefixes for uploads and index
     upload_prefix = f"{SESSION_PREFIX}/{session_id}/uploads/"
     index_prefix = f"{SESSION_PREFIX}/{session_id}/index"
+    manifest_key = f"{index_prefix}/manifest.json"
+    # in-progress job state and per-document checkpoints
+    job_prefix = f"{index_prefix}/job"
+    job_key = f"{job_prefix}/state.json"
 
-    # list all text and pdf files in the upload directory
-    keys = [
-        k
-        for k in list_objects(BUCKET, upload_prefix)
-        if k.endswith((".txt", ".pdf"))
-    ]
+    # list all text and pdf files in the upload directory with their etags
+    uploads = {
+        o["key"]: o
+        for o in list_object_details(BUCKET, upload_prefix)
+        if o["key"].endswith((".txt", ".pdf"))
+    }
 
-    # list to store all text chunks
-    all_chunks = []
-    for key in keys:
-        # temporary file to download object
-        with tempfile.NamedTemporaryFile(delete=False) as tf:
-            download_object(BUCKET, key, tf.name)
-            # read and extract text from downloaded file
-            with open(tf.name, "rb") as f:
-                content = f.read()
-                if key.endswith(".pdf"):
-                    text = extract_pdf(content)
-                else:
-                    text = extract_txt(content)
-
-        # split text into chunks with overlap (for context)
-        chunks = chunk_text(text, chunk_size=1000, overlap=150)
-        # add source info to each chunk
-        for c in chunks:
-            c["source"] = key.rsplit("/", 1)[-1]
-        # add chunks to the main list
-        all_chunks.extend(chunks)
-
-    # check if no chunks were found
-    if not all_chunks:
-        # stats dict with zero chunks
-        stats = {
-            "sessionId": session_id,
-            "chunks": 0,
-            "lastIngestedAt": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+    # ingest manifest maps each source to its etag and vector id range
+    # a different embed model means the old vectors are unusable, so start over
+    manifest = _read_json(manifest_key) or {}
+    sources = manifest.get("sources", {}) if manifest.get("embedModel") == EMBED_MODEL else {}
+    # index segments, tombstoned id ranges and the next free vector id
+    segments = _segments(manifest, index_prefix)
+    tombstones = manifest.get("tombstones", [])
+    next_id = manifest.get("nextId", max((seg["end"] for seg in segments), default=0))
+    # files of replaced segments, deleted on the next write so running queries can finish
+    retired = manifest.get("retired", [])
+    if manifest and manifest.get("embedModel") != EMBED_MODEL:
+        # vectors from another model are unusable, start over
+        retired += [f for seg in segments for f in _segment_files(seg)]
+        segments, tombstones, next_id = [], [], 0
+
+    # new or replaced uploads need processing, missing or replaced ones lose their vectors
+    changed = [k for k in sorted(uploads) if sources.get(k, {}).get("etag") != uploads[k]["etag"]]
+    stale = [k for k in sources if k not in uploads or k in changed]
+    unchanged = [k for k in sorted(uploads) if k not in changed]
+
+    # embedding cache hit/miss counts for this run
+    cache_stats = {"memoryHits": 0, "persistentHits": 0, "misses": 0}
+    job = {}
+    promoted = {}
+    if changed or stale:
+        # resume the previous job, keeping checkpoints of uploads that are unchanged since
+        job, job_etag = _read_json_version(job_key)
+        job = job or {}
+        if job.get("embedModel") != EMBED_MODEL:
+            job = {}
+        now = time.time()
+        owner = getattr(context, "aws_request_id", None) or str(uuid.uuid4())
+        lease = job.get("lease") or {}
+        if lease.get("owner") != owner and lease.get("until", 0) > now:
+            # another invocation is working on this job
+            return {
+                "statusCode": 202,
+                "body": json.dumps({"ok": True, "job": _progress(job, segments)}),
+            }
+
+        docs = {
+            k: d for k, d in job.get("docs", {}).items()
+            if k in changed and d["etag"] == uploads[k]["etag"]
         }
+        for k in changed:
+            docs.setdefault(k, {
+                "etag": uploads[k]["etag"],
+                "stage": "pending",
+                "file": _doc_file(k, uploads[k]["etag"]),
+            })
+        # dedupe spans the whole job, so a different document set means redoing it
+        plan = [[k, uploads[k]["etag"]] for k in changed] + [[k, None] for k in sorted(stale)]
+        deduped = bool(job.get("deduped")) and job.get("plan") == plan
+        if not deduped:
+            for d in docs.values():
+                if d["stage"] != "pending":
+                    d["stage"] = "chunked"
+        remaining_ms = context.get_remaining_time_in_millis() if hasattr(context, "get_remaining_time_in_millis") else 900000
+        job = {
+            "embedModel": EMBED_MODEL,
+            "plan": plan,
+            "docs": docs,
+            "deduped": deduped,
+            "dedupe": job.get("dedupe") if deduped else None,
+            "startedAt": job.get("startedAt") or datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "invocations": job.get("invocations", 0) + 1,
+            "lease": {"owner": owner, "until": now + remaining_ms / 1000},
+        }
+        # the claim only succeeds if nobody wrote the job since it was read, so two
+        # invocations that both saw a free lease can't both take it
+        if _put_json_if(job_key, job, job_etag) is None:
+            return {
+                "statusCode": 202,
+                "body": json.dumps({"ok": True, "job": _progress(job, segments)}),
+            }
 
-        # upload stats to s3
-        get_s3_client().put_object(
-            Bucket=BUCKET,
-            Key=f"{index_prefix}/stats.json",
-            Body=json.dumps(stats).encode("utf-8"),
-            ContentType="application/json",
-        )
+        # rows of dropped sources that surviving uploads duplicated are kept, the
+        # surviving uploads take them over; new chunks can collapse into them too
+        promoted = _promotions(index_prefix, segments, sources, stale)
+        kept = _adopt({k: s for k, s in sources.items() if k not in stale}, promoted, segments)
 
-        # return success response with stats
-        return {
-            "statusCode": 200,
-            "body": json.dumps({"ok": True, "stats": stats}),
+        # chunks per document, read back from checkpoints when needed
+        loaded = {}
+
+        def _fill(keys):
+            missing = [k for k in keys if k not in loaded]
+            with thread_pool(DOWNLOAD_WORKERS) as pool:
+                for k, chunks in zip(missing, pool.map(
+                    lambda k: _read_json(f"{job_prefix}/{docs[k]['file']}.json"), missing
+                )):
+                    loaded[k] = chunks
+
+        # dedupe signatures of the segments holding surviving sources, by segment id
+        def _live_signatures(kept):
+            used = [seg for seg in segments if any(seg["start"] <= a < seg["end"] for s in kept.values() for a, _ in _ranges(s))]
+            with thread_pool(DOWNLOAD_WORKERS) as pool:
+                return dict(zip((seg["id"] for seg in used), pool.map(lambda seg: _segment_signatures(index_prefix, seg), used)))
+
+        # stage 1: chunk documents window by window, checkpointing each one
+        processed = 0
+        todo = [k for k in changed if docs[k]["stage"] == "pending"]
+        while todo:
+            if _out_of_time(context, processed):
+                return _pause(job_key, job, segments)
+            window, todo = _next_window(todo, processed)
+            for k, chunks in zip(window, _load_chunks(window)):
+                _put_json(f"{job_prefix}/{docs[k]['file']}.json", chunks)
+                docs[k].update(stage="chunked", chunks=len(chunks))
+                loaded[k] = chunks
+            processed += len(window)
+            _put_json(job_key, job)
+
+        # stage 2: collapse exact and near-duplicate chunks, against surviving rows too
+        # delete-only ingests have no new chunks, so surviving rows aren't read at all
+        if not job["deduped"] and changed:
+            if _out_of_time(context, processed):
+                return _pause(job_key, job, segments)
+            _fill(changed)
+            job["dedupe"] = _dedupe(changed, loaded, kept, segments, _live_signatures(kept))
+            with thread_pool(DOWNLOAD_WORKERS) as pool:
+                list(pool.map(lambda k: _put_json(f"{job_prefix}/{docs[k]['file']}.json", loaded[k]), changed))
+            job["deduped"] = True
+            _put_json(job_key, job)
+
+        # stage 3: embed the remaining unique chunks, one embed_texts call per window
+        todo = [k for k in changed if docs[k]["stage"] != "embedded"]
+        while todo:
+            if _out_of_time(context, processed):
+                return _pause(job_key, job, segments)
+            window, todo = _next_window(todo, processed)
+            _fill(window)
+            unique = [c for k in window for c in loaded[k] if c.get("dupOf") is None]
+            texts = [c["text"] for c in unique]
+            # chunk_text already counted each chunk's tokens, batching reuses them
+            vecs = np.array(embed_texts(
+                texts, stats=cache_stats, token_counts=[c.get("tokens") for c in unique]
+            ), dtype="float32") if texts else None
+            offset = 0
+            for k in window:
+                n = sum(c.get("dupOf") is None for c in loaded[k])
+                if n:
+                    _put_array(f"{job_prefix}/{docs[k]['file']}.npy", vecs[offset:offset + n])
+                docs[k]["stage"] = "embedded"
+                offset += n
+            processed += len(window)
+            _put_json(job_key, job)
+
+        # every document is embedded, read back checkpoints from earlier invocations
+        _fill(changed)
+        with thread_pool(DOWNLOAD_WORKERS) as pool:
+            arrays = dict(zip(changed, pool.map(
+                lambda k: _read_array(f"{job_prefix}/{docs[k]['file']}.npy")
+                if any(c.get("dupOf") is None for c in loaded[k]) else None,
+                changed,
+            )))
+
+        # deleted and replaced uploads only get tombstones, their segments stay as they are;
+        # rows a surviving upload took over are not tombstoned
+        dead = [gid for k in stale for a, b in _ranges(sources[k]) for gid in range(a, b) if gid not in promoted]
+        tombstones = tombstones + _runs(dead, segments)
+        # sources recorded before ingest times were kept fall back to their upload time
+        sources = {
+            k: dict(
+                s,
+                aliases=[a for a in s.get("aliases", []) if a not in stale],
+                ingestedAt=s.get("ingestedAt") or uploads[k]["lastModified"],
+            )
+            for k, s in kept.items()
         }
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+        # new documents take the next ids, duplicates only add their source to a row
+        base = next_id
+        new_rows = []
+        # rows of older segments that gained duplicate sources, by global id
+        edits = {}
+        for key in changed:
+            unique = [c for c in loaded[key] if c.get("dupOf") is None]
+            sources[key] = {
+                "name": key.rsplit("/", 1)[-1],
+                "etag": uploads[key]["etag"],
+                "size": uploads[key]["size"],
+                # filter fields for query
+                "uploadedAt": uploads[key]["lastModified"],
+                "ingestedAt": now,
+                "start": base + len(new_rows),
+                "end": base + len(new_rows) + len(unique),
+                "aliases": [],
+            }
+            new_rows.extend(create_metadata(unique).values())
+            for c in loaded[key]:
+                if c.get("dupOf") is None:
+                    continue
+                target, off = c["dupOf"]
+                gid = _gid(sources[target], off)
+                entry = {"source": sources[key]["name"], "page": c.get("page"), "start_index": c.get("start_index", 0)}
+                if gid >= base:
+                    _add_source(new_rows[gid - base], entry)
+                else:
+                    edits.setdefault(gid, []).append(entry)
+                if target != key and key not in sources[target]["aliases"]:
+                    sources[target]["aliases"].append(key)
+
+        # files of the previous write are no longer referenced by any manifest
+        for name in retired:
+            delete_object(BUCKET, f"{index_prefix}/{name}")
+        retired = []
+        # sessions indexed before manifests were re-ingested from scratch, their single index goes next
+        if not manifest:
+            retired += ["faiss.index", "meta.json", "meta.bin", "vectors.f32"]
+
+        # only the metadata of segments with promoted or edited rows is rewritten, never their index
+        names = {s["name"]: k for k, s in sources.items()}
+        for seg in segments:
+            touched = [gid for gid in list(promoted) + list(edits) if seg["start"] <= gid < seg["end"]]
+            if not touched:
+                continue
+            rows = _segment_rows(index_prefix, seg)
+            for gid in touched:
+                if gid in promoted:
+                    key, entry = promoted[gid]
+                    row = rows[gid - seg["start"]] = _promote_row(rows[gid - seg["start"]], entry, names)
+                    # the row's other occurrences now collapse into the source that took it over
+                    for e in row.get("sources", [])[1:]:
+                        if names[e["source"]] != key and names[e["source"]] not in sources[key]["aliases"]:
+                            sources[key]["aliases"].append(names[e["source"]])
+                for entry in edits.pop(gid, []):
+                    _add_source(rows[gid - seg["start"]], entry)
+            retired.append(seg["metaFile"])
+            seg["metaFile"] = f"segments/{seg['id']}.{uuid.uuid4().hex[:6]}.meta.bin"
+            put_bytes(BUCKET, f"{index_prefix}/{seg['metaFile']}", pack_metadata(rows))
+
+        # everything new goes into one new segment
+        if new_rows:
+            vecs = np.concatenate([arrays[k] for k in changed if arrays[k] is not None])
+            vecs = vecs / np.maximum(np.linalg.norm(vecs, axis=1, keepdims=True), 1e-12)
+            segments.append(_write_segment(index_prefix, base, vecs.astype("float32"), new_rows))
+            next_id = base + len(new_rows)
+        if job.get("dedupe") and segments:
+            # stored code size of the newest segment, plus the rescoring copy when it keeps one
+            # (formats recorded before codeSize are full precision flat vectors)
+            fmt = segments[-1].get("format") or {}
+            dimension = fmt.get("dimension", 0)
+            per_vector = fmt.get("codeSize", dimension * 4) + (dimension * 4 if fmt.get("rescore") else 0)
+            job["dedupe"]["indexBytesSaved"] = job["dedupe"]["duplicates"] * per_vector
+
+        # segments written before routing get their mean vector once
+        for seg in segments:
+            if not seg.get("centroid"):
+                seg["centroid"] = encode_vector(_segment_vectors(index_prefix, seg).mean(axis=0))
 
-    # generate embeddings for all chunks
-    embeddings = embed_texts([c["text"] for c in all_chunks])
-    vecs = np.array(embeddings, dtype="float32") # to numpy array
-    # create faiss index
-    index = create_index(vecs.shape[1])
-    # add vectors to the index
-    add_vectors(index, vecs)
-
-    # create metadata for the chunks
-    meta = create_metadata(all_chunks)
-
-    # save index and metadata to temporary files
-    with tempfile.NamedTemporaryFile(delete=False) as idxf, tempfile.NamedTemporaryFile(delete=False) as mf:
-        save_index(index, idxf.name)
-        save_metadata(meta, mf.name)
-        # upload index and metadata to s3
-        upload_file(idxf.name, BUCKET, f"{index_prefix}/faiss.index")
-        upload_file(mf.name, BUCKET, f"{index_prefix}/meta.json")
+        # segments whose vectors are all tombstoned are dropped right away
+        live = [seg for seg in segments if any(seg["start"] <= a < seg["end"] for s in sources.values() for a, _ in _ranges(s))]
+        for seg in segments:
+            if seg not in live:
+                retired += _segment_files(seg)
+                tombstones = [[a, b] for a, b in tombstones if not seg["start"] <= a < seg["end"]]
+        segments = live
+
+        # job is done, drop its checkpoints
+        for d in docs.values():
+            delete_object(BUCKET, f"{job_prefix}/{d['file']}.json")
+            delete_object(BUCKET, f"{job_prefix}/{d['file']}.npy")
+
+    # merge segments once fragmentation or segment count passes the threshold,
+    # unless this call is short on time (the next call will do it)
+    compacted = False
+    if segments and (body.get("compact") or _compaction_due(segments, tombstones)) and not _out_of_time(context, 0):
+        if not job:
+            for name in retired:
+                delete_object(BUCKET, f"{index_prefix}/{name}")
+            retired = []
+        sources, segments, tombstones, dropped = _compact(index_prefix, segments, sources, tombstones)
+        retired += dropped
+        next_id = max((seg["end"] for seg in segments), default=0)
+        compacted = True
+
+    if job or compacted:
+        # manifest is written last so it never points at segments that were not uploaded
+        manifest = {
+            "embedModel": EMBED_MODEL,
+            "sources": sources,
+            "segments": segments,
+            "tombstones": tombstones,
+            "nextId": next_id,
+            "retired": retired,
+            "updatedAt": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        }
+        version = _put_json(manifest_key, manifest)
+        # small pointer to the manifest version, query checks it instead of heading the manifest
+        _put_json(f"{index_prefix}/version.json", {
+            "version": version,
+            "manifest": "manifest.json",
+            "chunks": sum(_count(s) for s in sources.values()),
+            "segments": len(segments),
+            "formats": [seg.get("format") or {} for seg in segments],
+            "updatedAt": manifest["updatedAt"],
+        })
+        if job:
+            delete_object(BUCKET, job_key)
+        # routing entry follows the manifest, sessions without vectors aren't searched
+        routing_key = f"{ROUTING_PREFIX}/{session_id}.json"
+        centroid = session_centroid(segments)
+        if centroid is None:
+            delete_object(BUCKET, routing_key)
+        else:
+            _put_json(routing_key, {
+                "sessionId": session_id,
+                "embedModel": EMBED_MODEL,
+                "centroid": encode_vector(centroid),
+                "vectors": sum(_count(s) for s in sources.values()),
+                "updatedAt": manifest["updatedAt"],
+            })
+        # answers cached against the previous index version can't be hit anymore
+        answers = list_object_details(BUCKET, f"{SESSION_PREFIX}/{session_id}/cache/answers/")
+        with thread_pool(min(16, len(answers))) as pool:
+            list(pool.map(lambda o: delete_object(BUCKET, o["key"]), answers))
 
     # updated stats dict
     stats = {
         "sessionId": session_id,
-        "chunks": len(all_chunks),
+        "chunks": sum(_count(s) for s in sources.values()),
         "lastIngestedAt": datetime.datetime.now(datetime.timezone.utc).isoformat(),
-        "sources": sorted({c["source"] for c in all_chunks if c.get("source")}),
+        "sources": sorted({s["name"] for s in sources.values()}),
+        "added": len([k for k in changed if k not in stale]),
+        "replaced": len([k for k in changed if k in stale]),
+        "removed": len([k for k in stale if k not in uploads]),
+        # rows of dropped uploads kept because a surviving upload duplicated them
+        "promoted": len(promoted),
+        "unchanged": len(unchanged),
+        "invocations": job.get("invocations", 0),
+        # index segments (family, vector storage, size) and tombstoned share
+        "index": {
+            "segments": [dict(seg["format"], id=seg["id"]) for seg in segments],
+            "tombstoned": sum(end - start for start, end in tombstones),
+            "fragmentation": round(_fragmentation(segments, tombstones), 4),
+            "compacted": compacted,
+        },
+        "dedupe": job.get("dedupe") or {"chunks": 0, "duplicates": 0, "tokensSaved": 0, "ratio": 0.0, "indexBytesSaved": 0},
+        "embeddingCache": dict(
+            cache_stats,
+            hitRate=round(
+                (cache_stats["memoryHits"] + cache_stats["persistentHits"])
+                / max(1, sum(cache_stats.values())),
+                4,
+            ),
+        ),
     }
 
     # upload updated stats to s3
-    get_s3_client().put_object(
-        Bucket=BUCKET,
-        Key=f"{index_prefix}/stats.json",
-        Body=json.dumps(stats).encode("utf-8"),
-        ContentType="application/json",
-    )
+    _put_json(f"{index_prefix}/stats.json", stats)
+    _flush_embeddings()
 
     # return success response with stats
     return {
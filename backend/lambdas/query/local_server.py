@@ -0,0 +1,94 @@
+# local http adapter for the query lambda with real streaming
+# api gateway buffers lambda responses, this server sends "stream": true answers as
+# server sent events over chunked transfer encoding, token by token, and passes every
+# other request to handler unchanged
+# usage (from the repo root, with the lambda's env vars set):
+#   PYTHONPATH=. python backend/lambdas/query/local_server.py [port]
+import json
+import os
+import sys
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import main  # noqa: E402
+
+# origin the frontend dev server runs on
+ALLOW_ORIGIN = os.environ.get("QUERY_SERVER_ORIGIN", "http://localhost:3000")
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    # chunked transfer encoding needs http/1.1
+    protocol_version = "HTTP/1.1"
+
+    def _cors(self):
+        self.send_header("Access-Control-Allow-Origin", ALLOW_ORIGIN)
+        self.send_header("Access-Control-Allow-Methods", "POST, OPTIONS")
+        self.send_header("Access-Control-Allow-Headers", "content-type, authorization")
+
+    # writes one chunk and flushes it, so the client sees it right away
+    def _chunk(self, data: str):
+        data = data.encode("utf-8")
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_OPTIONS(self):
+        self.send_response(204)
+        self._cors()
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/query":
+            self.send_error(404)
+            return
+        raw = self.rfile.read(int(self.headers.get("Content-Length") or 0)).decode("utf-8")
+        try:
+            body = json.loads(raw or "{}")
+        except json.JSONDecodeError:
+            body = None
+        if not isinstance(body, dict):
+            self._reply(400, {"Content-Type": "application/json"}, json.dumps({"error": "invalid json body"}))
+            return
+
+        if not body.get("stream"):
+            response = main.handler({"body": raw}, None)
+            headers = dict({"Content-Type": "application/json"}, **(response.get("headers") or {}))
+            self._reply(response["statusCode"], headers, response.get("body") or "")
+            return
+
+        status, events = main.stream_query(body)
+        self.send_response(status)
+        self._cors()
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for event in events:
+                self._chunk(event)
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # the client went away, closing the generator skips saving the turn
+            getattr(events, "close", lambda: None)()
+
+    def _reply(self, status: int, headers, text: str):
+        data = text.encode("utf-8")
+        self.send_response(status)
+        self._cors()
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def run(port: int = 8080):
+    server = ThreadingHTTPServer(("127.0.0.1", port), QueryHandler)
+    print(f"query server on http://127.0.0.1:{port}/query")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 8080)
@@ -1,17 +1,41 @@
+import datetime
+import hashlib
 import json
 import os
-import tempfile
+import time
 
 import numpy as np
 
 from backend.shared import (
+    ChunkMetadata,
+    LexicalIndex,
+    LRUCache,
     chat,
-    download_object,
+    chat_stream,
     embed_texts,
+    get_answer_cache,
+    get_encoder,
+    get_index_disk_cache,
+    get_object_bytes,
+    get_object_if_exists,
+    get_object_range,
     if_object,
+    iter_object,
+    list_object_details,
+    ids_in_ranges,
     load_index,
-    load_metadata,
-    search_index,
+    loads_metadata,
+    normalize_text,
+    mmr,
+    reconstruct_ids,
+    search_shards_batch,
+    search_lexical,
+    rrf_fuse,
+    decode_vector,
+    rank_sessions,
+    rescore,
+    select_metadata,
+    thread_pool,
     get_messages,
     save_message,
     openai_messages,
@@ -24,6 +48,47 @@ NAMESPACE = os.environ.get("NAMESPACE", "default")
 MESSAGES_TABLE = os.environ["MESSAGES_TABLE"]
 # session prefix path
 SESSION_PREFIX = f"{NAMESPACE}/sessions"
+# per-session centroids written by ingest, for searches across sessions
+ROUTING_PREFIX = f"{NAMESPACE}/routing/centroids"
+# centroids from another embedding model can't be compared with the question
+EMBED_MODEL = os.environ.get("EMBED_MODEL", "text-embedding-3-small")
+CHAT_MODEL = os.environ.get("CHAT_MODEL", "gpt-4o-mini")
+# sessions searched per cross-session query, the closest by centroid
+ROUTE_SESSIONS = int(os.environ.get("QUERY_ROUTE_SESSIONS", "8"))
+
+# candidates per result re-ranked with full precision vectors when the index is quantized
+RESCORE_FACTOR = int(os.environ.get("INDEX_RESCORE_FACTOR", "4"))
+
+# retrieval mode unless the request sets one: hybrid (bm25 + dense, fused), dense or lexical
+RETRIEVAL = os.environ.get("QUERY_RETRIEVAL", "hybrid")
+# candidates per retriever that go into rank fusion
+FUSION_DEPTH = int(os.environ.get("QUERY_FUSION_DEPTH", "20"))
+# hybrid queries skip the embedding call when the best bm25 hit matches at least
+# this share of the question's term weight, 0 turns the fast path off
+LEXICAL_FAST = float(os.environ.get("QUERY_LEXICAL_FAST", "0"))
+
+# maximal marginal relevance over MMR_CANDIDATES * k hits, on unless a request sets "mmr": false
+# lambda 1 is plain relevance order, lower values favour chunks unlike those already picked
+MMR = os.environ.get("QUERY_MMR", "on").lower() in ("on", "1", "true")
+MMR_CANDIDATES = int(os.environ.get("QUERY_MMR_CANDIDATES", "4"))
+MMR_LAMBDA = float(os.environ.get("QUERY_MMR_LAMBDA", "0.7"))
+
+# questions per batch request ("questions"), and how many of their chats run at once
+MAX_QUESTIONS = int(os.environ.get("QUERY_MAX_QUESTIONS", "32"))
+CHAT_WORKERS = int(os.environ.get("QUERY_CHAT_WORKERS", "8"))
+
+# seconds a session's index version pointer is trusted before it is read again
+# a new ingest becomes visible to a warm container within this delay
+VERSION_TTL = float(os.environ.get("QUERY_VERSION_TTL", "2"))
+
+# read metadata rows with s3 ranged gets instead of caching meta.bin on disk
+META_RANGED = os.environ.get("QUERY_META_RANGED", "off").lower() in ("on", "1", "true")
+
+# load the tokenizer during lambda init instead of the first request
+get_encoder()
+
+# answer when retrieval found nothing, no chat call is made
+NO_CONTEXT_ANSWER = "I could not find relevant context in the indexed documents."
 
 # system prompt for the assistant
 SYSTEM_PROMPT = (
@@ -31,88 +96,475 @@ SYSTEM_PROMPT = (
     "Use only the supplied context. If you cannot find the answer in the context, say you do not know."
 )
 
-# global cache for index and metadata
-_cache = {}
+# in-memory cache for index and metadata, bounded by session count and size
+# evicted sessions reload from the /tmp disk cache without an s3 transfer
+_cache = LRUCache(
+    max_entries=int(os.environ.get("QUERY_CACHE_SESSIONS", "16")),
+    max_bytes=int(os.environ.get("QUERY_CACHE_MB", "512")) * 1024 * 1024,
+    sizeof=lambda entry: entry["bytes"],
+)
+
+# question embeddings by (embed model, normalized question), so repeated and retried
+# questions skip the embedding round trip
+_question_embeddings = LRUCache(
+    max_entries=int(os.environ.get("QUERY_EMBED_CACHE_ENTRIES", "2000")),
+    max_bytes=int(os.environ.get("QUERY_EMBED_CACHE_MB", "16")) * 1024 * 1024,
+)
+
+# retrieval results by (searched sessions with their manifest etags, question, search
+# parameters); a new index version changes the key and drops the session's entries
+_results = LRUCache(
+    max_entries=int(os.environ.get("QUERY_RESULT_CACHE_ENTRIES", "2000")),
+    max_bytes=int(os.environ.get("QUERY_RESULT_CACHE_MB", "16")) * 1024 * 1024,
+    sizeof=lambda entry: 256 + 128 * (len(entry[0]) + len(entry[2]) + len(entry[3])),
+)
+
+
+# one index segment as a searchable shard
+# segment files are never rewritten under the same name, so the disk cache keys on
+# their names; version tags files that are (the pre-segment faiss.index)
+def _load_segment(session_id: str, seg, tombstones, version: str = ""):
+    index_prefix = f"{SESSION_PREFIX}/{session_id}/index"
+    disk = get_index_disk_cache()
+
+    def _cached(name: str) -> str:
+        cache_name = f"{session_id}.{version}{name.rsplit('/', 1)[-1]}"
+        return disk.get(cache_name) or disk.put(cache_name, iter_object(BUCKET, f"{index_prefix}/{name}"))
+
+    fmt = seg.get("format") or {}
+    index_path = _cached(seg["indexFile"])
+    # mapped where the index type allows it, so idle sessions cost page cache, not rss
+    mapping = {}
+    index = load_index(index_path, mmap=True, kind=fmt.get("kind"), stats=mapping)
+
+    meta_key = f"{index_prefix}/{seg['metaFile']}"
+    meta_path = None
+    if META_RANGED and meta_key.endswith(".bin"):
+        # only the fixed columns are read now, row text comes with ranged gets
+        meta = ChunkMetadata(lambda start, end: get_object_range(BUCKET, meta_key, start, end))
+    elif meta_key.endswith(".bin"):
+        meta_path = _cached(seg["metaFile"])
+        # mapped, row text is paged in only for search hits
+        meta = ChunkMetadata.from_file(meta_path)
+    else:
+        # sessions ingested before the binary store
+        meta_path = _cached(seg["metaFile"])
+        with open(meta_path, "rb") as f:
+            meta = loads_metadata(f)
+
+    # the full precision copy for rescoring is cached and mapped like the index, so
+    # rescoring reads candidate rows from the page cache instead of s3
+    vectors_path = _cached(seg["vectorsFile"]) if fmt.get("rescore") and seg.get("vectorsFile") else None
+    vectors = np.memmap(vectors_path, dtype="float32", mode="r").reshape(-1, index.d) if vectors_path else None
+
+    # bm25 postings are mapped too, segments written before it are searched densely only
+    lexical_path = _cached(seg["lexicalFile"]) if seg.get("lexicalFile") else None
+    lexical = LexicalIndex.from_file(lexical_path) if lexical_path else None
+
+    # parsed json metadata takes about twice its file size, binary metadata is mapped
+    # (about 40 bytes of columns per row), mapped index codes and lists stay out of rss
+    size = len(meta) * 40
+    if meta_path and meta_path.endswith(".json"):
+        size = os.path.getsize(meta_path) * 2
+    size += max(0, os.path.getsize(index_path) - mapping["mappedBytes"])
+    # the vocabulary is held as a dict, postings stay mapped
+    size += os.path.getsize(lexical_path) // 4 if lexical_path else 0
+    return {
+        "id": seg["id"],
+        "index": index,
+        "meta": meta,
+        "lexical": lexical,
+        "start": seg["start"],
+        # tombstoned vectors stay in the segment until compaction, searches skip them
+        "exclude": ids_in_ranges(tombstones, seg["start"], seg["start"] + index.ntotal),
+        "vectors": vectors,
+        "paths": [p for p in (index_path, meta_path, lexical_path, vectors_path) if p],
+        "bytes": size,
+        # index family and how the index was mapped, reported with the request timings
+        "kind": fmt.get("kind") or "flat",
+        "mapping": mapping,
+    }
+
+
+# single faiss.index of sessions ingested before segments, as a one segment list
+# its files are rewritten in place, so they are cached under the index etag
+def _legacy_segments(session_id: str, manifest):
+    index_prefix = f"{SESSION_PREFIX}/{session_id}/index"
+    etag = get_etag(BUCKET, f"{index_prefix}/faiss.index")
+    if not etag:
+        return []
+    # index format lived in the manifest, or in stats.json before that
+    fmt = manifest.get("index") or _read_format(f"{index_prefix}/stats.json")
+    return [{
+        "id": "legacy",
+        "version": etag.strip('"') + ".",
+        "start": 0,
+        "indexFile": "faiss.index",
+        "metaFile": "meta.bin" if if_object(BUCKET, f"{index_prefix}/meta.bin") else "meta.json",
+        "vectorsFile": "vectors.f32",
+        "format": fmt,
+    }]
+
+
+# index format written by older ingests (family, quantization, rescoring copy)
+# the oldest sessions have no format and hold a plain flat index
+def _read_format(stats_key: str) -> dict:
+    try:
+        return json.loads(get_object_bytes(BUCKET, stats_key)).get("index") or {}
+    except Exception:
+        return {}
+
+
+# index versions by session as (read at, version, pointer)
+_versions = {}
+
+
+# current index version of a session as (version, pointer) from index/version.json,
+# read at most once per VERSION_TTL; sessions ingested before the pointer existed
+# fall back to the manifest etag, which ingest also publishes as the version
+def _index_version(session_id: str):
+    cached = _versions.get(session_id)
+    if cached and time.monotonic() - cached[0] <= VERSION_TTL:
+        return cached[1], cached[2]
+    index_prefix = f"{SESSION_PREFIX}/{session_id}/index"
+    data = get_object_if_exists(BUCKET, f"{index_prefix}/version.json")
+    pointer = json.loads(data) if data else None
+    version = pointer["version"] if pointer else get_etag(BUCKET, f"{index_prefix}/manifest.json")
+    _versions[session_id] = (time.monotonic(), version, pointer)
+    return version, pointer
 
 
+# loads every segment of a session as a shard, none when nothing was ingested yet
+# returns (shards, {live source name: ingest time} or none when the manifest doesn't list them,
+# manifest etag)
 def _load(session_id: str):
-    # keys for index and metadata
-    index_key = f"{SESSION_PREFIX}/{session_id}/index/faiss.index"
-    meta_key = f"{SESSION_PREFIX}/{session_id}/index/meta.json"
-    
-    # get etag for the index file
-    etag = get_etag(BUCKET, index_key)
-
-    # check if session data is cached
+    manifest_key = f"{SESSION_PREFIX}/{session_id}/index/manifest.json"
+
+    # every ingest and compaction rewrites the manifest, its etag versions the whole index
+    etag, pointer = _index_version(session_id)
+    if pointer and not pointer["segments"]:
+        return None
+
+    # check if session data is cached, an etag missing in both also matches
     cached = _cache.get(session_id)
-    if cached:
-        cached_etag = cached.get("etag")
-        # return cached data if etag matches
-        if etag and cached_etag == etag:
-            return cached["index"], cached["meta"]
-        # return cached data if etag is missing in both
-        if not etag and cached_etag is None:
-            return cached["index"], cached["meta"]
-
-    # download index and metadata to temporary files
-    with tempfile.NamedTemporaryFile(delete=False) as idxf, tempfile.NamedTemporaryFile(delete=False) as mf:
-        download_object(BUCKET, index_key, idxf.name)
-        download_object(BUCKET, meta_key, mf.name)
-        # load index and metadata from files
-        index = load_index(idxf.name)
-        meta = load_metadata(mf.name)
+    if cached and cached["etag"] == etag:
+        return cached["shards"], cached["names"], etag
+    # results cached against the previous version can't be hit again
+    _results.discard(lambda key: any(sid == session_id for sid, _ in key[0]))
+
+    manifest = json.loads(get_object_bytes(BUCKET, manifest_key)) if etag else {}
+    if "segments" in manifest:
+        segments = manifest["segments"]
+        # a name uploaded under several keys keeps its latest ingest time
+        names = {}
+        for source in sorted(manifest.get("sources", {}).values(), key=lambda s: s.get("ingestedAt") or ""):
+            names[source["name"]] = source.get("ingestedAt")
+    else:
+        segments = _legacy_segments(session_id, manifest)
+        names = None
+    if not segments:
+        return None
+
+    # segments load concurrently, a new version usually adds one and reuses the rest from disk
+    tombstones = manifest.get("tombstones", [])
+    with thread_pool(len(segments)) as pool:
+        shards = list(pool.map(
+            lambda seg: _load_segment(session_id, seg, tombstones, seg.get("version", "")), segments
+        ))
+    # files of retired segments and older versions are dead weight now
+    get_index_disk_cache().discard(f"{session_id}.", keep=[p for shard in shards for p in shard["paths"]])
 
     # update cache with new data
-    _cache[session_id] = {"etag": etag, "index": index, "meta": meta}
-    return index, meta
+    _cache.put(session_id, {
+        "etag": etag, "shards": shards, "names": names, "bytes": sum(shard["bytes"] for shard in shards),
+    })
+    return shards, names, etag
 
 
-def handler(event, context):
-    # parse the request body from json string or default to empty dict
-    body = json.loads(event.get("body") or "{}")
-    # extract question and session id from body
-    question = body.get("question", "")
-    session_id = body.get("sessionId")
-    # check if session id is provided
-    if not session_id:
-        return {
-            "statusCode": 400,
-            "body": json.dumps({"error": "sessionId required"}),
-        }
-    # check if question is provided
-    if not question:
-        return {
-            "statusCode": 400,
-            "body": json.dumps({"error": "question required"}),
-        }
+# routing entries by key as (etag, session id, unit centroid), refreshed per listing
+_routes = {}
 
-    # keys for index and metadata
-    index_key = f"{SESSION_PREFIX}/{session_id}/index/faiss.index"
-    meta_key = f"{SESSION_PREFIX}/{session_id}/index/meta.json"
-    # check if index or metadata exists
-    if not if_object(BUCKET, index_key) or not if_object(BUCKET, meta_key):
-        return {
-            "statusCode": 404,
-            "body": json.dumps(
-                {
-                    "error": "No index found for session. Upload and ingest documents first.",
-                    "sessionId": session_id,
-                }
-            ),
+
+# {session id: unit centroid} for every routable session in the namespace
+# one list call, and only entries whose etag changed are downloaded
+def _routing_table():
+    listed = {o["key"]: o["etag"] for o in list_object_details(BUCKET, f"{ROUTING_PREFIX}/") if o["key"].endswith(".json")}
+    changed = [key for key, etag in listed.items() if _routes.get(key, (None,))[0] != etag]
+
+    def _fetch(key):
+        entry = json.loads(get_object_bytes(BUCKET, key))
+        if entry.get("embedModel") != EMBED_MODEL:
+            return listed[key], entry["sessionId"], None
+        return listed[key], entry["sessionId"], decode_vector(entry["centroid"])
+
+    with thread_pool(min(16, len(changed))) as pool:
+        _routes.update(zip(changed, pool.map(_fetch, changed)))
+    for key in [key for key in _routes if key not in listed]:
+        del _routes[key]
+    return {sid: vec for _, sid, vec in _routes.values() if vec is not None}
+
+
+# sessions to search: the request's own, an explicit sessionIds list, or the whole
+# namespace with scope "namespace"; lists longer than maxSessions are routed by centroid
+# (of the mean question, for a batch); embed returns the question embeddings
+# returns (session ids, question embeddings if routing needed them, else none per question)
+def _search_targets(body, session_id: str, questions, embed=None):
+    if body.get("scope") == "namespace":
+        table = _routing_table()
+        session_ids = sorted(table)
+    elif body.get("sessionIds"):
+        session_ids = list(dict.fromkeys(str(sid) for sid in body["sessionIds"]))
+        table = None
+    else:
+        return [session_id], [None] * len(questions)
+    limit = int(body.get("maxSessions") or ROUTE_SESSIONS)
+    if len(session_ids) <= limit:
+        return session_ids, [None] * len(questions)
+    qembs = embed() if embed else _embed_questions(questions)
+    table = table if table is not None else _routing_table()
+    return rank_sessions(np.mean(qembs, axis=0), session_ids, table, limit), qembs
+
+
+# shards of several sessions, loaded concurrently, each tagged with its session
+# and that session's live source names (with their ingest times) and index etag
+def _load_sessions(session_ids):
+    with thread_pool(len(session_ids)) as pool:
+        loaded = list(pool.map(_load, session_ids))
+    tagged = []
+    for sid, result in zip(session_ids, loaded):
+        if result:
+            shards, names, etag = result
+            tagged.extend(dict(shard, session=sid, names=names, etag=etag) for shard in shards)
+    return tagged
+
+
+# question embeddings as float32 arrays, the ones not cached in one embed_texts call
+def _embed_questions(questions):
+    keys = [(EMBED_MODEL, normalize_text(question)) for question in questions]
+    found = {key: _question_embeddings.get(key) for key in dict.fromkeys(keys)}
+    missing = [key for key, emb in found.items() if emb is None]
+    if missing:
+        # questions are embedded once per container, so the shared embedding cache (and its
+        # s3 round trips) is skipped; _question_embeddings is the only cache here
+        for key, emb in zip(missing, embed_texts([text for _, text in missing], cache=False)):
+            found[key] = np.array(emb, dtype="float32")
+            _question_embeddings.put(key, found[key])
+    return [found[key] for key in keys]
+
+
+# checks and normalizes the request's "filters": {"sources": [names], "pages": [first, last],
+# "ingestedAfter": iso time, "ingestedBefore": iso time}; none when nothing is filtered
+def _parse_filters(filters):
+    if not filters:
+        return None
+    if not isinstance(filters, dict):
+        raise ValueError("filters must be an object")
+    sources = filters.get("sources")
+    if sources is not None and (not isinstance(sources, list) or not all(isinstance(x, str) for x in sources)):
+        raise ValueError("filters.sources must be a list of source names")
+    pages = filters.get("pages")
+    if pages is not None:
+        if not isinstance(pages, list) or len(pages) != 2 or not all(isinstance(x, int) for x in pages):
+            raise ValueError("filters.pages must be [first, last]")
+        pages = (min(pages), max(pages))
+    times = []
+    for field in ("ingestedAfter", "ingestedBefore"):
+        try:
+            times.append(_parse_time(filters[field]) if filters.get(field) else None)
+        except (TypeError, ValueError):
+            raise ValueError(f"filters.{field} must be an iso 8601 time")
+    return {"sources": sources, "pages": pages, "after": times[0], "before": times[1]}
+
+
+# timezone aware datetime of an iso 8601 string, naive times are utc
+def _parse_time(value: str) -> datetime.datetime:
+    parsed = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=datetime.timezone.utc)
+
+
+# boolean mask of the shard's local ids that pass the filters, none when all do
+# source and time filters resolve to source names (times come from the manifest, so
+# sessions that don't record them match no time filter), which the metadata turns
+# into a mask with its source and page columns
+def _filter_mask(shard, filters):
+    sources = filters["sources"]
+    if filters["after"] or filters["before"]:
+        names = shard["names"] or {}
+        timed = {
+            name for name, at in names.items()
+            if at and (not filters["after"] or _parse_time(at) >= filters["after"])
+            and (not filters["before"] or _parse_time(at) < filters["before"])
         }
-    # load index for semantic search
-    index, meta = _load(session_id)
-    # embed question and search for relevant chunks
-    qemb = np.array(embed_texts([question])[0], dtype="float32")
-    dists, inds = search_index(index, qemb, k=int(body.get("k", 5)))
+        sources = timed if sources is None else timed & set(sources)
+    if sources is None and filters["pages"] is None:
+        return None
+    meta = shard["meta"]
+    if isinstance(meta, ChunkMetadata):
+        return meta.select(sources, filters["pages"])
+    # json metadata of sessions ingested before the binary store
+    return select_metadata(meta, shard["index"].ntotal, sources, filters["pages"])
+
+
+# re-ranks hits from quantized shards with their full precision vectors
+# hits of exact shards already carry exact scores
+def _rescore_hits(qemb: np.ndarray, hits, shards, k: int):
+    rescored = [hit for hit in hits if shards[hit[1]]["vectors"] is None]
+    for pos in {hit[1] for hit in hits if shards[hit[1]]["vectors"] is not None}:
+        shard = shards[pos]
+        ids = np.array([hit[2] for hit in hits if hit[1] == pos], dtype="int64")
+        scores, ids = rescore(qemb, ids, np.asarray(shard["vectors"][ids]), len(ids))
+        rescored.extend((float(score), pos, int(i)) for score, i in zip(scores, ids))
+    return sorted(rescored, key=lambda hit: -hit[0])[:k]
+
+
+# reorders hits by maximal marginal relevance and keeps k
+# candidate vectors come from their shard's index, relevance is each hit's score
+# relative to the best one, so dense, lexical and fused scores all fit
+def _diversify(hits, shards, k: int, lambda_mult: float):
+    vectors = np.zeros((len(hits), shards[0]["index"].d), dtype="float32")
+    for pos in {hit[1] for hit in hits}:
+        rows = [n for n, hit in enumerate(hits) if hit[1] == pos]
+        vectors[rows] = reconstruct_ids(shards[pos]["index"], [hits[n][2] for n in rows])
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    scores = np.array([hit[0] for hit in hits], dtype="float32")
+    relevance = scores / max(float(scores.max()), 1e-12)
+    return [hits[n] for n in mmr(relevance, vectors, k, lambda_mult)]
+
+
+# retrieval for one or more questions against the same shards
+# questions that need dense search are embedded in one call and searched as one
+# matrix per shard; qembs holds embeddings computed earlier (none where missing)
+# returns per question (hits, retrieval mode, dense scores, lexical scores)
+def _retrieve(shards, questions, qembs, body, filters=None):
+    k = int(body.get("k", 5))
+    # filters travel as per-request shard copies, the cached shards stay untouched
+    if filters:
+        shards = [dict(shard, allow=_filter_mask(shard, filters)) for shard in shards]
+    mode = body.get("retrieval") or RETRIEVAL
+    # mmr picks the k results from a larger candidate pool
+    diversify = body.get("mmr", MMR) and MMR_CANDIDATES > 1
+    candidates = k * MMR_CANDIDATES if diversify else k
+
+    # bm25 over every shard with a lexical index, needs no embedding
+    has_lexical = any(shard["lexical"] for shard in shards)
+    lexical = [([], 0.0)] * len(questions)
+    if mode != "dense" and has_lexical:
+        lexical = [
+            search_lexical(
+                [shard["lexical"] for shard in shards], question,
+                k=candidates if mode == "lexical" else max(candidates, FUSION_DEPTH),
+                excludes=[shard["exclude"] for shard in shards],
+                allows=[shard.get("allow") for shard in shards],
+            )
+            for question in questions
+        ]
+    # a confident exact match answers without the paid embedding round trip
+    # sessions ingested without bm25 fall back to dense search
+    fast = [
+        has_lexical and (mode == "lexical" or (
+            mode == "hybrid" and qemb is None and LEXICAL_FAST and hits and confidence >= LEXICAL_FAST
+        ))
+        for qemb, (hits, confidence) in zip(qembs, lexical)
+    ]
+
+    # embed the remaining questions in one call and search them as one matrix
+    dense_rows = [n for n in range(len(questions)) if not fast[n]]
+    missing = [n for n in dense_rows if qembs[n] is None]
+    if missing:
+        for n, emb in zip(missing, _embed_questions([questions[n] for n in missing])):
+            qembs[n] = emb
+    depth = max(candidates, FUSION_DEPTH) if mode != "dense" and has_lexical else candidates
+    # quantized shards over-fetch and re-rank candidates at full precision
+    rescoring = body.get("rescore", True) and RESCORE_FACTOR > 1 and any(shard["vectors"] is not None for shard in shards)
+    dense = {}
+    if dense_rows:
+        dense = dict(zip(dense_rows, search_shards_batch(
+            shards, np.stack([qembs[n] for n in dense_rows]),
+            k=max(depth, k * RESCORE_FACTOR) if rescoring else depth,
+            nprobe=body.get("nprobe"), ef_search=body.get("efSearch"),
+        )))
 
+    def _finish(n):
+        lexical_hits = lexical[n][0]
+        if fast[n]:
+            hits, retrieval, dense_scores, lexical_scores = lexical_hits[:candidates], "lexical", {}, {}
+        else:
+            hits = dense[n]
+            if rescoring:
+                hits = _rescore_hits(qembs[n], hits, shards, depth)
+            # reciprocal rank fusion, each retriever keeps its own score for the response
+            dense_scores = {(pos, i): score for score, pos, i in hits}
+            lexical_scores = {(pos, i): score for score, pos, i in lexical_hits}
+            if lexical_hits:
+                hits, retrieval = rrf_fuse([hits, lexical_hits], candidates), "hybrid"
+            else:
+                hits, retrieval = hits[:candidates], "dense"
+        # neighbouring chunks overlap, keep one of each near-duplicate group
+        if diversify and len(hits) > k:
+            hits = _diversify(hits, shards, k, float(body.get("mmrLambda", MMR_LAMBDA)))
+        return hits, retrieval, dense_scores, lexical_scores
+
+    # rescoring reads rows from s3, so questions finish concurrently
+    with thread_pool(len(questions)) as pool:
+        return list(pool.map(_finish, range(len(questions))))
+
+
+# _retrieve with results cached per question
+# a result is only valid for the same sessions at the same index versions, searched in
+# the same order (hits point at shard positions) with the same parameters
+def _retrieve_cached(shards, questions, qembs, body, filters=None):
+    sessions = tuple(dict.fromkeys((shard["session"], shard["etag"]) for shard in shards))
+    params = json.dumps(
+        [body.get(field) for field in ("k", "retrieval", "mmr", "mmrLambda", "nprobe", "efSearch", "rescore", "filters")],
+        sort_keys=True, default=str,
+    )
+    keys = [
+        (sessions, hashlib.sha256(f"{EMBED_MODEL}\n{normalize_text(q)}".encode("utf-8")).hexdigest(), params)
+        for q in questions
+    ]
+    results = [_results.get(key) for key in keys]
+    # repeats within one batch are retrieved once
+    pending = {}
+    for n, (key, result) in enumerate(zip(keys, results)):
+        if result is None:
+            pending.setdefault(key, n)
+    if pending:
+        rows = list(pending.values())
+        embeddings = [qembs[n] for n in rows]
+        fresh = dict(zip(pending, _retrieve(shards, [questions[n] for n in rows], embeddings, body, filters)))
+        # embeddings computed by the search are handed back for the answer cache
+        computed = dict(zip(pending, embeddings))
+        for n, key in enumerate(keys):
+            if qembs[n] is None:
+                qembs[n] = computed.get(key)
+        for key, result in fresh.items():
+            _results.put(key, result)
+        results = [fresh[key] if result is None else result for key, result in zip(keys, results)]
+    return results
+
+
+# metadata rows for search hits, binary metadata reads each shard's rows concurrently
+def _hit_rows(hits, shards):
+    rows = {}
+    for pos in {hit[1] for hit in hits}:
+        meta = shards[pos]["meta"]
+        ids = [hit[2] for hit in hits if hit[1] == pos]
+        if isinstance(meta, ChunkMetadata):
+            found = meta.get_many(ids)
+        else:
+            found = [meta.get(str(i), {}) for i in ids]
+        rows.update({(pos, i): row for i, row in zip(ids, found)})
+    return [rows[(hit[1], hit[2])] for hit in hits]
+
+
+# prompt contexts and response chunks for one question's hits
+# attribute adds each chunk's sessionId, for searches beyond the caller's own session
+def _contexts(hits, shards, retrieval, dense_scores, lexical_scores, attribute: bool):
     # initialize lists for contexts and chunks
     contexts = []
     chunks = []
     # iterate over search results
-    for score, idx in zip(dists, inds):
-        # get metadata for the chunk
-        md = meta.get(str(int(idx)), {})
+    for (score, pos, i), md in zip(hits, _hit_rows(hits, shards)):
         if not md:
             continue
         # extract text, source, and page from metadata
@@ -122,26 +574,244 @@ def handler(event, context):
         label = source or "Unknown source"
         if page is not None:
             label = f"{label} (page {page})"
+        # deduplicated chunks list every document they appear in
+        names = shards[pos]["names"]
+        also = [s for s in md.get("sources") or [] if names is None or s["source"] in names]
+        if len(also) > 1:
+            label = "; ".join(
+                s["source"] + (f" (page {s['page']})" if s.get("page") is not None else "") for s in also
+            )
         # add formatted context and chunk details
         contexts.append(f"[{label}]\n{chunk_text}")
-        chunks.append(
-            {
-                "text": chunk_text,
-                "source": source,
-                "page": page,
-                "score": float(score),
-            }
-        )
+        chunk = {
+            "text": chunk_text,
+            "source": source,
+            "page": page,
+            "score": float(score),
+        }
+        if also:
+            chunk["sources"] = also
+        # fused results keep each retriever's own score next to the fused one
+        if retrieval == "hybrid":
+            if (pos, i) in dense_scores:
+                chunk["denseScore"] = dense_scores[(pos, i)]
+            if (pos, i) in lexical_scores:
+                chunk["lexicalScore"] = lexical_scores[(pos, i)]
+        # cross-session results say which session they came from
+        if attribute:
+            chunk["sessionId"] = shards[pos]["session"]
+        chunks.append(chunk)
+    return contexts, chunks
+
+
+# answer cache key of one question's hits: the chat setup, the index versions of the
+# sessions the hits come from and the hits' chunk ids in prompt order; conversation
+# history is left out, every turn adds to it, so a repeated question would never hit
+def _answer_key(hits, shards) -> str:
+    chunks = [[shards[pos]["session"], shards[pos]["id"], i] for _, pos, i in hits]
+    versions = sorted({(shards[pos]["session"], shards[pos]["etag"] or "") for _, pos, _ in hits})
+    data = json.dumps({"chat": [CHAT_MODEL, SYSTEM_PROMPT], "index": versions, "chunks": chunks})
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
 
-     # load conversation history from dynamodb
-    conversation_history = get_messages(BUCKET, session_id, NAMESPACE, table_name=MESSAGES_TABLE)
+
+# openai messages for one question: the prior conversation plus the question with its contexts
+def _chat_messages(conversation_history, question: str, contexts):
     # build question with context for current turn
+    current_question = f"Question: {question}\n\nContext:\n" + "\n\n".join(contexts)
+    # build openai messages with conversation history + new question
+    messages = openai_messages(conversation_history, SYSTEM_PROMPT)
+    messages.append({"role": "user", "content": current_question})
+    return messages
+
+
+# chat answer to one question given its contexts and the prior conversation
+def _answer(conversation_history, question: str, contexts) -> str:
+    if not contexts:
+        return NO_CONTEXT_ANSWER
+    # get answer from openai
+    return chat(_chat_messages(conversation_history, question, contexts), temperature=0)
+
+
+# runs fn and records its duration in ms under timings[name]
+def _timed(timings, name: str, fn, *args, **kwargs):
+    start = time.perf_counter()
+    try:
+        return fn(*args, **kwargs)
+    finally:
+        timings[name] = round((time.perf_counter() - start) * 1000, 1)
+
+
+# one log line per request: per-stage latency plus hit rates of the warm container caches
+# stages overlap, so totalMs is less than stagesMs (their sum) by the time saved
+# index counts the searched segments by family and by how they were mapped, and the
+# ones whose mmap load fell back to a full read
+def _log_timings(started: float, timings, questions: int, cached_answers: int, shards=()):
+    mappings = [shard["mapping"] for shard in shards]
+    kinds = [shard["kind"] for shard in shards]
+    print(json.dumps({
+        "timings": dict(
+            timings,
+            totalMs=round((time.perf_counter() - started) * 1000, 1),
+            stagesMs=round(sum(timings.values()), 1),
+            questions=questions,
+        ),
+        "caches": {
+            "index": _cache.stats(),
+            "questionEmbeddings": _question_embeddings.stats(),
+            "results": _results.stats(),
+            "answers": {"hits": cached_answers, "questions": questions},
+        },
+        "index": {
+            "segments": len(mappings),
+            "kinds": {kind: kinds.count(kind) for kind in sorted(set(kinds))},
+            "mapped": {mode: sum(m["mmap"] == mode for m in mappings) for mode in ("codes", "lists", "none")},
+            "mmapFallbacks": sum(m["mmap"] == "none" and "fallback" in m for m in mappings),
+        },
+    }))
+
+
+# validates a request and runs retrieval for its questions
+# returns (error response, none) or (none, request state) for the answer step
+def _prepare(body):
+    # extract question(s) and session id from body, "questions" asks several at once
+    batch = "questions" in body
+    questions = body.get("questions") if batch else [body.get("question", "")]
+    session_id = body.get("sessionId")
+    # check if session id is provided
+    if not session_id:
+        return {
+            "statusCode": 400,
+            "body": json.dumps({"error": "sessionId required"}),
+        }, None
+    # check if question is provided
+    if not isinstance(questions, list) or not questions or not all(isinstance(q, str) and q for q in questions):
+        return {
+            "statusCode": 400,
+            "body": json.dumps({"error": "questions must be a non-empty list of strings" if batch else "question required"}),
+        }, None
+    if len(questions) > MAX_QUESTIONS:
+        return {
+            "statusCode": 400,
+            "body": json.dumps({"error": f"at most {MAX_QUESTIONS} questions per request"}),
+        }, None
+
+    # metadata filters are applied inside the search, not to its results
+    try:
+        filters = _parse_filters(body.get("filters"))
+    except ValueError as e:
+        return {
+            "statusCode": 400,
+            "body": json.dumps({"error": str(e)}),
+        }, None
+
+    # the history read and the question embedding don't depend on the index, so they
+    # run while it loads; embeddings are only fetched ahead when dense search will need them
+    timings = {}
+    mode = body.get("retrieval") or RETRIEVAL
+    with thread_pool(2) as pool:
+        history = pool.submit(
+            _timed, timings, "historyMs", get_messages, BUCKET, session_id, NAMESPACE, table_name=MESSAGES_TABLE
+        )
+        prefetch = None
+        if mode != "lexical" and not LEXICAL_FAST:
+            prefetch = pool.submit(_timed, timings, "embedMs", _embed_questions, questions)
+        # sessions to search, routed by centroid when there are many
+        session_ids, qembs = _timed(
+            timings, "routeMs", _search_targets, body, session_id, questions, prefetch.result if prefetch else None
+        )
+        # load index shards of every target session once for all questions
+        shards = _timed(timings, "loadMs", _load_sessions, session_ids)
+        if prefetch and shards:
+            qembs = prefetch.result()
+    # check if anything was ingested
+    if not shards:
+        return {
+            "statusCode": 404,
+            "body": json.dumps(
+                {
+                    "error": "No index found for session. Upload and ingest documents first.",
+                    "sessionId": session_id,
+                    **({"sessionIds": session_ids} if len(session_ids) > 1 else {}),
+                }
+            ),
+        }, None
+    retrieved = _timed(timings, "retrieveMs", _retrieve_cached, shards, questions, qembs, body, filters)
+    # decided by the sessions actually searched, routing can narrow a list to one
+    # session that isn't the caller's
+    attribute = {shard["session"] for shard in shards} != {session_id}
+    found = _timed(timings, "contextsMs", lambda: [
+        _contexts(hits, shards, retrieval, dense_scores, lexical_scores, attribute)
+        for hits, retrieval, dense_scores, lexical_scores in retrieved
+    ])
+    return None, {
+        "batch": batch,
+        "questions": questions,
+        "sessionId": session_id,
+        "shards": shards,
+        "qembs": qembs,
+        "retrieved": retrieved,
+        "found": found,
+        "history": history.result(),
+        "timings": timings,
+    }
+
+
+# one server sent event
+def _sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+# streaming mode ("stream": true) for one question
+# returns (status code, server sent events): "chunks" with the retrieved chunks as soon
+# as retrieval is done, "token" events with answer text as the chat generates it, then
+# "done" with the whole answer; the turn is saved once the answer is complete
+def stream_query(body):
+    started = time.perf_counter()
+    if "questions" in body:
+        return 400, iter([_sse("error", {"error": "stream answers a single question"})])
+    error, state = _prepare(body)
+    if error:
+        return error["statusCode"], iter([_sse("error", json.loads(error["body"]))])
+    return 200, _stream_events(body, state, started)
+
+
+# events of one streamed answer, after retrieval in stream_query
+def _stream_events(body, state, started: float):
+    session_id, question = state["sessionId"], state["questions"][0]
+    hits, retrieval = state["retrieved"][0][:2]
+    contexts, chunks = state["found"][0]
+    yield _sse("chunks", {"chunks": chunks, "retrieval": retrieval, "sessionId": session_id})
+
+    conversation_history, timings = state["history"], state["timings"]
+    chat_started = time.perf_counter()
+    # cached answers and the no-context answer come as a single token
+    answer, cached = NO_CONTEXT_ANSWER, False
+    answer_cache = get_answer_cache() if body.get("answerCache", True) and contexts else None
     if contexts:
-        current_question = f"Question: {question}\n\nContext:\n" + "\n\n".join(contexts)
+        key = _answer_key(hits, state["shards"]) if answer_cache else None
+        answer = answer_cache.get(session_id, key, question, state["qembs"][0]) if answer_cache else None
+        cached = answer is not None
+    if answer is not None:
+        yield _sse("token", {"text": answer})
     else:
-        current_question = question
-    # save user message to history
-    save_message(
+        parts = []
+        try:
+            for text in chat_stream(_chat_messages(conversation_history, question, contexts), temperature=0):
+                parts.append(text)
+                yield _sse("token", {"text": text})
+        except Exception as e:
+            # nothing is saved for a turn that was cut off
+            yield _sse("error", {"error": f"chat failed: {e}"})
+            return
+        answer = "".join(parts)
+        if answer_cache:
+            answer_cache.put(session_id, key, question, answer, state["qembs"][0])
+
+    timings["chatMs"] = round((time.perf_counter() - chat_started) * 1000, 1)
+
+    # the turn is saved once the whole answer is known
+    _timed(
+        timings, "saveQuestionMs", save_message,
         bucket=BUCKET,
         session_id=session_id,
         role="user",
@@ -149,17 +819,8 @@ def handler(event, context):
         namespace=NAMESPACE,
         table_name=MESSAGES_TABLE,
     )
-
-    # build openai messages with conversation history + new question
-    messages = openai_messages(conversation_history, SYSTEM_PROMPT)
-    messages.append({"role": "user", "content": current_question})
-    # get answer from openai
-    if contexts:
-        answer = chat(messages, temperature=0)
-    else:
-        answer = "I could not find relevant context in the indexed documents."
-    # save assistant response to history
-    save_message(
+    _timed(
+        timings, "saveAnswerMs", save_message,
         bucket=BUCKET,
         session_id=session_id,
         role="assistant",
@@ -168,17 +829,112 @@ def handler(event, context):
         namespace=NAMESPACE,
         table_name=MESSAGES_TABLE,
     )
+    _log_timings(started, timings, 1, int(cached), state["shards"])
+    yield _sse("done", {"answer": answer, "cached": cached, "retrieval": retrieval, "sessionId": session_id})
+
+
+def handler(event, context):
+    started = time.perf_counter()
+    # parse the request body from json string or default to empty dict
+    body = json.loads(event.get("body") or "{}")
+    # api gateway buffers lambda responses, so the events arrive together there;
+    # local_server.py sends them as they are produced
+    if body.get("stream"):
+        status, events = stream_query(body)
+        return {
+            "statusCode": status,
+            "headers": {"Content-Type": "text/event-stream", "Cache-Control": "no-cache"},
+            "body": "".join(events),
+        }
+    error, state = _prepare(body)
+    if error:
+        return error
+    batch, questions, session_id = state["batch"], state["questions"], state["sessionId"]
+    shards, qembs, retrieved, found = state["shards"], state["qembs"], state["retrieved"], state["found"]
+
+    # history was read while the index loaded
+    conversation_history, timings = state["history"], state["timings"]
+    # earlier answers over the same chunks are reused for the same or a paraphrased question
+    answer_cache = get_answer_cache() if body.get("answerCache", True) else None
 
-    # get updated conversation history
-    updated_history = get_messages(BUCKET, session_id, NAMESPACE, table_name=MESSAGES_TABLE)
+    def _respond(n):
+        contexts = found[n][0]
+        if not answer_cache or not contexts:
+            return _answer(conversation_history, questions[n], contexts), False
+        key = _answer_key(retrieved[n][0], shards)
+        answer = answer_cache.get(session_id, key, questions[n], qembs[n])
+        if answer is not None:
+            return answer, True
+        answer = _answer(conversation_history, questions[n], contexts)
+        answer_cache.put(session_id, key, questions[n], answer, qembs[n])
+        return answer, False
+
+    saved = []
+    # every question is answered against the same prior history, chats run concurrently;
+    # a single question's user message is saved while its answer is generated
+    with thread_pool(min(CHAT_WORKERS, len(questions)) + 1) as pool:
+        user_message = None
+        if not batch:
+            user_message = pool.submit(
+                _timed, timings, "saveQuestionMs", save_message,
+                bucket=BUCKET,
+                session_id=session_id,
+                role="user",
+                content=questions[0],
+                namespace=NAMESPACE,
+                table_name=MESSAGES_TABLE,
+            )
+        answers, cached = zip(*_timed(timings, "chatMs", lambda: list(pool.map(_respond, range(len(questions))))))
+        if user_message:
+            saved.append(user_message.result())
+
+    # save turns in question order once all answers are in
+    save_started = time.perf_counter()
+    for question, answer, (_, chunks) in zip(questions, answers, found):
+        if batch:
+            saved.append(save_message(
+                bucket=BUCKET,
+                session_id=session_id,
+                role="user",
+                content=question,
+                namespace=NAMESPACE,
+                table_name=MESSAGES_TABLE,
+            ))
+        # save assistant response to history
+        saved.append(save_message(
+            bucket=BUCKET,
+            session_id=session_id,
+            role="assistant",
+            content=answer,
+            chunks=chunks,
+            namespace=NAMESPACE,
+            table_name=MESSAGES_TABLE,
+        ))
+    timings["saveAnswerMs"] = round((time.perf_counter() - save_started) * 1000, 1)
+
+    # updated conversation history: the history read for the prompt plus this request's
+    # turns, as save_message stored them, instead of reading it all again
+    updated_history = conversation_history + saved
+    _log_timings(started, timings, len(questions), sum(cached), shards)
+    if batch:
+        results = [
+            {"question": question, "answer": answer, "chunks": chunks, "retrieval": result[1], "cached": hit}
+            for question, answer, (_, chunks), result, hit in zip(questions, answers, found, retrieved, cached)
+        ]
+        return {
+            "statusCode": 200,
+            "body": json.dumps({"results": results, "sessionId": session_id, "messages": updated_history}),
+        }
     # return successful response with answer and history
     return {
         "statusCode": 200,
         "body": json.dumps(
             {
-                "answer": answer,
-                "chunks": chunks,
+                "answer": answers[0],
+                "chunks": found[0][1],
                 "sessionId": session_id,
+                "retrieval": retrieved[0][1],
+                "cached": cached[0],
                 "messages": updated_history,
             }
         ),
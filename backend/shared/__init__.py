@@ -5,8 +5,16 @@ from .s3_utils import (
     get_s3_client,
     generate_put_url,
     download_object,
+    get_object_bytes,
+    get_object_if_exists,
+    get_object_stream,
+    get_object_range,
+    iter_object,
+    put_bytes,
     upload_file,
     list_objects,
+    list_object_details,
+    delete_object,
     if_object,
     get_etag
 )
@@ -16,25 +24,101 @@ from .openai_utils import (
     get_openai_client,
     embed_texts,
     chat,
+    chat_stream,
 )
 
 from .chunking import (
+    PDF_BATCH_PAGES,
+    get_encoder,
     count_tokens,
     chunk_text,
     extract_pdf,
+    extract_pdf_pages,
+    extract_pdf_chunks,
+    iter_pdf_pages,
+    pdf_page_count,
+    chunk_pages,
     extract_txt,
+    extract_chunks,
 )
 
 from .faiss_utils import (
     create_index,
     add_vectors,
     search_index,
+    search_index_batch,
+    search_shards,
+    search_shards_batch,
+    ids_in_ranges,
+    choose_index_kind,
+    index_kind,
+    reconstruct_all,
+    reconstruct_ids,
+    keep_ids,
+    ensure_direct_map,
+    mmr,
+    rescore,
+    index_quantization,
+    index_format,
+    index_code_size,
     save_index,
     load_index,
+    serialize_index,
+    deserialize_index,
     create_metadata,
     save_metadata,
     load_metadata,
-    merge_indexes,
+    dumps_metadata,
+    loads_metadata,
+)
+
+from .cache_utils import (
+    LRUCache,
+    DiskCache,
+    EmbeddingCache,
+    AnswerCache,
+    get_embedding_cache,
+    get_answer_cache,
+    get_index_disk_cache,
+    text_hash,
+    normalize_text,
+)
+
+from .concurrency import (
+    cpu_workers,
+    thread_pool,
+    process_pool,
+    PipePool,
+)
+
+from .metadata_store import (
+    ChunkMetadata,
+    pack_metadata,
+    is_packed_metadata,
+    select_metadata,
+)
+
+from .dedupe import (
+    exact_key,
+    minhash,
+    find_duplicates,
+    pack_signatures,
+    load_signatures,
+)
+
+from .lexical_index import (
+    LexicalIndex,
+    tokenize,
+    pack_lexical,
+    search_lexical,
+    rrf_fuse,
+)
+
+from .routing_utils import (
+    encode_vector,
+    decode_vector,
+    session_centroid,
+    rank_sessions,
 )
 
 from .dynamodb_utils import (
@@ -54,8 +138,16 @@ __all__ = [
     "get_s3_client",
     "generate_put_url",
     "download_object",
+    "get_object_bytes",
+    "get_object_if_exists",
+    "get_object_stream",
+    "get_object_range",
+    "iter_object",
+    "put_bytes",
     "upload_file",
     "list_objects",
+    "list_object_details",
+    "delete_object",
     "if_object",
     "get_etag",
     
@@ -64,23 +156,93 @@ __all__ = [
     "get_openai_client",
     "embed_texts",
     "chat",
+    "chat_stream",
     
     # text processing utils
+    "PDF_BATCH_PAGES",
+    "get_encoder",
     "count_tokens",
     "chunk_text",
     "extract_pdf",
+    "extract_pdf_pages",
+    "extract_pdf_chunks",
+    "iter_pdf_pages",
+    "pdf_page_count",
+    "chunk_pages",
     "extract_txt",
+    "extract_chunks",
     
     # vector search utils
     "create_index",
     "add_vectors",
     "search_index",
+    "search_index_batch",
+    "search_shards",
+    "search_shards_batch",
+    "ids_in_ranges",
+    "choose_index_kind",
+    "index_kind",
+    "reconstruct_all",
+    "reconstruct_ids",
+    "keep_ids",
+    "ensure_direct_map",
+    "mmr",
+    "rescore",
+    "index_quantization",
+    "index_format",
+    "index_code_size",
     "save_index",
     "load_index",
+    "serialize_index",
+    "deserialize_index",
     "create_metadata",
     "save_metadata",
     "load_metadata",
-    "merge_indexes",
+    "dumps_metadata",
+    "loads_metadata",
+    
+    # cache utils
+    "LRUCache",
+    "DiskCache",
+    "EmbeddingCache",
+    "AnswerCache",
+    "get_embedding_cache",
+    "get_answer_cache",
+    "get_index_disk_cache",
+    "text_hash",
+    "normalize_text",
+    
+    # concurrency utils
+    "cpu_workers",
+    "thread_pool",
+    "process_pool",
+    "PipePool",
+    
+    # metadata store
+    "ChunkMetadata",
+    "pack_metadata",
+    "is_packed_metadata",
+    "select_metadata",
+    
+    # dedupe utils
+    "exact_key",
+    "minhash",
+    "find_duplicates",
+    "pack_signatures",
+    "load_signatures",
+    
+    # lexical index
+    "LexicalIndex",
+    "tokenize",
+    "pack_lexical",
+    "search_lexical",
+    "rrf_fuse",
+    
+    # routing utils
+    "encode_vector",
+    "decode_vector",
+    "session_centroid",
+    "rank_sessions",
     
     # message history utils
     "save_message",
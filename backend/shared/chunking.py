@@ -1,89 +1,269 @@
 # breaking docs into manageable pieces for vector search and retrieval
+import base64
+import hashlib
+import os
+import re
+from functools import lru_cache
 from typing import List, Dict
+import numpy as np
 import tiktoken
+import tiktoken.model
 import pypdf
 from io import BytesIO
 
+# cl100k_base bpe ranks packaged with the code layer
+# avoids tiktoken downloading them on a cold start (or failing without egress)
+BPE_PATH = os.environ.get(
+    "TIKTOKEN_BPE_PATH",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "cl100k_base.tiktoken"),
+)
+# sha256 published by tiktoken for cl100k_base.tiktoken
+BPE_SHA256 = "223921b76ee99bde995b7ff738513eef100fb51d18c93597a113bcffe865b2a7"
+# cl100k_base split pattern and special tokens (as in tiktoken_ext.openai_public)
+_CL100K_PATTERN = r"""'(?i:[sdmt]|ll|ve|re)|[^\r\n\p{L}\p{N}]?+\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]++[\r\n]*|\s*[\r\n]|\s+(?!\S)|\s+"""
+_CL100K_SPECIAL = {
+    "<|endoftext|>": 100257,
+    "<|fim_prefix|>": 100258,
+    "<|fim_middle|>": 100259,
+    "<|fim_suffix|>": 100260,
+    "<|endofprompt|>": 100276,
+}
+
+# creates/caches the cl100k_base encoder (gpt-4 and text-embedding-3 models)
+# loads ranks from the packaged file, falls back to tiktoken's own loader
+@lru_cache(maxsize=1)
+def get_encoder():
+    if BPE_PATH and os.path.exists(BPE_PATH):
+        with open(BPE_PATH, "rb") as f:
+            data = f.read()
+        if hashlib.sha256(data).hexdigest() == BPE_SHA256:
+            ranks = {
+                base64.b64decode(token): int(rank)
+                for token, rank in (line.split() for line in data.splitlines() if line)
+            }
+            return tiktoken.Encoding(
+                name="cl100k_base",
+                pat_str=_CL100K_PATTERN,
+                mergeable_ranks=ranks,
+                special_tokens=_CL100K_SPECIAL,
+            )
+        print(f"packaged bpe file {BPE_PATH} failed its hash check, using tiktoken download")
+    return tiktoken.get_encoding("cl100k_base")
+
+# encoder for a model, the preloaded singleton for cl100k models
+def _encoder_for(model: str):
+    try:
+        name = tiktoken.model.encoding_name_for_model(model)
+    except KeyError:
+        name = "cl100k_base"
+    if name == "cl100k_base":
+        return get_encoder()
+    return tiktoken.get_encoding(name)
+
 # counts tokens in text for chunking sizing and api limits
 # using gpt-4 tokenzier
 def count_tokens(text: str, model: str = "gpt-4"):
-    enc = tiktoken.encoding_for_model(model)
-    return len(enc.encode(text))
+    enc = _encoder_for(model)
+    return len(enc.encode(text, disallowed_special=()))
+
+# byte length of every token id, built once per encoder
+@lru_cache(maxsize=4)
+def _token_lengths(enc) -> np.ndarray:
+    lengths = np.zeros(enc.n_vocab, dtype=np.int64)
+    for token in range(enc.n_vocab):
+        try:
+            lengths[token] = len(enc.decode_single_token_bytes(token))
+        except KeyError:
+            # unused ids between the regular and special tokens
+            continue
+    return lengths
+
+# character offset where each token starts, vectorized
+# utf-8 continuation bytes don't start a character, so a running count of
+# non-continuation bytes maps byte offsets to character offsets
+def _token_offsets(enc, tokens: List[int], text: str) -> np.ndarray:
+    data = np.frombuffer(text.encode("utf-8", errors="surrogatepass"), dtype=np.uint8)
+    if len(data) == 0:
+        return np.zeros(len(tokens), dtype=np.int64)
+    continuation = (data & 0xC0) == 0x80
+    chars_before = np.concatenate(([0], np.cumsum(~continuation)))
+    byte_starts = np.concatenate(([0], np.cumsum(_token_lengths(enc)[np.asarray(tokens)])[:-1]))
+    byte_starts = np.minimum(byte_starts, len(data) - 1)
+    # a token starting mid-character belongs to that character
+    return np.maximum(chars_before[byte_starts] - continuation[byte_starts], 0)
+
+# sentence boundary, a period followed by whitespace
+_SENTENCE_END = re.compile(r'\.\s')
+# safe split point for parallel encoding, no bpe piece spans ". " before a letter
+_SEGMENT_BREAK = re.compile(r'\. (?=\w)')
+# documents above this many characters are encoded in parallel segments
+_SEGMENT_CHARS = 256 * 1024
+# a cut span encodes differently from the same tokens in context only at its edges,
+# so chunks within this many tokens of chunk_size are encoded again and trimmed
+_RECHECK_MARGIN = 4
+
+# encodes the whole document once
+# large documents are cut at sentence breaks and encoded across threads,
+# the concatenated tokens match a single encode of the full text
+def _encode(enc, text: str) -> List[int]:
+    threads = os.cpu_count() or 1
+    if threads <= 1 or len(text) <= 2 * _SEGMENT_CHARS:
+        return enc.encode(text, disallowed_special=())
+    segments = []
+    start = 0
+    while start < len(text):
+        m = _SEGMENT_BREAK.search(text, start + _SEGMENT_CHARS)
+        end = m.start() + 1 if m else len(text)
+        segments.append(text[start:end])
+        start = end
+    encoded = enc.encode_batch(segments, num_threads=threads, disallowed_special=())
+    return [t for segment in encoded for t in segment]
+
+# trims stripped chunk text until it encodes to at most chunk_size tokens
+# returns (text, token count)
+def _fit(enc, text: str, chunk_size: int):
+    tokens = enc.encode(text, disallowed_special=())
+    while len(tokens) > chunk_size:
+        text = text[:int(_token_offsets(enc, tokens, text)[chunk_size])].rstrip()
+        tokens = enc.encode(text, disallowed_special=())
+    return text, len(tokens)
 
-# splits into sentences (sentences first for semantic coherence)
-# build chunks within size limits
-# duplicates overlaps at boundaries (to preserve context across chunks)
-# remaining text becomes final chunk
+# tokenizes the document once and cuts it on token offsets
+# sentences are packed into chunks (sentences first for semantic coherence)
+# sentences longer than chunk_size are split so no chunk exceeds it, and chunks near
+# the limit are checked again after stripping, since a cut span can encode to more tokens
+# trailing sentences are repeated at boundaries (to preserve context across chunks)
+# start_index/end_index are the chunk's character span in the original text
 def chunk_text(text: str, chunk_size: int = 1000, overlap: int = 150):
-    enc = tiktoken.encoding_for_model("gpt-4")
-    
-    # split by sentences first for better chunks
-    sentences = text.split('. ')
+    enc = get_encoder()
+
+    tokens = _encode(enc, text)
+    n = len(tokens)
+    if n == 0:
+        return []
+    # character offset where each token starts, plus the end of the text
+    offsets = np.append(_token_offsets(enc, tokens, text), len(text))
+
+    # token index where each sentence starts
+    ends = np.fromiter((m.start() + 1 for m in _SENTENCE_END.finditer(text)), dtype=np.int64)
+    cuts = np.unique(np.searchsorted(offsets[:n], ends, side="left"))
+    cuts = cuts[(cuts > 0) & (cuts < n)].tolist() + [n]
+
+    # sentence units as [start, end) token ranges, capped at chunk_size tokens
+    units = []
+    prev = 0
+    for cut in cuts:
+        while cut - prev > chunk_size:
+            units.append((prev, prev + chunk_size))
+            prev += chunk_size
+        units.append((prev, cut))
+        prev = cut
+
     chunks = []
-    current_chunk = []
-    current_tokens = 0
-    start_idx = 0
-    
-    for sentence in sentences:
-        sentence_tokens = len(enc.encode(sentence))
-        
-        if current_tokens + sentence_tokens > chunk_size and current_chunk:
-            # save current chunk
-            chunk_text = '. '.join(current_chunk)
+    first = 0
+    while first < len(units):
+        # grow the chunk while the next sentence still fits
+        last = first
+        while last + 1 < len(units) and units[last + 1][1] - units[first][0] <= chunk_size:
+            last += 1
+
+        # cut on token offsets, trimming surrounding whitespace from the span
+        tok_start, tok_end = units[first][0], units[last][1]
+        char_start, char_end = int(offsets[tok_start]), int(offsets[tok_end])
+        body = text[char_start:char_end]
+        stripped = body.strip()
+        count = tok_end - tok_start
+        if stripped and count > chunk_size - _RECHECK_MARGIN:
+            stripped, count = _fit(enc, stripped, chunk_size)
+        if stripped:
+            lead = len(body) - len(body.lstrip())
             chunks.append({
-                'text': chunk_text,
-                'start_index': start_idx,
-                'tokens': current_tokens
+                'text': stripped,
+                'start_index': char_start + lead,
+                'end_index': char_start + lead + len(stripped),
+                'tokens': count,
             })
-            
-            # start new chunk with overlap
-            overlap_sentences = []
-            overlap_tokens = 0
-            for s in reversed(current_chunk):
-                t = len(enc.encode(s))
-                if overlap_tokens + t <= overlap:
-                    overlap_sentences.insert(0, s)
-                    overlap_tokens += t
-                else:
-                    break
-            
-            current_chunk = overlap_sentences
-            current_tokens = overlap_tokens
-            start_idx += len(chunk_text) - sum(len(s) for s in overlap_sentences)
-        
-        current_chunk.append(sentence)
-        current_tokens += sentence_tokens
-    
-    # add final chunk
-    if current_chunk:
-        chunks.append({
-            'text': '. '.join(current_chunk),
-            'start_index': start_idx,
-            'tokens': current_tokens
-        })
-    
+
+        if last + 1 >= len(units):
+            break
+
+        # start the next chunk with trailing sentences that fit in the overlap,
+        # as long as the next new sentence still fits beside them
+        nxt = last + 1
+        while (nxt - 1 > first
+               and units[last][1] - units[nxt - 1][0] <= overlap
+               and units[last + 1][1] - units[nxt - 1][0] <= chunk_size):
+            nxt -= 1
+        first = nxt
+
     return chunks
 
-# extracts text from pdf files
-# gets text per page and joins it
-def extract_pdf(pdf_bytes: bytes):
+# pages handed to one pdf worker task, ingest splits pdfs into batches of this size
+PDF_BATCH_PAGES = int(os.environ.get("PDF_BATCH_PAGES", "16"))
+
+# number of pages in a pdf, only parses the page tree
+def pdf_page_count(pdf_bytes: bytes) -> int:
+    return len(pypdf.PdfReader(BytesIO(pdf_bytes)).pages)
+
+# extracts (page_number, text) for pages [start, end), page numbers start at 1
+# top level so page ranges can run in a process pool
+# pdf is the file's bytes or a path to it, a path keeps process pool tasks small
+def extract_pdf_pages(pdf_bytes, start: int = 0, end: int = None):
     try:
         # turn pdf into in memory file object
         # mimics open() without a real file
         # lets pdf reader read without the actual file
         # bytesio creates readable stream from which pdfreader reads from = extracts text
-        pdf_file = BytesIO(pdf_bytes)
-        reader = pypdf.PdfReader(pdf_file)
-        
-        text = ""
-        for page in reader.pages:
-            text += page.extract_text() + "\n"
-        
-        return text
+        reader = pypdf.PdfReader(pdf_bytes if isinstance(pdf_bytes, str) else BytesIO(pdf_bytes))
+        end = len(reader.pages) if end is None else min(end, len(reader.pages))
+        return [(i + 1, reader.pages[i].extract_text() or "") for i in range(start, end)]
     except Exception as e:
         print(f"Error extracting PDF text: {e}")
         raise
 
+# yields (page_number, text) in page order, one batch of pages parsed at a time
+# (parallel extraction is ingest's job, it hands page ranges to its process pool)
+def iter_pdf_pages(pdf_bytes: bytes):
+    total = pdf_page_count(pdf_bytes)
+    for s in range(0, total, PDF_BATCH_PAGES):
+        yield from extract_pdf_pages(pdf_bytes, s, min(s + PDF_BATCH_PAGES, total))
+
+# extracts text from pdf files
+# gets text per page and joins it
+def extract_pdf(pdf_bytes: bytes):
+    return "\n".join(text for _, text in iter_pdf_pages(pdf_bytes)) + "\n"
+
+# chunks each page on its own so every chunk carries its page number
+# start_index/end_index are offsets within that page's text
+def chunk_pages(name: str, pages, chunk_size: int = 1000, overlap: int = 150):
+    chunks = []
+    for page_number, text in pages:
+        for c in chunk_text(text, chunk_size=chunk_size, overlap=overlap):
+            c["source"] = name
+            c["page"] = page_number
+            chunks.append(c)
+    return chunks
+
+# extracts and chunks pages [start, end) of one pdf upload (bytes or a path)
+# top level so ingest can spread a single large pdf across a process pool
+def extract_pdf_chunks(name: str, pdf_bytes, start: int, end: int,
+                       chunk_size: int = 1000, overlap: int = 150):
+    return chunk_pages(name, extract_pdf_pages(pdf_bytes, start, end), chunk_size, overlap)
+
+# extracts text from one upload by extension and chunks it
+# tags every chunk with its source name (and page for pdfs)
+# top level so it can run in a process pool during ingest
+def extract_chunks(name: str, content: bytes, chunk_size: int = 1000, overlap: int = 150):
+    if name.endswith(".pdf"):
+        return chunk_pages(name, iter_pdf_pages(content), chunk_size, overlap)
+
+    # split text into chunks with overlap (for context)
+    chunks = chunk_text(extract_txt(content), chunk_size=chunk_size, overlap=overlap)
+    # add source info to each chunk
+    for c in chunks:
+        c["source"] = name
+    return chunks
+
 # decodes utf-8 bytes into a string
 # utf-8 cover (ascii/english/unicode)
 def extract_txt(text_bytes: bytes):
@@ -0,0 +1,138 @@
+# worker pools shared by the lambdas
+# threads for network bound work, processes for cpu bound parsing
+import multiprocessing
+import os
+import queue
+import threading
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+
+# default worker count for cpu bound stages
+# a 3008 mb lambda gets 2 vcpus, larger worker boxes get more
+def cpu_workers() -> int:
+    return max(1, os.cpu_count() or 1)
+
+
+# thread pool for io bound stages (s3 and openai round trips)
+def thread_pool(max_workers: int) -> Executor:
+    return ThreadPoolExecutor(max_workers=max(1, max_workers))
+
+
+# loop of one pipe pool worker process: receives (fn, args, kwargs), sends back
+# (True, result) or (False, exception), stops on none or when the parent goes away
+def _pipe_worker(conn):
+    while True:
+        try:
+            task = conn.recv()
+        except (EOFError, OSError):
+            break
+        if task is None:
+            break
+        fn, args, kwargs = task
+        try:
+            reply = (True, fn(*args, **kwargs))
+        except BaseException as e:
+            reply = (False, e)
+        try:
+            conn.send(reply)
+        except Exception as e:
+            # results and exceptions that don't pickle still answer the task
+            conn.send((False, RuntimeError(f"{type(e).__name__}: {e}")))
+    conn.close()
+
+
+# process pool built from multiprocessing.Process workers, each fed over its own Pipe
+# by a thread in the parent; pipes need no /dev/shm, so it runs on lambda, where
+# ProcessPoolExecutor can't create its queues. a worker that dies fails its task
+# and is replaced. fn, its arguments and its result must pickle
+class PipePool(Executor):
+    def __init__(self, max_workers: int):
+        self._tasks = queue.Queue()
+        self._shutdown = False
+        self._processes = []
+        self._feeders = []
+        for _ in range(max(1, max_workers)):
+            feeder = threading.Thread(target=self._feed, args=self._start(), daemon=True)
+            feeder.start()
+            self._feeders.append(feeder)
+
+    # starts one worker process, returns (its end of the pipe, the process)
+    def _start(self):
+        conn, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=_pipe_worker, args=(child,), daemon=True)
+        process.start()
+        child.close()
+        self._processes.append(process)
+        return conn, process
+
+    # hands queued tasks to one worker, one at a time
+    def _feed(self, conn, process):
+        while True:
+            item = self._tasks.get()
+            if item is None:
+                conn.send(None)
+                conn.close()
+                process.join()
+                return
+            future, fn, args, kwargs = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                conn.send((fn, args, kwargs))
+                ok, value = conn.recv()
+            except (EOFError, OSError) as e:
+                future.set_exception(RuntimeError(f"pipe pool worker exited: {e!r}"))
+                conn.close()
+                process.join()
+                conn, process = self._start()
+                continue
+            except Exception as e:
+                # fn or its arguments don't pickle, the worker never saw the task
+                future.set_exception(e)
+                continue
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+
+    def submit(self, fn, *args, **kwargs):
+        if self._shutdown:
+            raise RuntimeError("cannot schedule new futures after shutdown")
+        future = Future()
+        self._tasks.put((future, fn, args, kwargs))
+        return future
+
+    def shutdown(self, wait: bool = True, *, cancel_futures: bool = False):
+        self._shutdown = True
+        if cancel_futures:
+            while True:
+                try:
+                    item = self._tasks.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not None:
+                    item[0].cancel()
+        for _ in self._feeders:
+            self._tasks.put(None)
+        if wait:
+            for feeder in self._feeders:
+                feeder.join()
+
+
+# process pool for cpu bound stages
+# lambda has no /dev/shm so ProcessPoolExecutor can't create its queues there,
+# in that case workers are fed over pipes instead (PipePool), and threads are
+# the last resort where processes can't be started at all
+def process_pool(max_workers: int = None) -> Executor:
+    max_workers = max_workers or cpu_workers()
+    if max_workers <= 1:
+        return ThreadPoolExecutor(max_workers=1)
+    try:
+        return ProcessPoolExecutor(max_workers=max_workers)
+    except (OSError, NotImplementedError) as e:
+        error = e
+    try:
+        return PipePool(max_workers)
+    except (OSError, NotImplementedError) as e:
+        print(f"process pool unavailable ({error}), using threads: {e}")
+        return ThreadPoolExecutor(max_workers=max_workers)
@@ -0,0 +1,118 @@
+# finds exact and near-duplicate chunks before they are embedded
+# exact: hash of normalized text, near: minhash over word shingles with lsh banding
+import hashlib
+import io
+import os
+import re
+import zlib
+from typing import List, Tuple
+
+import numpy as np
+
+# estimated jaccard similarity at which two chunks count as duplicates
+DEDUPE_THRESHOLD = float(os.environ.get("DEDUPE_THRESHOLD", "0.85"))
+# minhash signature length, split into lsh bands
+NUM_PERM = 64
+BANDS = 16
+# words per shingle
+SHINGLE = 5
+
+_WORD = re.compile(r"\w+")
+# mersenne prime keeps (a * x + b) mod p within uint64 for 32-bit hashes
+_PRIME = np.uint64((1 << 61) - 1)
+_rng = np.random.RandomState(1)
+_A = _rng.randint(1, 1 << 31, size=NUM_PERM).astype(np.uint64)
+_B = _rng.randint(0, 1 << 31, size=NUM_PERM).astype(np.uint64)
+
+
+# lowercased words, ignores whitespace and punctuation differences
+def _words(text: str) -> List[str]:
+    return _WORD.findall(text.lower())
+
+
+# hash of normalized text, equal for exact duplicates
+def exact_key(text: str) -> str:
+    return hashlib.sha1(" ".join(_words(text)).encode("utf-8")).hexdigest()
+
+
+# minhash signature of one text's word shingles
+def minhash(text: str) -> np.ndarray:
+    words = _words(text)
+    if len(words) < SHINGLE:
+        shingles = [" ".join(words)]
+    else:
+        shingles = [" ".join(words[i:i + SHINGLE]) for i in range(len(words) - SHINGLE + 1)]
+    hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in set(shingles)), dtype=np.uint64)
+    # every permutation applied to every shingle hash at once
+    return ((np.outer(_A, hashes) + _B[:, None]) % _PRIME).min(axis=1)
+
+
+# exact keys and minhash signatures of texts, packed as .npz bytes
+# ingest stores one per index segment, so later uploads are deduped against
+# existing rows without reading and hashing their text again
+def pack_signatures(texts: List[str]) -> bytes:
+    keys = np.array([bytearray.fromhex(exact_key(t)) for t in texts], dtype=np.uint8).reshape(-1, 20)
+    sigs = np.stack([minhash(t) for t in texts]) if texts else np.zeros((0, NUM_PERM), dtype=np.uint64)
+    buf = io.BytesIO()
+    np.savez(buf, keys=keys, sigs=sigs)
+    return buf.getvalue()
+
+
+# (exact keys, minhash signatures) from pack_signatures bytes
+def load_signatures(data: bytes) -> Tuple[List[str], np.ndarray]:
+    packed = np.load(io.BytesIO(data))
+    return [bytes(k).hex() for k in packed["keys"]], packed["sigs"]
+
+
+# representative index for every text (itself if it is unique)
+# duplicates always point at the earliest text in their cluster
+# known is (exact keys, minhash signatures) of rows that come before texts, they take
+# the first positions of the result and are never hashed again
+def find_duplicates(texts: List[str], threshold: float = None,
+                    known: Tuple[List[str], np.ndarray] = None) -> List[int]:
+    threshold = DEDUPE_THRESHOLD if threshold is None else threshold
+    known_keys, known_sigs = known if known is not None else ([], None)
+    offset = len(known_keys)
+    keys = list(known_keys) + [exact_key(text) for text in texts]
+    parent = list(range(len(keys)))
+
+    # union-find keeping the smallest index as the root
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    def union(i, j):
+        ri, rj = find(i), find(j)
+        if ri != rj:
+            parent[max(ri, rj)] = min(ri, rj)
+
+    # exact duplicates
+    seen = {}
+    for i, key in enumerate(keys):
+        if key in seen:
+            union(seen[key], i)
+        else:
+            seen[key] = i
+
+    # near duplicates among the remaining distinct texts
+    distinct = sorted(seen.values())
+    if len(distinct) > 1:
+        sigs = np.stack([known_sigs[i] if i < offset else minhash(texts[i - offset]) for i in distinct])
+        rows = NUM_PERM // BANDS
+        for band in range(BANDS):
+            buckets = {}
+            for pos, key in enumerate(map(bytes, sigs[:, band * rows:(band + 1) * rows])):
+                buckets.setdefault(key, []).append(pos)
+            for members in buckets.values():
+                if len(members) < 2:
+                    continue
+                # compare bucket members against the first one, vectorized
+                anchor = members[0]
+                similarity = (sigs[members[1:]] == sigs[anchor]).mean(axis=1)
+                for pos, sim in zip(members[1:], similarity):
+                    if sim >= threshold:
+                        union(distinct[anchor], distinct[pos])
+
+    return [find(i) for i in range(len(keys))]
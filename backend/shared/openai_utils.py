@@ -2,8 +2,21 @@ import boto3
 import json
 import os
 import openai
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Optional, Dict, List
 
+from .cache_utils import get_embedding_cache, text_hash
+from .chunking import count_tokens
+
+# per request limits of the embeddings api (2048 inputs, 300k tokens)
+# token budget stays below the hard cap to leave room for tokenizer drift
+EMBED_BATCH_TOKENS = int(os.environ.get('EMBED_BATCH_TOKENS', '200000'))
+EMBED_BATCH_SIZE = int(os.environ.get('EMBED_BATCH_SIZE', '2048'))
+# number of embedding requests in flight at once
+EMBED_CONCURRENCY = int(os.environ.get('EMBED_CONCURRENCY', '4'))
+# optional shortened embedding size (text-embedding-3 models only)
+EMBED_DIMENSIONS = int(os.environ['EMBED_DIMENSIONS']) if os.environ.get('EMBED_DIMENSIONS') else None
+
 # get openai key from aws secret manager
 # gets the latest val and returns it as a string
 def get_openai_key():
@@ -35,22 +48,103 @@ def get_openai_client():
     # return configured client
     return openai.OpenAI(api_key=api_key)
 
+# groups texts into batches that fit the per request input and token limits
+# counts are known token counts per text (none where unknown), only the rest are encoded
+# returns (start, end) slices so results can be stitched back in order
+def _token_batches(texts: List[str], max_tokens: int, max_items: int,
+                   counts: Optional[List[Optional[int]]] = None):
+    batches = []
+    start = 0
+    tokens = 0
+    for i, text in enumerate(texts):
+        n = counts[i] if counts is not None and counts[i] is not None else count_tokens(text)
+        # close the current batch if this text would overflow it
+        if i > start and (tokens + n > max_tokens or i - start >= max_items):
+            batches.append((start, i))
+            start = i
+            tokens = 0
+        tokens += n
+    if start < len(texts):
+        batches.append((start, len(texts)))
+    return batches
+
 # converts text into fixed size vectors
 # maps text to numeric vectors for similarity search
 # this will run the semnatic search in ingest/querying
-def embed_texts(texts: List[str], model: str = None):
+# large inputs are split into token sized batches sent concurrently
+# identical texts are served from the embedding cache (cache=False skips it)
+# pass a stats dict to collect cache hit/miss counts
+# token_counts, when the caller already has them (chunk_text's "tokens"), spare
+# encoding every text again to size the batches
+def embed_texts(texts: List[str], model: str = None, concurrency: int = None,
+                dimensions: Optional[int] = None, cache=None,
+                stats: Optional[Dict[str, int]] = None,
+                token_counts: Optional[List[Optional[int]]] = None):
     # use default model if none provided
     if model is None:
         model = os.environ.get('EMBED_MODEL', 'text-embedding-3-small')
-    
-    # get openai client
+    if concurrency is None:
+        concurrency = EMBED_CONCURRENCY
+    if dimensions is None:
+        dimensions = EMBED_DIMENSIONS
+    if cache is None:
+        cache = get_embedding_cache()
+    if not texts:
+        return []
+
+    # repeated texts (overlaps, shared notes) only need one vector
+    digests = [text_hash(t) for t in texts]
+    unique = dict(zip(digests, texts))
+    counts = dict(zip(digests, token_counts)) if token_counts is not None else None
+    found, memory_hits, persistent_hits = {}, 0, 0
+    if cache:
+        found, memory_hits, persistent_hits = cache.get_many(model, dimensions, list(unique))
+    missing = [d for d in unique if d not in found]
+    pending = [unique[d] for d in missing]
+
+    if stats is not None:
+        stats['memoryHits'] = stats.get('memoryHits', 0) + memory_hits
+        stats['persistentHits'] = stats.get('persistentHits', 0) + persistent_hits
+        stats['misses'] = stats.get('misses', 0) + len(missing)
+
+    if pending:
+        # only cache misses go to openai
+        embedded = _embed_uncached(
+            pending, model, concurrency, dimensions, [counts[d] for d in missing] if counts else None
+        )
+        fresh = dict(zip(missing, embedded))
+        if cache:
+            cache.put_many(model, dimensions, fresh)
+        found.update(fresh)
+
+    # stitch vectors back in input order
+    return [list(map(float, found[d])) for d in digests]
+
+# embeds texts straight through the api, no cache
+def _embed_uncached(texts: List[str], model: str, concurrency: int, dimensions: Optional[int],
+                    counts: Optional[List[Optional[int]]] = None):
+    # get openai client, shared by every batch
     client = get_openai_client()
+    extra = {'dimensions': dimensions} if dimensions else {}
+
+    # embeds one slice of the input
+    def _embed(batch):
+        start, end = batch
+        # call embedding api
+        response = client.embeddings.create(model=model, input=texts[start:end], **extra)
+        # api returns items with their position in the batch
+        return [item.embedding for item in sorted(response.data, key=lambda d: d.index)]
     
     try:
-        # call embedding api
-        response = client.embeddings.create(model=model, input=texts)
-        # extract and return embeddings list
-        return [item.embedding for item in response.data]
+        batches = _token_batches(texts, EMBED_BATCH_TOKENS, EMBED_BATCH_SIZE, counts)
+        if len(batches) == 1 or concurrency <= 1:
+            results = [_embed(b) for b in batches]
+        else:
+            # map keeps batch order, so results line up with the input
+            with ThreadPoolExecutor(max_workers=min(concurrency, len(batches))) as pool:
+                results = list(pool.map(_embed, batches))
+        # flatten batches into one embeddings list
+        return [emb for batch in results for emb in batch]
     except Exception as e:
         # log error and raise
         print(f"error creating embeddings: {e}")
@@ -76,3 +170,26 @@ def chat(messages: List[Dict[str, str]], model: str = None, **kwargs):
         # log error and raise
         print(f"error in chat: {e}")
         raise
+
+
+# streams a chat completion from gpt
+# yields the reply in pieces as they are generated, joined they equal chat's reply
+def chat_stream(messages: List[Dict[str, str]], model: str = None, **kwargs):
+    # use default model if none provided
+    if model is None:
+        model = os.environ.get('CHAT_MODEL', 'gpt-4o-mini')
+
+    # get openai client
+    client = get_openai_client()
+
+    try:
+        # call chat completion api with server sent events
+        stream = client.chat.completions.create(model=model, messages=messages, stream=True, **kwargs)
+        for event in stream:
+            # the last event carries no choices when usage is requested
+            if event.choices and event.choices[0].delta.content:
+                yield event.choices[0].delta.content
+    except Exception as e:
+        # log error and raise
+        print(f"error in chat stream: {e}")
+        raise
@@ -0,0 +1,43 @@
+# per-session centroids that route cross-session searches to promising sessions
+# ingest keeps a mean vector per index segment and writes one small routing entry
+# per session, query ranks sessions by cosine similarity to the question
+import base64
+from typing import Dict, List, Optional
+
+import numpy as np
+
+
+# compact json-safe encoding of a vector (float16, base64)
+def encode_vector(vector: np.ndarray) -> str:
+    return base64.b64encode(np.asarray(vector, dtype="<f2").tobytes()).decode("ascii")
+
+
+# inverse of encode_vector, as float32
+def decode_vector(data: str) -> np.ndarray:
+    return np.frombuffer(base64.b64decode(data), dtype="<f2").astype("float32")
+
+
+# unit centroid of a session from its segments' mean vectors, weighted by segment size
+# none when a segment has no mean (written before routing existed)
+def session_centroid(segments) -> Optional[np.ndarray]:
+    if not segments or any(not seg.get("centroid") for seg in segments):
+        return None
+    total = sum(decode_vector(seg["centroid"]) * (seg["end"] - seg["start"]) for seg in segments)
+    norm = np.linalg.norm(total)
+    return total / norm if norm else None
+
+
+# session ids ordered by similarity of their centroid to the query, best first
+# sessions without a centroid (empty, built with another model, or not ingested since
+# routing existed) can't be ranked and only fill the slots the ranked ones leave
+def rank_sessions(query_vector: np.ndarray, session_ids: List[str],
+                  centroids: Dict[str, np.ndarray], limit: int = None) -> List[str]:
+    unknown = [sid for sid in session_ids if sid not in centroids]
+    known = [sid for sid in session_ids if sid in centroids]
+    if known:
+        query = np.asarray(query_vector, dtype="float32").ravel()
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        scores = np.stack([centroids[sid] for sid in known]) @ query
+        known = [known[i] for i in np.argsort(-scores, kind="stable")]
+    ranked = known + unknown
+    return ranked[:limit] if limit else ranked
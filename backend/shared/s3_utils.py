@@ -6,12 +6,15 @@ import boto3
 from botocore.config import Config
 import json
 import os
+from functools import lru_cache
 from typing import Any, Optional, Dict
 
 
 # creates s3 client
 # centralizes client creation
 # no need to issue new creds on each call
+# built once per container, boto3 clients are thread safe and keep their connection pool
+@lru_cache(maxsize=1)
 def get_s3_client():
     # initialize boto3 client with region and signature version
     return boto3.client('s3', region_name=os.environ.get('AWS-REGION', 'us-east-1'),
@@ -65,6 +68,95 @@ def download_object(bucket: str, key: str, local_path: str):
         raise
 
 
+# reads an s3 object straight into memory
+# for small/medium objects (uploads, indexes, metadata), no temp file on disk
+def get_object_bytes(bucket: str, key: str) -> bytes:
+    # get s3 client
+    s3_client = get_s3_client()
+
+    try:
+        # read the whole body into a bytes buffer
+        response = s3_client.get_object(Bucket=bucket, Key=key)
+        return response['Body'].read()
+    except Exception as e:
+        # log error and raise
+        print(f"error reading from s3: {e}")
+        raise
+
+
+# reads an s3 object into memory, none when it doesn't exist
+# one get instead of a head followed by a get for optional objects
+def get_object_if_exists(bucket: str, key: str) -> Optional[bytes]:
+    # get s3 client
+    s3_client = get_s3_client()
+
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=key)
+        return response['Body'].read()
+    except s3_client.exceptions.NoSuchKey:
+        return None
+    except Exception as e:
+        # log error and raise
+        print(f"error reading from s3: {e}")
+        raise
+
+
+# returns the streaming body of an s3 object
+# file-like, so parsers such as json.load can consume it directly
+def get_object_stream(bucket: str, key: str):
+    # get s3 client
+    s3_client = get_s3_client()
+
+    try:
+        return s3_client.get_object(Bucket=bucket, Key=key)['Body']
+    except Exception as e:
+        # log error and raise
+        print(f"error reading from s3: {e}")
+        raise
+
+
+# reads bytes [start, end) of an s3 object with a ranged get
+# lets callers pull a few rows out of a large file without downloading it
+def get_object_range(bucket: str, key: str, start: int, end: int) -> bytes:
+    # get s3 client
+    s3_client = get_s3_client()
+
+    try:
+        response = s3_client.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end - 1}")
+        return response['Body'].read()
+    except Exception as e:
+        # log error and raise
+        print(f"error reading from s3: {e}")
+        raise
+
+
+# yields an s3 object in fixed size chunks
+# keeps memory flat when copying large objects to another sink
+def iter_object(bucket: str, key: str, chunk_size: int = 1024 * 1024):
+    body = get_object_stream(bucket, key)
+    try:
+        for chunk in body.iter_chunks(chunk_size=chunk_size):
+            yield chunk
+    finally:
+        body.close()
+
+
+# upload in-memory bytes to s3
+# for writing serialized indexes and metadata without temp files
+def put_bytes(bucket: str, key: str, data: bytes, content_type: str = 'application/octet-stream'):
+    # get s3 client
+    s3_client = get_s3_client()
+
+    try:
+        s3_client.put_object(Bucket=bucket, Key=key, Body=data, ContentType=content_type)
+        # return object key
+        return key
+    except Exception as e:
+        # log error and raise
+        print(f"error uploading to s3: {e}")
+        raise
+
+
 # upload local file to s3
 # for writing generated indexes (FAISS)
 def upload_file(local_path: str, bucket: str, key: str):
@@ -102,6 +194,50 @@ def list_objects(bucket: str, prefix: str):
         raise
 
 
+# list objects under a prefix with their etag, size and modified time
+# pages through results so large upload sets are fully listed
+# for ingest to detect new, changed and deleted uploads
+def list_object_details(bucket: str, prefix: str):
+    # get s3 client
+    s3_client = get_s3_client()
+
+    try:
+        # collect details across all result pages
+        details = []
+        paginator = s3_client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                details.append({
+                    'key': obj['Key'],
+                    'etag': obj.get('ETag'),
+                    'size': obj.get('Size', 0),
+                    'lastModified': obj['LastModified'].isoformat() if obj.get('LastModified') else None,
+                })
+        # return list of object details
+        return details
+    except Exception as e:
+        # log error and raise
+        print(f"error listing s3 objects: {e}")
+        raise
+
+
+# deletes an object from s3
+# for ingest to drop index artifacts once every upload is gone
+def delete_object(bucket: str, key: str):
+    # get s3 client
+    s3_client = get_s3_client()
+
+    try:
+        # delete is a no-op if the key does not exist
+        s3_client.delete_object(Bucket=bucket, Key=key)
+        # return deleted key
+        return key
+    except Exception as e:
+        # log error and raise
+        print(f"error deleting s3 object: {e}")
+        raise
+
+
 # checks if object in s3 without downloading
 # to verify and check for indexes
 def if_object(bucket: str, key: str):
@@ -556,19 +556,51 @@ export default function HomePage() {
         );
 
         // trigger ingestion (vector embedding)
-        const ingestRes = await fetch(`${API_BASE_URL}/ingest`, {
-          method: "POST",
-          headers: { "Content-Type": "application/json" },
-          body: JSON.stringify({ sessionId: session.sessionId }),
-        });
+        // large uploads ingest over several invocations: 202 means a checkpointed
+        // job is still running and 504 means the gateway gave up waiting on it,
+        // so keep calling until the job reports its final stats; only a 200 means
+        // the index is complete
+        let ingestJson: {
+          stats?: { chunks?: number };
+          job?: { documents?: number; embedded?: number };
+        } = {};
+        let ingestDone = false;
+        for (let attempt = 0; attempt < 120; attempt += 1) {
+          const ingestRes = await fetch(`${API_BASE_URL}/ingest`, {
+            method: "POST",
+            headers: { "Content-Type": "application/json" },
+            body: JSON.stringify({ sessionId: session.sessionId }),
+          });
 
-        if (!ingestRes.ok) {
-          throw new Error(`Ingest failed: ${ingestRes.statusText}`);
-        }
+          if (ingestRes.status === 504) {
+            await new Promise((resolve) => setTimeout(resolve, 5000));
+            continue;
+          }
+          if (!ingestRes.ok) {
+            throw new Error(`Ingest failed: ${ingestRes.statusText}`);
+          }
 
-        const ingestJson = (await ingestRes.json()) as {
-          stats?: { chunks?: number };
-        };
+          ingestJson = (await ingestRes.json()) as typeof ingestJson;
+          if (ingestRes.status !== 202) {
+            ingestDone = true;
+            break;
+          }
+          setStatus(
+            `Ingesting ${sessionLabel}: ${ingestJson.job?.embedded ?? 0}/${
+              ingestJson.job?.documents ?? 0
+            } documents embedded...`
+          );
+          await new Promise((resolve) => setTimeout(resolve, 2000));
+        }
+        if (!ingestDone) {
+          throw new Error(
+            `Ingest for ${sessionLabel} is still running (${
+              ingestJson.job?.embedded ?? 0
+            }/${
+              ingestJson.job?.documents ?? 0
+            } documents embedded). Submit again to keep waiting before asking questions.`
+          );
+        }
 
         const chunkCount = ingestJson.stats?.chunks ?? 0;
         setStatus(
@@ -0,0 +1,431 @@
+# caching helpers shared by the lambdas
+# bounded in-process lru, a byte-bounded disk cache, a content-addressed embedding cache
+# and a per-session answer cache
+import hashlib
+import json
+import os
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+import numpy as np
+
+from .routing_utils import decode_vector, encode_vector
+from .s3_utils import get_s3_client
+
+
+# byte size of a cached value, used for the byte bound
+def _sizeof(value: Any) -> int:
+    if hasattr(value, "nbytes"):
+        return int(value.nbytes)
+    if isinstance(value, (bytes, bytearray, str)):
+        return len(value)
+    return 64
+
+
+# thread safe lru bounded by entry count and total bytes
+# survives across invocations in a warm container
+class LRUCache:
+    def __init__(self, max_entries: int = 10000, max_bytes: int = 64 * 1024 * 1024,
+                 sizeof: Callable[[Any], int] = _sizeof):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Any, Any]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    # returns cached value (and marks it recently used) or default
+    def get(self, key, default=None):
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return self._data[key]
+
+    # stores a value, evicting least recently used entries past the bounds
+    def put(self, key, value):
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self.bytes -= self.sizeof(self._data.pop(key))
+            self._data[key] = value
+            self.bytes += size
+            while self._data and (len(self._data) > self.max_entries or self.bytes > self.max_bytes):
+                _, evicted = self._data.popitem(last=False)
+                self.bytes -= self.sizeof(evicted)
+
+    # drops every entry matching the predicate
+    def discard(self, predicate: Callable[[Any], bool]):
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                self.bytes -= self.sizeof(self._data.pop(key))
+
+    # hit/miss counters for logging
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+# files in a local directory (lambda's /tmp) bounded by total bytes
+# least recently used files (by mtime, touched on every hit) are evicted first
+# survives in-memory eviction for as long as the container lives
+class DiskCache:
+    def __init__(self, directory: str, max_bytes: int = 400 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    # local path for a cache entry name (e.g. session + etag)
+    def path(self, name: str) -> str:
+        return os.path.join(self.directory, re.sub(r"[^\w.-]", "_", name))
+
+    # path of a cached file (and marks it recently used) or none
+    def get(self, name: str) -> Optional[str]:
+        path = self.path(name)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    # stores bytes or an iterable of byte chunks, returns the local path
+    def put(self, name: str, data) -> str:
+        path = self.path(name)
+        # write then rename so readers never see partial files
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            if isinstance(data, (bytes, bytearray, memoryview)):
+                f.write(data)
+            else:
+                for chunk in data:
+                    f.write(chunk)
+        os.replace(tmp, path)
+        self.evict(keep=(path,))
+        return path
+
+    # removes entries whose name starts with prefix (e.g. older etags of a session)
+    def discard(self, prefix: str, keep: Iterable[str] = ()):
+        start = self.path(prefix)
+        for entry in os.scandir(self.directory):
+            if entry.path.startswith(start) and entry.path not in keep:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+    # deletes least recently used files until the directory fits max_bytes
+    def evict(self, keep: Iterable[str] = ()):
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                if path in keep:
+                    continue
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    # hit/miss counters and current size for logging
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "bytes": sum(e.stat().st_size for e in os.scandir(self.directory)),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+# creates/caches the index disk cache from env vars
+# INDEX_CACHE_DIR (default /tmp/index-cache), INDEX_CACHE_MB bounds its size
+# (lambda's /tmp is 512 mb unless ephemeral storage is raised)
+@lru_cache(maxsize=1)
+def get_index_disk_cache() -> DiskCache:
+    return DiskCache(
+        os.environ.get("INDEX_CACHE_DIR", "/tmp/index-cache"),
+        max_bytes=int(os.environ.get("INDEX_CACHE_MB", "400")) * 1024 * 1024,
+    )
+
+
+# sha256 of chunk text, the content address of an embedding
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+# canonical form of a user question for cache keys: unicode compatibility form,
+# case folded, whitespace collapsed, so retries and retyped questions match
+def normalize_text(text: str) -> str:
+    return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+
+# embedding cache keyed by (model, dimensions, sha256 of text)
+# memory tier is an lru of float32 arrays
+# persistent tier is s3 under the namespace prefix or a local directory
+class EmbeddingCache:
+    def __init__(self, memory: LRUCache, bucket: Optional[str] = None,
+                 prefix: str = "default/cache/embeddings", directory: Optional[str] = None,
+                 concurrency: int = 16):
+        self.memory = memory
+        self.bucket = bucket
+        self.prefix = prefix.rstrip("/")
+        self.directory = directory
+        self.concurrency = concurrency
+        # persistent tier writes run in the background until flush
+        self._writer: Optional[ThreadPoolExecutor] = None
+        self._pending = []
+        self._lock = threading.Lock()
+
+    # relative location of an entry in the persistent tier
+    def _path(self, model: str, dimensions: Optional[int], digest: str) -> str:
+        return f"{model}/{dimensions or 'native'}/{digest[:2]}/{digest}.f32"
+
+    # reads one entry from the persistent tier, none on miss
+    def _read(self, path: str) -> Optional[np.ndarray]:
+        try:
+            if self.directory:
+                with open(os.path.join(self.directory, path), "rb") as f:
+                    data = f.read()
+            elif self.bucket:
+                s3 = get_s3_client()
+                try:
+                    data = s3.get_object(Bucket=self.bucket, Key=f"{self.prefix}/{path}")["Body"].read()
+                except s3.exceptions.NoSuchKey:
+                    return None
+            else:
+                return None
+        except FileNotFoundError:
+            return None
+        return np.frombuffer(data, dtype="float32")
+
+    # writes one entry to the persistent tier
+    def _write(self, path: str, vector: np.ndarray):
+        data = np.asarray(vector, dtype="float32").tobytes()
+        if self.directory:
+            full = os.path.join(self.directory, path)
+            os.makedirs(os.path.dirname(full), exist_ok=True)
+            # write then rename so readers never see partial files
+            tmp = f"{full}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, full)
+        elif self.bucket:
+            get_s3_client().put_object(Bucket=self.bucket, Key=f"{self.prefix}/{path}", Body=data)
+
+    # runs fn over items, concurrently when there is a remote tier
+    def _map(self, fn, items):
+        if len(items) > 1 and self.concurrency > 1:
+            with ThreadPoolExecutor(max_workers=min(self.concurrency, len(items))) as pool:
+                return list(pool.map(fn, items))
+        return [fn(item) for item in items]
+
+    # looks up hashes in both tiers
+    # returns {digest: vector} for hits and per tier hit counts
+    def get_many(self, model: str, dimensions: Optional[int], digests: List[str]):
+        found: Dict[str, np.ndarray] = {}
+        remote = []
+        for digest in digests:
+            vector = self.memory.get((model, dimensions, digest))
+            if vector is None:
+                remote.append(digest)
+            else:
+                found[digest] = vector
+        memory_hits = len(found)
+
+        if remote and (self.bucket or self.directory):
+            vectors = self._map(lambda d: self._read(self._path(model, dimensions, d)), remote)
+            for digest, vector in zip(remote, vectors):
+                if vector is not None:
+                    found[digest] = vector
+                    # promote to the memory tier
+                    self.memory.put((model, dimensions, digest), vector)
+        return found, memory_hits, len(found) - memory_hits
+
+    # stores freshly embedded vectors in both tiers
+    # the memory tier is filled right away, persistent writes are queued on a background
+    # pool so the caller goes on with its next batch; flush waits for them
+    def put_many(self, model: str, dimensions: Optional[int], entries: Dict[str, np.ndarray]):
+        for digest, vector in entries.items():
+            self.memory.put((model, dimensions, digest), np.asarray(vector, dtype="float32"))
+        if not (self.bucket or self.directory) or not entries:
+            return
+        with self._lock:
+            if self._writer is None:
+                self._writer = ThreadPoolExecutor(max_workers=max(1, self.concurrency))
+            self._pending.extend(
+                self._writer.submit(self._write, self._path(model, dimensions, digest), vector)
+                for digest, vector in entries.items()
+            )
+
+    # waits for queued persistent writes, call before the process can be frozen or exit
+    # returns the number of entries that failed to write
+    def flush(self) -> int:
+        with self._lock:
+            pending, self._pending = self._pending, []
+        errors = [e for e in (f.exception() for f in pending) if e is not None]
+        if errors:
+            # a failed cache write should never fail the ingest
+            print(f"error writing embedding cache ({len(errors)} entries): {errors[0]}")
+        return len(errors)
+
+
+# creates/caches the default embedding cache from env vars
+# EMBED_CACHE=off disables it, EMBED_CACHE_DIR selects the local tier,
+# otherwise entries live in BUCKET under {NAMESPACE}/cache/embeddings
+@lru_cache(maxsize=1)
+def get_embedding_cache() -> Optional[EmbeddingCache]:
+    if os.environ.get("EMBED_CACHE", "on").lower() in ("off", "0", "false"):
+        return None
+    memory = LRUCache(
+        max_entries=int(os.environ.get("EMBED_CACHE_ENTRIES", "20000")),
+        max_bytes=int(os.environ.get("EMBED_CACHE_MB", "128")) * 1024 * 1024,
+    )
+    namespace = os.environ.get("NAMESPACE", "default")
+    return EmbeddingCache(
+        memory,
+        bucket=os.environ.get("EMBED_CACHE_BUCKET") or os.environ.get("BUCKET"),
+        prefix=f"{namespace}/cache/embeddings",
+        directory=os.environ.get("EMBED_CACHE_DIR"),
+        concurrency=int(os.environ.get("EMBED_CACHE_CONCURRENCY", "16")),
+    )
+
+
+# answers of earlier questions, persisted per session so they outlive the container
+# an entry is keyed by the caller (index version plus retrieved chunk ids) and holds a
+# few (question, embedding, answer) triples; a question hits when its normalized text
+# is the same or its embedding is at least `similarity` cosine to a stored one
+# stored as json in s3 at {prefix}/{session id}/cache/answers/{key}.json
+class AnswerCache:
+    def __init__(self, memory: LRUCache, bucket: Optional[str] = None,
+                 prefix: str = "default/sessions", similarity: float = 0.95, per_key: int = 8):
+        self.memory = memory
+        self.bucket = bucket
+        self.prefix = prefix.rstrip("/")
+        self.similarity = similarity
+        self.per_key = per_key
+
+    def _key(self, session_id: str, key: str) -> str:
+        return f"{self.prefix}/{session_id}/cache/answers/{key}.json"
+
+    # stored triples of one key, memory first, then s3 (an empty list on miss)
+    def _entries(self, session_id: str, key: str) -> List[Dict[str, Any]]:
+        entries = self.memory.get((session_id, key))
+        if entries is not None:
+            return entries
+        entries = []
+        if self.bucket:
+            s3 = get_s3_client()
+            try:
+                data = json.loads(s3.get_object(Bucket=self.bucket, Key=self._key(session_id, key))["Body"].read())
+                entries = [
+                    dict(e, embedding=decode_vector(e["embedding"]) if e.get("embedding") else None)
+                    for e in data.get("entries", [])
+                ]
+            except s3.exceptions.NoSuchKey:
+                pass
+            except Exception as e:
+                print(f"error reading answer cache: {e}")
+        # misses are remembered too, so a new key costs one s3 read per container
+        self.memory.put((session_id, key), entries)
+        return entries
+
+    # cached answer for a question, none on miss
+    # the same normalized question wins, otherwise the most similar stored question
+    # at or above the similarity threshold
+    def get(self, session_id: str, key: str, question: str, embedding: Optional[np.ndarray] = None) -> Optional[str]:
+        question = normalize_text(question)
+        best, best_similarity = None, self.similarity
+        for entry in self._entries(session_id, key):
+            if entry["question"] == question:
+                return entry["answer"]
+            if embedding is None or entry["embedding"] is None:
+                continue
+            similarity = _cosine(embedding, entry["embedding"])
+            if similarity >= best_similarity:
+                best, best_similarity = entry["answer"], similarity
+        return best
+
+    # stores an answer, the oldest triple of the key makes room past per_key
+    def put(self, session_id: str, key: str, question: str, answer: str, embedding: Optional[np.ndarray] = None):
+        entry = {"question": normalize_text(question), "answer": answer, "embedding": embedding}
+        entries = ([e for e in self._entries(session_id, key) if e["question"] != entry["question"]] + [entry])[-self.per_key:]
+        self.memory.put((session_id, key), entries)
+        if not self.bucket:
+            return
+        try:
+            data = {"entries": [
+                dict(e, embedding=encode_vector(e["embedding"]) if e["embedding"] is not None else None) for e in entries
+            ]}
+            get_s3_client().put_object(
+                Bucket=self.bucket, Key=self._key(session_id, key), Body=json.dumps(data).encode("utf-8"),
+                ContentType="application/json",
+            )
+        except Exception as e:
+            # a failed cache write should never fail the query
+            print(f"error writing answer cache: {e}")
+
+
+# cosine similarity of two vectors
+def _cosine(a: np.ndarray, b: np.ndarray) -> float:
+    return float(np.dot(a, b) / max(float(np.linalg.norm(a) * np.linalg.norm(b)), 1e-12))
+
+
+# byte size of an answer cache entry list
+def _answers_sizeof(entries: List[Dict[str, Any]]) -> int:
+    return 64 + sum(len(e["answer"]) + len(e["question"]) + _sizeof(e["embedding"]) for e in entries)
+
+
+# creates/caches the default answer cache from env vars
+# ANSWER_CACHE=off disables it, ANSWER_CACHE_SIMILARITY is the cosine a paraphrase needs
+# entries live in BUCKET under {NAMESPACE}/sessions/{session id}/cache/answers
+@lru_cache(maxsize=1)
+def get_answer_cache() -> Optional[AnswerCache]:
+    if os.environ.get("ANSWER_CACHE", "on").lower() in ("off", "0", "false"):
+        return None
+    memory = LRUCache(
+        max_entries=int(os.environ.get("ANSWER_CACHE_ENTRIES", "2000")),
+        max_bytes=int(os.environ.get("ANSWER_CACHE_MB", "32")) * 1024 * 1024,
+        sizeof=_answers_sizeof,
+    )
+    namespace = os.environ.get("NAMESPACE", "default")
+    return AnswerCache(
+        memory,
+        bucket=os.environ.get("BUCKET"),
+        prefix=f"{namespace}/sessions",
+        similarity=float(os.environ.get("ANSWER_CACHE_SIMILARITY", "0.95")),
+        per_key=int(os.environ.get("ANSWER_CACHE_PER_KEY", "8")),
+    )
@@ -1,47 +1,395 @@
 # efficient approx nearest neighbour search with indexes (cosine similarity)
 # build and search vector indexes for fast semantic search
 import faiss
+import heapq
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Tuple, Dict, Any
 import json
 import os
+import threading
+
+from .metadata_store import ChunkMetadata, is_packed_metadata
+
+# index family selection
+# auto picks exact flat search while it fits the latency budget, ivf beyond that
+# flat / ivf / hnsw force one family
+INDEX_KIND = os.environ.get("INDEX_KIND", "auto").lower()
+# flat search is always used up to this many vectors
+INDEX_FLAT_MAX = int(os.environ.get("INDEX_FLAT_MAX", "20000"))
+# target single-query search time for auto selection
+INDEX_LATENCY_BUDGET_MS = float(os.environ.get("INDEX_LATENCY_BUDGET_MS", "20"))
+# flat scan throughput used to estimate search time (vector dims per ms, one lambda vcpu)
+INDEX_FLAT_DIMS_PER_MS = float(os.environ.get("INDEX_FLAT_DIMS_PER_MS", "4000000"))
+# default search parameters, overridable per request in search_index
+INDEX_NPROBE = int(os.environ.get("INDEX_NPROBE", "16"))
+INDEX_EF_SEARCH = int(os.environ.get("INDEX_EF_SEARCH", "64"))
+# hnsw graph degree and build effort
+INDEX_HNSW_M = int(os.environ.get("INDEX_HNSW_M", "32"))
+INDEX_EF_CONSTRUCTION = int(os.environ.get("INDEX_EF_CONSTRUCTION", "80"))
+# vector storage: none (float32), sq8 (1 byte/dim), fp16 (2 bytes/dim) or pq
+INDEX_QUANTIZATION = os.environ.get("INDEX_QUANTIZATION", "none").lower()
+# pq sub-quantizers (bytes per vector), 0 = dimension / 16
+INDEX_PQ_M = int(os.environ.get("INDEX_PQ_M", "0"))
+# pq trains 256 centroids per sub-quantizer and needs ~39 points for each
+PQ_MIN_TRAIN = 256 * 39
+# filtered searches that leave at most this many vectors run exactly over them;
+# ivf and hnsw lose recall when most of what they visit is filtered out
+INDEX_FILTER_EXACT_MAX = int(os.environ.get("INDEX_FILTER_EXACT_MAX", "2048"))
+
+# guards building ivf direct maps, a loaded index is searched from several threads
+_direct_map_lock = threading.Lock()
+
+# picks an index family for n vectors of the given dimension
+def choose_index_kind(n: int, dimension: int, latency_budget_ms: float = None) -> str:
+    if INDEX_KIND in ("flat", "ivf", "hnsw"):
+        return INDEX_KIND
+    budget = INDEX_LATENCY_BUDGET_MS if latency_budget_ms is None else latency_budget_ms
+    if n <= INDEX_FLAT_MAX or n * dimension / INDEX_FLAT_DIMS_PER_MS <= budget:
+        return "flat"
+    # ivf over hnsw: supports removals, trains in seconds and adds no graph memory
+    return "ivf"
+
+# ivf list count, about 4 * sqrt(n) with enough training points per centroid
+def _nlist(n: int) -> int:
+    return max(1, min(int(4 * np.sqrt(max(n, 1))), n // 39))
+
+# family of an existing index
+def index_kind(index: faiss.Index) -> str:
+    if isinstance(index, faiss.IndexHNSW):
+        return "hnsw"
+    try:
+        faiss.extract_index_ivf(index)
+        return "ivf"
+    except RuntimeError:
+        return "flat"
+
+# pq sub-quantizer count, must divide the dimension
+def _pq_m(dimension: int) -> int:
+    m = INDEX_PQ_M or max(1, dimension // 16)
+    while dimension % m:
+        m -= 1
+    return m
+
+# faiss factory suffix for the vector storage
+# pq falls back to sq8 when there are too few vectors to train it
+def _storage(dimension: int, n: int, quantization: str) -> str:
+    if quantization == "pq" and n < PQ_MIN_TRAIN:
+        quantization = "sq8"
+    return {
+        "sq8": "SQ8",
+        "fp16": "SQfp16",
+        "pq": f"PQ{_pq_m(dimension)}",
+    }.get(quantization, "Flat")
+
+# vector storage of an existing index: none, sq8, fp16 or pq
+def index_quantization(index: faiss.Index) -> str:
+    if index_kind(index) == "ivf":
+        index = faiss.downcast_index(faiss.extract_index_ivf(index))
+    elif index_kind(index) == "hnsw":
+        index = faiss.downcast_index(index.storage)
+    if isinstance(index, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+        return "fp16" if index.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else "sq8"
+    if isinstance(index, (faiss.IndexPQ, faiss.IndexIVFPQ)):
+        return "pq"
+    return "none"
+
+# bytes of one stored vector code (sq8, pq and fp16 codes are smaller than d * 4)
+def index_code_size(index: faiss.Index) -> int:
+    if index_kind(index) == "ivf":
+        return faiss.extract_index_ivf(index).code_size
+    if index_kind(index) == "hnsw":
+        return faiss.downcast_index(index.storage).code_size
+    return index.code_size
+
+# family, storage and shape of an index, recorded in stats.json
+def index_format(index: faiss.Index) -> Dict[str, Any]:
+    kind = index_kind(index)
+    info = {
+        "kind": kind,
+        "quantization": index_quantization(index),
+        "dimension": index.d,
+        "vectors": index.ntotal,
+        "codeSize": index_code_size(index),
+    }
+    if kind == "ivf":
+        info["nlist"] = faiss.extract_index_ivf(index).nlist
+    return info
 
 # creates faiss index
-# exact search via inner product on normalized vectors
-def create_index(dimension: int):
-    # indexflatip = inner product on normalized vectors (cosine similarity)
-    index = faiss.IndexFlatIP(dimension)
+# inner product on normalized vectors (cosine similarity)
+# n is the expected vector count, used to pick flat / ivf / hnsw
+# quantization selects the vector storage (defaults to INDEX_QUANTIZATION)
+def create_index(dimension: int, n: int = 0, kind: str = None, quantization: str = None):
+    kind = kind or choose_index_kind(n, dimension)
+    storage = _storage(dimension, n, quantization or INDEX_QUANTIZATION)
+    if kind == "ivf":
+        # centroids are trained on the first add_vectors call
+        index = faiss.index_factory(dimension, f"IVF{_nlist(n)},{storage}", faiss.METRIC_INNER_PRODUCT)
+        index.nprobe = INDEX_NPROBE
+    elif kind == "hnsw":
+        index = faiss.index_factory(dimension, f"HNSW{INDEX_HNSW_M},{storage}", faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = INDEX_EF_CONSTRUCTION
+        index.hnsw.efSearch = INDEX_EF_SEARCH
+    elif storage != "Flat":
+        # quantized codes, still scanned exhaustively
+        index = faiss.index_factory(dimension, storage, faiss.METRIC_INNER_PRODUCT)
+    else:
+        # indexflatip = exact search
+        index = faiss.IndexFlatIP(dimension)
     return index
 
 # add vectors to faiss index
 # normalizes vectors and adds them to the index for cosine similarity
+# untrained (ivf) indexes are trained on the first batch
 def add_vectors(index: faiss.Index, vectors: np.ndarray):
-    # faiss needs contiguous data
-    if not vectors.flags['C_CONTIGUOUS']:
-        vectors = np.ascontiguousarray(vectors)
-    
+    # faiss needs contiguous float32 data
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+
     # normalize for cosine similarity
     faiss.normalize_L2(vectors)
+    if not index.is_trained:
+        index.train(vectors)
     index.add(vectors)
 
-# find the nearest k vectors to a query
-def search_index(index: faiss.Index, query_vector: np.ndarray, k: int = 5):
-    # normalize query vector
-    query_vector = query_vector.reshape(1, -1)
+# builds the id -> list map ivf needs to find a stored vector, once per loaded index
+# checked under the lock too: faiss sets the map type before it fills the map
+def ensure_direct_map(index: faiss.Index):
+    if index_kind(index) != "ivf":
+        return
+    ivf = faiss.extract_index_ivf(index)
+    with _direct_map_lock:
+        if ivf.direct_map.type == faiss.DirectMap.NoMap:
+            ivf.make_direct_map()
+
+# all vectors currently stored in the index, in id order
+def reconstruct_all(index: faiss.Index) -> np.ndarray:
+    if index.ntotal == 0:
+        return np.zeros((0, index.d), dtype="float32")
+    ensure_direct_map(index)
+    return index.reconstruct_n(0, index.ntotal)
+
+# keeps only the given ids of a flat (flat, sq, pq, fp16) index, the others are removed
+# without decoding any stored code; kept vectors are renumbered in id order
+def keep_ids(index: faiss.Index, ids) -> faiss.Index:
+    drop = np.setdiff1d(np.arange(index.ntotal, dtype="int64"), np.asarray(ids, dtype="int64"))
+    if len(drop):
+        index.remove_ids(faiss.IDSelectorBatch(drop))
+    return index
+
+# stored vectors of the given ids, decoded from the index's own (possibly lossy) codes
+def reconstruct_ids(index: faiss.Index, ids) -> np.ndarray:
+    ids = np.asarray(ids, dtype="int64")
+    if len(ids) == 0:
+        return np.zeros((0, index.d), dtype="float32")
+    ensure_direct_map(index)
+    return index.reconstruct_batch(ids)
+
+# maximal marginal relevance: orders up to k candidates, trading relevance for novelty
+# relevance[i] scores candidate i against the query, vectors[i] is its unit vector
+# lambda_mult 1 keeps relevance order, lower values push near-duplicates further down
+# returns candidate positions in selection order
+def mmr(relevance: np.ndarray, vectors: np.ndarray, k: int, lambda_mult: float = 0.7) -> np.ndarray:
+    relevance = np.asarray(relevance, dtype="float32")
+    n = min(k, len(relevance))
+    if n == 0:
+        return np.zeros(0, dtype="int64")
+    # all pairwise similarities at once, a 100 x 100 matrix for 100 candidates
+    sim = vectors @ vectors.T
+    selected = np.empty(n, dtype="int64")
+    chosen = np.zeros(len(relevance), dtype=bool)
+    selected[0] = int(np.argmax(relevance))
+    chosen[selected[0]] = True
+    # highest similarity of every candidate to anything selected so far
+    redundancy = sim[selected[0]].copy()
+    for step in range(1, n):
+        score = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        score[chosen] = -np.inf
+        selected[step] = int(np.argmax(score))
+        chosen[selected[step]] = True
+        np.maximum(redundancy, sim[selected[step]], out=redundancy)
+    return selected
+
+# re-ranks candidate ids by exact inner product with full precision vectors
+# vectors[i] belongs to ids[i], ids of -1 (no result) are dropped
+def rescore(query_vector: np.ndarray, ids: np.ndarray, vectors: np.ndarray, k: int):
+    query_vector = np.array(query_vector, dtype="float32").reshape(1, -1)
     faiss.normalize_L2(query_vector)
-    
-    distances, indices = index.search(query_vector, k)
-    
+    ids = np.asarray(ids)
+    valid = ids >= 0
+    ids, vectors = ids[valid], np.asarray(vectors, dtype="float32")[valid]
+    scores = vectors @ query_vector[0]
+    order = np.argsort(-scores)[:k]
+    return scores[order], ids[order]
+
+# find the nearest k vectors to a query
+# nprobe (ivf) and ef_search (hnsw) trade recall for speed per request
+# exclude lists ids (e.g. tombstoned vectors) that must not be returned,
+# allow is a boolean mask of the ids that may be (e.g. ChunkMetadata.select)
+def search_index(index: faiss.Index, query_vector: np.ndarray, k: int = 5,
+                 nprobe: int = None, ef_search: int = None, exclude: np.ndarray = None,
+                 allow: np.ndarray = None):
+    distances, indices = search_index_batch(
+        index, np.reshape(query_vector, (1, -1)), k, nprobe, ef_search, exclude, allow
+    )
     return distances[0], indices[0]
 
+# nearest k vectors for every row of a query matrix in one index.search call
+# allow, when given, is a boolean mask over ids (e.g. from metadata filters) and
+# exclude lists ids to skip; both are applied inside the search
+# returns (distances, indices), one row per query
+def search_index_batch(index: faiss.Index, query_vectors: np.ndarray, k: int = 5,
+                       nprobe: int = None, ef_search: int = None, exclude: np.ndarray = None,
+                       allow: np.ndarray = None):
+    # normalize query vectors
+    query_vectors = np.array(query_vectors, dtype="float32").reshape(-1, index.d)
+    faiss.normalize_L2(query_vectors)
+    kind = index_kind(index)
+
+    # selector objects must stay referenced until the search returns
+    bits = batch = sel = None
+    if allow is not None:
+        allow = np.array(allow, dtype=bool)
+        if exclude is not None and len(exclude):
+            allow[exclude] = False
+        allowed = int(allow.sum())
+        # few survivors: exact scores over just those, fast and with full recall
+        if kind != "flat" and allowed <= INDEX_FILTER_EXACT_MAX:
+            return _search_subset(index, query_vectors, k, np.flatnonzero(allow))
+        # visit more lists / graph nodes the more is filtered out, so k allowed hits are still found
+        share = allowed / max(1, index.ntotal)
+        if kind == "ivf":
+            nprobe = min(faiss.extract_index_ivf(index).nlist, int((nprobe or faiss.extract_index_ivf(index).nprobe) / share))
+        elif kind == "hnsw":
+            ef_search = min(1024, int((ef_search or index.hnsw.efSearch) / share))
+        bits = np.packbits(allow, bitorder="little")
+        sel = faiss.IDSelectorBitmap(bits)
+    elif exclude is not None and len(exclude):
+        batch = faiss.IDSelectorBatch(np.asarray(exclude, dtype="int64"))
+        sel = faiss.IDSelectorNot(batch)
+
+    params = None
+    if kind == "ivf" and (nprobe or sel):
+        params = faiss.SearchParametersIVF(sel=sel, nprobe=int(nprobe or faiss.extract_index_ivf(index).nprobe))
+    elif kind == "hnsw" and (ef_search or sel):
+        params = faiss.SearchParametersHNSW(sel=sel, efSearch=int(ef_search or index.hnsw.efSearch))
+    elif sel is not None:
+        params = faiss.SearchParameters(sel=sel)
+
+    try:
+        return index.search(query_vectors, k, params=params)
+    except RuntimeError:
+        if sel is None:
+            raise
+    # some storages (flat pq) can't take a selector
+    if allow is not None:
+        return _search_subset(index, query_vectors, k, np.flatnonzero(allow))
+    # over-fetch and filter instead
+    distances, indices = index.search(query_vectors, min(index.ntotal, k + len(exclude)))
+    out_d = np.full((len(query_vectors), k), -np.inf, dtype="float32")
+    out_i = np.full((len(query_vectors), k), -1, dtype="int64")
+    for row in range(len(query_vectors)):
+        keep = ~np.isin(indices[row], exclude)
+        found = indices[row][keep][:k]
+        out_d[row, :len(found)], out_i[row, :len(found)] = distances[row][keep][:k], found
+    return out_d, out_i
+
+# exact top k of normalized queries among the given ids, scored on their stored vectors
+def _search_subset(index: faiss.Index, query_vectors: np.ndarray, k: int, ids: np.ndarray):
+    out_d = np.full((len(query_vectors), k), -np.inf, dtype="float32")
+    out_i = np.full((len(query_vectors), k), -1, dtype="int64")
+    if len(ids) == 0:
+        return out_d, out_i
+    scores = query_vectors @ reconstruct_ids(index, ids).T
+    top = np.argsort(-scores, axis=1)[:, :k]
+    out_d[:, :top.shape[1]] = np.take_along_axis(scores, top, axis=1)
+    out_i[:, :top.shape[1]] = ids[top]
+    return out_d, out_i
+
+# local ids of [start, end) global id ranges that fall inside a shard's id range
+def ids_in_ranges(ranges: List[Tuple[int, int]], start: int, end: int) -> np.ndarray:
+    parts = [np.arange(max(a, start), min(b, end), dtype="int64") - start for a, b in ranges if a < end and b > start]
+    return np.concatenate(parts) if parts else np.zeros(0, dtype="int64")
+
+# searches several shards concurrently and merges their hits into one top-k
+# each shard is a dict with "index" and optional "exclude" (local ids to skip)
+# and "allow" (boolean mask of local ids that may be returned)
+# returns [(score, shard position, local id)] best first
+def search_shards(shards: List[Dict[str, Any]], query_vector: np.ndarray, k: int = 5,
+                  nprobe: int = None, ef_search: int = None, workers: int = 8):
+    return search_shards_batch(shards, np.reshape(query_vector, (1, -1)), k, nprobe, ef_search, workers)[0]
+
+# search_shards for a matrix of queries, one batched search per shard
+# returns one hit list per query row
+def search_shards_batch(shards: List[Dict[str, Any]], query_vectors: np.ndarray, k: int = 5,
+                        nprobe: int = None, ef_search: int = None, workers: int = 8):
+    query_vectors = np.asarray(query_vectors, dtype="float32")
+
+    def _one(shard):
+        if not shard["index"].ntotal:
+            return np.zeros((len(query_vectors), 0), dtype="float32"), np.zeros((len(query_vectors), 0), dtype="int64")
+        return search_index_batch(
+            shard["index"], query_vectors, k, nprobe, ef_search, shard.get("exclude"), shard.get("allow")
+        )
+
+    if len(shards) > 1 and workers > 1:
+        # faiss releases the gil while searching
+        with ThreadPoolExecutor(max_workers=min(workers, len(shards))) as pool:
+            results = list(pool.map(_one, shards))
+    else:
+        results = [_one(shard) for shard in shards]
+
+    merged = []
+    for row in range(len(query_vectors)):
+        hits = [
+            (float(score), pos, int(i))
+            for pos, (scores, ids) in enumerate(results)
+            for score, i in zip(scores[row], ids[row])
+            if i >= 0
+        ]
+        merged.append(heapq.nlargest(k, hits, key=lambda hit: hit[0]))
+    return merged
+
 # save faiss index to the disk
 def save_index(index: faiss.Index, path: str):
     faiss.write_index(index, path)
 
 # loads faiss index from disk
-def load_index(path: str) -> faiss.Index:
+# mmap maps flat codes (flat, sq, pq and hnsw storage) with IO_FLAG_MMAP_IFC and ivf
+# inverted lists with plain IO_FLAG_MMAP, ivf can't be read with the IFC flag set;
+# kind skips the IFC attempt for ivf, without it each mapping is tried in turn before
+# a full read. stats gets the mapping used ("codes", "lists" or "none"), the mapped
+# bytes and the error of the last failed attempt under "fallback"
+def load_index(path: str, mmap: bool = False, kind: str = None, stats: Dict[str, Any] = None) -> faiss.Index:
+    stats = {} if stats is None else stats
+    stats.update(mmap="none", mappedBytes=0)
+    if mmap:
+        base = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+        ifc = getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+        attempts = [base] if kind == "ivf" or not ifc else [base | ifc, base]
+        for flags in attempts:
+            try:
+                index = faiss.read_index(path, flags)
+            except RuntimeError as e:
+                stats["fallback"] = str(e).strip().splitlines()[-1]
+                continue
+            if index_kind(index) == "ivf":
+                ivf = faiss.extract_index_ivf(index)
+                stats.update(mmap="lists", mappedBytes=ivf.ntotal * (ivf.code_size + 8))
+            elif flags & ifc:
+                storage = faiss.downcast_index(index.storage) if index_kind(index) == "hnsw" else index
+                stats.update(mmap="codes", mappedBytes=index.ntotal * storage.code_size)
+            return index
     return faiss.read_index(path)
 
+# serializes a faiss index to bytes for direct upload
+def serialize_index(index: faiss.Index) -> bytes:
+    return faiss.serialize_index(index).tobytes()
+
+# loads a faiss index from in-memory bytes
+def deserialize_index(data: bytes) -> faiss.Index:
+    return faiss.deserialize_index(np.frombuffer(data, dtype=np.uint8))
+
 # maps vector indices to chunk metadata 
 # to source for retrieval and citations
 def create_metadata(chunks: List[Dict[str, Any]]) -> Dict[int, Dict[str, Any]]:
@@ -51,7 +399,8 @@ def create_metadata(chunks: List[Dict[str, Any]]) -> Dict[int, Dict[str, Any]]:
             'text': chunk.get('text', ''),
             'source': chunk.get('source', ''),
             'page': chunk.get('page', None),
-            'start_index': chunk.get('start_index', 0)
+            'start_index': chunk.get('start_index', 0),
+            'end_index': chunk.get('end_index'),
         }
     return metadata
 
@@ -65,28 +414,15 @@ def load_metadata(path: str):
     with open(path, 'r') as f:
         return json.load(f)
 
-# loads an existing index and adds new vectors in place
-# in case of new uploads, ingest adds new chunks without any rebuild
-def merge_indexes(existing_index_path: str, new_vectors: np.ndarray, 
-                  new_metadata: Dict[int, Dict[str, Any]],
-                  dimension: int):
-
-    # load existing
-    if os.path.exists(existing_index_path):
-        index = load_index(existing_index_path)
-        metadata = load_metadata(existing_index_path.replace('faiss.index', 'meta.json'))
-        next_id = max(metadata.keys()) + 1 if metadata else 0
-    else:
-        index = create_index(dimension)
-        metadata = {}
-        next_id = 0
-    
-    # add new vectors
-    add_vectors(index, new_vectors)
-    
-    # update metadata
-    for i, item in new_metadata.items():
-        metadata[next_id] = item
-        next_id += 1
-    
-    return index, metadata
+# serializes metadata to json bytes for direct upload
+def dumps_metadata(metadata: Dict[int, Dict[str, Any]]) -> bytes:
+    return json.dumps(metadata).encode('utf-8')
+
+# loads metadata from bytes or a readable stream (e.g. an s3 body)
+# packed binary metadata (meta.bin) opens as a ChunkMetadata view, json as a dict
+def loads_metadata(data):
+    if hasattr(data, 'read'):
+        data = data.read()
+    if is_packed_metadata(data):
+        return ChunkMetadata.from_bytes(data)
+    return json.loads(data)
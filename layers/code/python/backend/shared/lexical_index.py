@@ -0,0 +1,174 @@
+# bm25 inverted index over chunk text, one per index segment (segments/{id}.bm25)
+# catches exact matches on course codes, formula names and rare terms that dense
+# search misses, and can answer without an embedding call when the match is confident
+#
+# layout: MAGIC | uint32 header length | json header | padding to 8 bytes | body
+# body:   doc lengths uint32[n] | postings offsets uint64[terms + 1] | doc ids uint32[p] | term freqs uint16[p]
+# the header holds the sorted vocabulary, postings of term i are [offsets[i], offsets[i + 1])
+import json
+import math
+import mmap
+import re
+import struct
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+MAGIC = b"SAILBM25"
+VERSION = 1
+# bm25 term frequency saturation and length normalization
+K1 = 1.2
+B = 0.75
+# reciprocal rank fusion constant, dampens the weight of top ranks
+RRF_K = 60
+
+_TOKEN = re.compile(r"\w+")
+
+
+# lowercased word tokens, digits kept so course codes and numbers match exactly
+def tokenize(text: str) -> List[str]:
+    return _TOKEN.findall(text.lower())
+
+
+# builds the packed index over texts, doc ids are positions in texts
+def pack_lexical(texts: Sequence[str]) -> bytes:
+    vocab: Dict[str, int] = {}
+    lengths = np.zeros(len(texts), dtype="<u4")
+    term_ids, doc_ids, freqs = [], [], []
+    for doc, text in enumerate(texts):
+        counts = Counter(tokenize(text or ""))
+        lengths[doc] = sum(counts.values())
+        for term, tf in counts.items():
+            term_ids.append(vocab.setdefault(term, len(vocab)))
+            doc_ids.append(doc)
+            freqs.append(min(tf, 0xFFFF))
+
+    # postings grouped by term in vocabulary order, doc ids ascending within a term
+    terms = sorted(vocab)
+    rank = np.empty(len(vocab), dtype="int64")
+    rank[[vocab[t] for t in terms]] = np.arange(len(terms))
+    term_ids = rank[np.array(term_ids, dtype="int64")]
+    doc_ids = np.array(doc_ids, dtype="<u4")
+    order = np.lexsort((doc_ids, term_ids))
+    offsets = np.zeros(len(terms) + 1, dtype="<u8")
+    np.cumsum(np.bincount(term_ids, minlength=len(terms)), out=offsets[1:])
+
+    header = json.dumps({"version": VERSION, "docs": len(texts), "terms": terms}).encode("utf-8")
+    head = MAGIC + struct.pack("<I", len(header)) + header
+    head += b"\0" * (-len(head) % 8)
+    return b"".join([
+        head,
+        lengths.tobytes(),
+        offsets.tobytes(),
+        doc_ids[order].tobytes(),
+        np.array(freqs, dtype="<u2")[order].tobytes(),
+    ])
+
+
+# read-only view over a packed index, postings are decoded only for query terms
+class LexicalIndex:
+    # data is the whole packed file (bytes or mmap)
+    def __init__(self, data):
+        if bytes(data[:len(MAGIC)]) != MAGIC:
+            raise ValueError("not a packed lexical index")
+        (header_len,) = struct.unpack("<I", bytes(data[len(MAGIC):len(MAGIC) + 4]))
+        header = json.loads(bytes(data[len(MAGIC) + 4:len(MAGIC) + 4 + header_len]))
+        base = len(MAGIC) + 4 + header_len
+        base += -base % 8
+
+        n, terms = header["docs"], header["terms"]
+        self._terms = {term: i for i, term in enumerate(terms)}
+        self.lengths = np.frombuffer(data, dtype="<u4", count=n, offset=base)
+        base += self.lengths.nbytes
+        self._offsets = np.frombuffer(data, dtype="<u8", count=len(terms) + 1, offset=base)
+        base += self._offsets.nbytes
+        postings = int(self._offsets[-1])
+        self._docs = np.frombuffer(data, dtype="<u4", count=postings, offset=base)
+        self._freqs = np.frombuffer(data, dtype="<u2", count=postings, offset=base + self._docs.nbytes)
+        self.total_length = int(self.lengths.sum())
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "LexicalIndex":
+        return cls(data)
+
+    # memory-maps a packed file, postings pages are read only for query terms
+    @classmethod
+    def from_file(cls, path: str) -> "LexicalIndex":
+        with open(path, "rb") as f:
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def __len__(self):
+        return len(self.lengths)
+
+    # (doc ids, term freqs) of a term, none when the term never occurs
+    def postings(self, term: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        i = self._terms.get(term)
+        if i is None:
+            return None
+        start, end = int(self._offsets[i]), int(self._offsets[i + 1])
+        return self._docs[start:end], self._freqs[start:end]
+
+    # number of docs containing a term
+    def df(self, term: str) -> int:
+        i = self._terms.get(term)
+        return 0 if i is None else int(self._offsets[i + 1] - self._offsets[i])
+
+
+# bm25 search over several indexes (shards of one corpus) with corpus-wide idf
+# indexes may hold none for shards without a lexical index, excludes are local ids to skip
+# and allows boolean masks of the local ids that may match (metadata filters)
+# returns ([(score, shard position, local id)] best first, confidence)
+# confidence is the share of the query's idf weight matched by the best hit (0 to 1)
+def search_lexical(indexes: Sequence[Optional[LexicalIndex]], query: str, k: int = 5,
+                   excludes: Sequence[Optional[np.ndarray]] = None,
+                   allows: Sequence[Optional[np.ndarray]] = None):
+    terms = list(dict.fromkeys(tokenize(query)))
+    present = [(pos, index) for pos, index in enumerate(indexes) if index is not None and len(index)]
+    if not terms or not present:
+        return [], 0.0
+
+    n = sum(len(index) for _, index in present)
+    avgdl = max(1.0, sum(index.total_length for _, index in present) / n)
+    idf = {}
+    for term in terms:
+        df = sum(index.df(term) for _, index in present)
+        idf[term] = math.log(1 + (n - df + 0.5) / (df + 0.5))
+
+    hits = []
+    for pos, index in present:
+        scores = np.zeros(len(index), dtype="float32")
+        norm = K1 * (1 - B + B * index.lengths.astype("float32") / avgdl)
+        for term in terms:
+            found = index.postings(term)
+            if found is None:
+                continue
+            ids, tfs = found
+            tfs = tfs.astype("float32")
+            scores[ids] += idf[term] * tfs * (K1 + 1) / (tfs + norm[ids])
+        if excludes is not None and excludes[pos] is not None and len(excludes[pos]):
+            scores[excludes[pos]] = 0
+        if allows is not None and allows[pos] is not None:
+            scores[~allows[pos]] = 0
+        top = np.flatnonzero(scores)
+        if len(top) > k:
+            top = top[np.argpartition(-scores[top], k - 1)[:k]]
+        hits.extend((float(scores[i]), pos, int(i)) for i in top)
+
+    hits.sort(key=lambda hit: -hit[0])
+    hits = hits[:k]
+    # a hit holding every query term once at average length scores about the idf sum
+    confidence = min(1.0, hits[0][0] / sum(idf.values())) if hits else 0.0
+    return hits, confidence
+
+
+# reciprocal rank fusion of ranked hit lists [(score, shard position, local id)]
+# returns [(fused score, shard position, local id)] best first
+def rrf_fuse(rankings: Sequence[Sequence[Tuple[float, int, int]]], k: int = 5, c: int = RRF_K):
+    fused: Dict[Tuple[int, int], float] = {}
+    for ranking in rankings:
+        for rank, (_, pos, i) in enumerate(ranking):
+            fused[(pos, i)] = fused.get((pos, i), 0.0) + 1.0 / (c + rank + 1)
+    best = sorted(fused.items(), key=lambda item: -item[1])[:k]
+    return [(score, pos, i) for (pos, i), score in best]
+
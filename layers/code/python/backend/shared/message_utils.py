@@ -25,18 +25,33 @@ def _serialize_chunks_for_dynamo(chunks: List[Dict[str, Any]]) -> List[Dict[str,
     serialized = []
     # loop through each chunk
     for chunk in chunks:
-        # copy chunk dictionary
-        entry = dict(chunk)
-        # get score value
-        score = entry.get("score")
-        # convert float score to decimal if present
-        if isinstance(score, float):
-            entry["score"] = Decimal(str(score))
+        # convert float scores (score, denseScore, lexicalScore, ...) to decimal
+        entry = _to_decimal(chunk)
         # add to list
         serialized.append(entry)
     # return processed chunks
     return serialized
 
+# recursively converts floats to decimals, dynamodb rejects float numbers
+def _to_decimal(value: Any) -> Any:
+    if isinstance(value, float):
+        return Decimal(str(value))
+    if isinstance(value, dict):
+        return {k: _to_decimal(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_to_decimal(v) for v in value]
+    return value
+
+# recursively converts dynamodb decimals to int or float
+def _from_decimal(value: Any) -> Any:
+    if isinstance(value, Decimal):
+        return int(value) if value.as_tuple().exponent >= 0 else float(value)
+    if isinstance(value, dict):
+        return {k: _from_decimal(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_from_decimal(v) for v in value]
+    return value
+
 # deserialize scores from decimal for python use
 # convert decimal back to float for normal use
 def _deserialize_chunks_from_dynamo(chunks: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
@@ -46,13 +61,8 @@ def _deserialize_chunks_from_dynamo(chunks: List[Dict[str, Any]]) -> List[Dict[s
     for chunk in chunks:
         # copy chunk dictionary
         entry = dict(chunk)
-        # get score value
-        score = entry.get("score")
-        # convert decimal score to float if present
-        if isinstance(score, Decimal):
-            entry["score"] = float(score)
-        # add to list
-        deserialized.append(entry)
+        # convert decimal numbers (score, page, nested sources) back to float/int
+        deserialized.append(_from_decimal(entry))
     # return processed chunks
     return deserialized
 
@@ -0,0 +1,202 @@
+# columnar binary store for chunk metadata (index/meta.bin)
+# fixed-width columns (source id, page, offsets) plus one utf-8 text blob,
+# so readers map the file or fetch only the rows they need instead of parsing json
+#
+# layout: MAGIC | uint32 header length | json header | padding to 8 bytes | body
+# body:   source int32[n] | page int32[n] | start_index int64[n] | end_index int64[n]
+#         | text offsets uint64[n + 1] | text blob | extras json
+# page / end_index of -1 mean none, extras holds per-row fields outside the
+# fixed columns (e.g. the sources list of a deduplicated chunk)
+import json
+import mmap
+import struct
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+MAGIC = b"SAILMETA"
+VERSION = 1
+# fixed columns, in body order
+_COLUMNS = [("source", "<i4"), ("page", "<i4"), ("start_index", "<i8"), ("end_index", "<i8")]
+_FIELDS = {"text", "source", "page", "start_index", "end_index"}
+
+
+# row value or -1 for missing numbers
+def _num(value) -> int:
+    return -1 if value is None else int(value)
+
+
+# serializes {id: row} metadata (as built by create_metadata) to the binary format
+def pack_metadata(metadata: Dict[int, Dict[str, Any]]) -> bytes:
+    rows = [metadata[k] for k in sorted(metadata, key=int)]
+    n = len(rows)
+    names = sorted({row.get("source") or "" for row in rows})
+    source_ids = {name: i for i, name in enumerate(names)}
+
+    columns = {
+        "source": np.array([source_ids[row.get("source") or ""] for row in rows], dtype="<i4"),
+        "page": np.array([_num(row.get("page")) for row in rows], dtype="<i4"),
+        "start_index": np.array([_num(row.get("start_index", 0)) for row in rows], dtype="<i8"),
+        "end_index": np.array([_num(row.get("end_index")) for row in rows], dtype="<i8"),
+    }
+    texts = [(row.get("text") or "").encode("utf-8") for row in rows]
+    offsets = np.zeros(n + 1, dtype="<u8")
+    np.cumsum([len(t) for t in texts], out=offsets[1:])
+    extras = {
+        str(i): {k: v for k, v in row.items() if k not in _FIELDS}
+        for i, row in enumerate(rows)
+        if any(k not in _FIELDS for k in row)
+    }
+    extras_blob = json.dumps(extras).encode("utf-8")
+
+    # body offsets, relative to the start of the body
+    layout, pos = {}, 0
+    for name, _ in _COLUMNS:
+        layout[name] = pos
+        pos += columns[name].nbytes
+    layout["offsets"] = pos
+    pos += offsets.nbytes
+    layout["text"] = pos
+    pos += int(offsets[-1])
+    layout["extras"] = [pos, len(extras_blob)]
+
+    header = json.dumps({"version": VERSION, "rows": n, "sources": names, "layout": layout}).encode("utf-8")
+    head = MAGIC + struct.pack("<I", len(header)) + header
+    head += b"\0" * (-len(head) % 8)
+    return b"".join([head, *(columns[name].tobytes() for name, _ in _COLUMNS), offsets.tobytes(), *texts, extras_blob])
+
+
+# read-only {id: row} view over a packed metadata file
+# rows are decoded on access; accepts int or str ids like the json dict did
+class ChunkMetadata(Mapping):
+    # read(start, end) returns bytes [start, end) of the packed file
+    # buffer, when given, is the whole file (bytes or mmap) for zero-copy columns
+    def __init__(self, read: Callable[[int, int], bytes], buffer=None, concurrency: int = 8):
+        self._read = read
+        self._concurrency = concurrency
+        prefix = bytes(read(0, len(MAGIC) + 4))
+        if prefix[:len(MAGIC)] != MAGIC:
+            raise ValueError("not a packed metadata file")
+        (header_len,) = struct.unpack("<I", prefix[len(MAGIC):])
+        header = json.loads(bytes(read(len(MAGIC) + 4, len(MAGIC) + 4 + header_len)))
+        self._n = header["rows"]
+        self._sources = header["sources"]
+        layout = header["layout"]
+        base = len(MAGIC) + 4 + header_len
+        base += -base % 8
+
+        # fixed columns and text offsets are contiguous, one read (or view) covers them
+        n = self._n
+        end = base + layout["text"]
+        data = buffer if buffer is not None else read(base, end)
+        start = base if buffer is not None else 0
+        self._columns = {}
+        for name, dtype in _COLUMNS:
+            self._columns[name] = np.frombuffer(data, dtype=dtype, count=n, offset=start + layout[name])
+        self._offsets = np.frombuffer(data, dtype="<u8", count=n + 1, offset=start + layout["offsets"])
+        self._text = base + layout["text"]
+
+        extras_at, extras_len = layout["extras"]
+        self._extras = json.loads(bytes(read(base + extras_at, base + extras_at + extras_len))) if extras_len else {}
+
+    # opens packed bytes held in memory
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "ChunkMetadata":
+        view = memoryview(data)
+        return cls(lambda start, end: view[start:end], buffer=data)
+
+    # memory-maps a packed file, pages are read only when rows are touched
+    @classmethod
+    def from_file(cls, path: str) -> "ChunkMetadata":
+        with open(path, "rb") as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(lambda start, end: mapped[start:end], buffer=mapped)
+
+    def __len__(self):
+        return self._n
+
+    def __iter__(self):
+        return iter(range(self._n))
+
+    def __getitem__(self, key):
+        i = int(key)
+        if not 0 <= i < self._n:
+            raise KeyError(key)
+        start, end = int(self._offsets[i]), int(self._offsets[i + 1])
+        return self._row(i, self._read(self._text + start, self._text + end))
+
+    # builds the row dict from the columns and its text bytes
+    def _row(self, i: int, text) -> Dict[str, Any]:
+        page = int(self._columns["page"][i])
+        end_index = int(self._columns["end_index"][i])
+        row = {
+            "text": bytes(text).decode("utf-8"),
+            "source": self._sources[int(self._columns["source"][i])],
+            "page": None if page < 0 else page,
+            "start_index": int(self._columns["start_index"][i]),
+            "end_index": None if end_index < 0 else end_index,
+        }
+        row.update(self._extras.get(str(i), {}))
+        return row
+
+    # rows for several ids at once, text reads run concurrently (ranged gets)
+    # missing ids map to none
+    def get_many(self, ids: Iterable) -> List[Optional[Dict[str, Any]]]:
+        ids = [int(i) for i in ids]
+        valid = [i for i in ids if 0 <= i < self._n]
+        if len(valid) > 1 and self._concurrency > 1:
+            with ThreadPoolExecutor(max_workers=min(self._concurrency, len(valid))) as pool:
+                rows = dict(zip(valid, pool.map(self.__getitem__, valid)))
+        else:
+            rows = {i: self[i] for i in valid}
+        return [rows.get(i) for i in ids]
+
+    # boolean mask of rows from the given source names and within [first, last] pages
+    # reads only the fixed columns; deduplicated rows also match through the
+    # other documents they appear in
+    def select(self, sources: Iterable[str] = None, pages: Tuple[int, int] = None) -> np.ndarray:
+        mask = np.ones(self._n, dtype=bool)
+        if sources is not None:
+            sources = set(sources)
+            wanted = [i for i, name in enumerate(self._sources) if name in sources]
+            mask &= np.isin(self._columns["source"], wanted)
+        if pages is not None:
+            page = self._columns["page"]
+            mask &= (page >= pages[0]) & (page <= pages[1])
+        for key, extra in self._extras.items():
+            if any(_mentions(s, sources, pages) for s in extra.get("sources", [])):
+                mask[int(key)] = True
+        return mask
+
+    # plain {id: row} dict, for callers that modify metadata (ingest)
+    def to_dict(self) -> Dict[int, Dict[str, Any]]:
+        return {i: self[i] for i in range(self._n)}
+
+
+# true when one (source, page) mention of a row passes the filters of select
+def _mentions(mention: Dict[str, Any], sources, pages) -> bool:
+    if sources is not None and mention.get("source") not in sources:
+        return False
+    if pages is not None:
+        page = mention.get("page")
+        return page is not None and pages[0] <= page <= pages[1]
+    return True
+
+
+# boolean mask of the rows of a {id: row} dict (json metadata of older sessions)
+# that pass the same filters as ChunkMetadata.select
+def select_metadata(metadata: Dict[Any, Dict[str, Any]], size: int,
+                    sources: Iterable[str] = None, pages: Tuple[int, int] = None) -> np.ndarray:
+    sources = None if sources is None else set(sources)
+    mask = np.zeros(size, dtype=bool)
+    for key, row in metadata.items():
+        mentions = row.get("sources") or [row]
+        mask[int(key)] = any(_mentions(m, sources, pages) for m in mentions)
+    return mask
+
+
+# true when data starts like a packed metadata file
+def is_packed_metadata(data: bytes) -> bool:
+    return bytes(data[:len(MAGIC)]) == MAGIC
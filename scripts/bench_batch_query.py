@@ -0,0 +1,77 @@
+# throughput of batched questions ("questions" in a query request) vs one request per question
+# index search is real (search_shards vs search_shards_batch over a synthetic session);
+# embedding, s3 and chat round trips are simulated with fixed latencies, since their
+# cost is per call: a batch makes one embed call, one index load and history read,
+# and runs its chats concurrently
+# usage: python scripts/bench_batch_query.py [questions] [vectors] [embed_ms] [chat_ms] [s3_ms]
+#   e.g. python scripts/bench_batch_query.py 20 50000 150 1500 30
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from backend.shared import (  # noqa: E402
+    add_vectors,
+    create_index,
+    search_shards,
+    search_shards_batch,
+    thread_pool,
+)
+
+DIMENSION = 1536
+K = 20
+CHAT_WORKERS = 8
+# s3 round trips per single query: version pointer, history read, two message writes
+S3_CALLS_SINGLE = 4
+
+
+def main():
+    args = sys.argv[1:] + [None] * 5
+    n = int(args[0] or 20)
+    size = int(args[1] or 50000)
+    embed_s = float(args[2] or 150) / 1000
+    chat_s = float(args[3] or 1500) / 1000
+    s3_s = float(args[4] or 30) / 1000
+
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((size, DIMENSION)).astype("float32")
+    index = create_index(DIMENSION, size)
+    add_vectors(index, vectors)
+    shards = [{"index": index}]
+    queries = rng.standard_normal((n, DIMENSION)).astype("float32")
+    print(f"{n} questions, {size} vectors x {DIMENSION} dims, embed {embed_s * 1000:.0f}ms, "
+          f"chat {chat_s * 1000:.0f}ms, s3 {s3_s * 1000:.0f}ms per call")
+
+    # n separate requests, one after another
+    search = 0.0
+    start = time.perf_counter()
+    for q in queries:
+        time.sleep(embed_s + S3_CALLS_SINGLE * s3_s)
+        t = time.perf_counter()
+        search_shards(shards, q, K)
+        search += time.perf_counter() - t
+        time.sleep(chat_s)
+    single = time.perf_counter() - start
+    print(f"  single x{n:<4d} total {single:8.2f}s  search {search * 1000:8.1f}ms  {n / single:6.2f} questions/s")
+
+    # one batch request
+    start = time.perf_counter()
+    # one embed call, version pointer and history read
+    time.sleep(embed_s + 2 * s3_s)
+    t = time.perf_counter()
+    search_shards_batch(shards, queries, K)
+    search = time.perf_counter() - t
+    with thread_pool(min(CHAT_WORKERS, n)) as pool:
+        list(pool.map(lambda _: time.sleep(chat_s), range(n)))
+    # message writes stay sequential to keep their order
+    time.sleep(2 * n * s3_s)
+    batch = time.perf_counter() - start
+    print(f"  batch  x{n:<4d} total {batch:8.2f}s  search {search * 1000:8.1f}ms  {n / batch:6.2f} questions/s"
+          f"  ({single / batch:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
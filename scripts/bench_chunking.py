@@ -0,0 +1,91 @@
+# benchmarks chunking.chunk_text against the previous sentence-by-sentence chunker
+# usage: python scripts/bench_chunking.py [megabytes ...]
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import tiktoken
+
+from backend.shared.chunking import chunk_text
+
+WORDS = (
+    "the lecture covers gradient descent convergence proofs for convex functions "
+    "with lipschitz continuous gradients and step sizes chosen by backtracking line search"
+).split()
+
+
+# previous implementation, kept here only as the baseline
+def legacy_chunk_text(text: str, chunk_size: int = 1000, overlap: int = 150):
+    enc = tiktoken.encoding_for_model("gpt-4")
+    sentences = text.split('. ')
+    chunks = []
+    current_chunk = []
+    current_tokens = 0
+    start_idx = 0
+    for sentence in sentences:
+        sentence_tokens = len(enc.encode(sentence))
+        if current_tokens + sentence_tokens > chunk_size and current_chunk:
+            chunk = '. '.join(current_chunk)
+            chunks.append({'text': chunk, 'start_index': start_idx, 'tokens': current_tokens})
+            overlap_sentences = []
+            overlap_tokens = 0
+            for s in reversed(current_chunk):
+                t = len(enc.encode(s))
+                if overlap_tokens + t <= overlap:
+                    overlap_sentences.insert(0, s)
+                    overlap_tokens += t
+                else:
+                    break
+            current_chunk = overlap_sentences
+            current_tokens = overlap_tokens
+            start_idx += len(chunk) - sum(len(s) for s in overlap_sentences)
+        current_chunk.append(sentence)
+        current_tokens += sentence_tokens
+    if current_chunk:
+        chunks.append({'text': '. '.join(current_chunk), 'start_index': start_idx, 'tokens': current_tokens})
+    return chunks
+
+
+# builds roughly `megabytes` of sentence-like text
+# short sentences stress the overlap handling (slides, bullet lists)
+def make_text(megabytes: float, seed: int = 0, words: tuple = (4, 40)) -> str:
+    rng = random.Random(seed)
+    parts = []
+    size = 0
+    while size < megabytes * 1024 * 1024:
+        sentence = " ".join(rng.choice(WORDS) for _ in range(rng.randint(*words))) + "."
+        parts.append(sentence)
+        size += len(sentence) + 1
+    return " ".join(parts)
+
+
+# wall time of one call
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    sizes = [float(a) for a in sys.argv[1:]] or [1, 4]
+    corpora = (("prose", (4, 40)), ("short", (1, 4)))
+    for mb in sizes:
+        for label, words in corpora:
+            text = make_text(mb, words=words)
+            old_s, old = timed(legacy_chunk_text, text)
+            new_s, new = timed(chunk_text, text)
+            # check that reported spans point at the chunk text
+            exact = sum(text[c['start_index']:c['end_index']] == c['text'] for c in new)
+            legacy_exact = sum(text[c['start_index']:c['start_index'] + len(c['text'])] == c['text'] for c in old)
+            print(
+                f"{mb:>5.1f} MB {label:5s}  legacy {old_s:6.2f}s {len(old):6d} chunks ({legacy_exact} exact spans)  "
+                f"new {new_s:6.2f}s {len(new):6d} chunks ({exact} exact spans, max {max(c['tokens'] for c in new)} tokens)  "
+                f"speedup {old_s / new_s:4.1f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+# measures cold start time of the ingest and query handlers
+# each run imports a handler in a fresh interpreter with an empty tiktoken cache,
+# like a new lambda container, and times module init plus a first count_tokens
+# usage: python scripts/bench_cold_start.py [runs]
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+CHILD = """
+import runpy, sys, time
+start = time.perf_counter()
+runpy.run_path(sys.argv[1])
+init = time.perf_counter() - start
+from backend.shared import count_tokens
+count_tokens("warm question about the uploaded lecture notes")
+print(init, time.perf_counter() - start)
+"""
+
+
+# one cold start, returns (init seconds, init + first tokenization seconds)
+def cold_start(handler: str, packaged: bool):
+    env = dict(os.environ, BUCKET="bench", MESSAGES_TABLE="bench", PYTHONPATH=ROOT)
+    # empty cache dir so tiktoken can't reuse an earlier download
+    env["TIKTOKEN_CACHE_DIR"] = tempfile.mkdtemp()
+    if not packaged:
+        env["TIKTOKEN_BPE_PATH"] = ""
+    path = os.path.join(ROOT, "backend", "lambdas", handler, "main.py")
+    result = subprocess.run([sys.executable, "-c", CHILD, path], env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        return None
+    init, total = map(float, result.stdout.split()[-2:])
+    return init, total
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    for handler in ("ingest", "query"):
+        for packaged in (False, True):
+            label = "packaged bpe" if packaged else "tiktoken download"
+            samples = [cold_start(handler, packaged) for _ in range(runs)]
+            ok = [s for s in samples if s]
+            if not ok:
+                print(f"{handler:7s} {label:18s} failed (no network egress?)")
+                continue
+            print(
+                f"{handler:7s} {label:18s} init p50 {statistics.median(s[0] for s in ok):.3f}s  "
+                f"init+first tokenize p50 {statistics.median(s[1] for s in ok):.3f}s  "
+                f"({len(ok)}/{runs} ok)"
+            )
+
+
+if __name__ == "__main__":
+    main()
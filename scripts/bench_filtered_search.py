@@ -0,0 +1,64 @@
+# latency and recall of metadata-filtered search as filters get more selective
+# a filter keeps a random share of a synthetic clustered corpus (like a source or page
+# range of a session) and is passed to search_index as an allow mask, so filtering
+# happens inside the search; recall@k is against exact search over the allowed ids,
+# which post-filtering the unfiltered top-k can't reach once the filter is selective
+# usage: python scripts/bench_filtered_search.py [size] [dimension] [k]
+#   e.g. python scripts/bench_filtered_search.py 50000 1536 5
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from backend.shared.faiss_utils import add_vectors, create_index, search_index  # noqa: E402
+
+QUERIES = 100
+SHARES = [1.0, 0.3, 0.1, 0.03, 0.01, 0.001]
+CONFIGS = [("flat", "none"), ("ivf", "none"), ("ivf", "sq8"), ("hnsw", "none")]
+
+
+def main():
+    args = sys.argv[1:] + [None] * 3
+    size = int(args[0] or 50000)
+    dimension = int(args[1] or 1536)
+    k = int(args[2] or 5)
+
+    rng = np.random.default_rng(0)
+    topics = rng.standard_normal((max(10, size // 200), dimension))
+    vectors = (topics[rng.integers(0, len(topics), size)] + 0.6 * rng.standard_normal((size, dimension))).astype("float32")
+    queries = (topics[rng.integers(0, len(topics), QUERIES)] + 0.6 * rng.standard_normal((QUERIES, dimension))).astype("float32")
+    masks = {}
+    for share in SHARES:
+        masks[share] = np.zeros(size, dtype=bool)
+        masks[share][rng.choice(size, max(1, int(size * share)), replace=False)] = True
+
+    exact = create_index(dimension, size, "flat")
+    add_vectors(exact, vectors.copy())
+    truth = {share: [set(search_index(exact, q, k, allow=mask)[1].tolist()) for q in queries]
+             for share, mask in masks.items()}
+
+    print(f"{size} vectors x {dimension} dims, k={k}, {QUERIES} queries")
+    for kind, quantization in CONFIGS:
+        index = create_index(dimension, size, kind, quantization)
+        add_vectors(index, vectors.copy())
+        for share, mask in masks.items():
+            times, recall = [], []
+            for q, expected in zip(queries, truth[share]):
+                start = time.perf_counter()
+                _, ids = search_index(index, q, k, allow=mask)
+                times.append((time.perf_counter() - start) * 1000)
+                recall.append(len(expected & set(ids.tolist())) / len(expected))
+            # post-filtering: the unfiltered top-k, minus what the filter rejects
+            post = [len(expected & {i for i in search_index(index, q, k)[1].tolist() if i >= 0 and mask[i]}) / len(expected)
+                    for q, expected in zip(queries[:20], truth[share][:20])]
+            print(f"  {kind:4s}/{quantization:4s} keep {share:6.1%}  p50 {statistics.median(times):7.3f}ms  "
+                  f"p99 {np.percentile(times, 99):7.3f}ms  recall@{k} {np.mean(recall):.3f}  "
+                  f"(post-filter {np.mean(post):.3f})")
+
+
+if __name__ == "__main__":
+    main()
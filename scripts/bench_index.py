@@ -0,0 +1,141 @@
+# recall vs latency harness for the index families in faiss_utils
+# builds flat / ivf / hnsw indexes, plain and quantized (sq8 / fp16 / pq), over
+# synthetic clustered corpora (embeddings of course material cluster by topic)
+# and reports, per search setting, recall@k against exact flat search,
+# p50/p99 single-query latency, serialized index size and resident memory; quantized
+# indexes are also measured with full precision rescoring of RESCORE_FACTOR * k candidates
+# resident memory is the rss growth of a fresh process that loads the index file, read
+# in full ("rss") and memory-mapped as query loads it ("mmap"), and after that process
+# has answered the queries, which pages in the mapped codes/lists they touch
+# usage: python scripts/bench_index.py [sizes] [dimension] [k]
+#   e.g. python scripts/bench_index.py 10000,50000,200000 1536 5
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+from backend.shared.faiss_utils import (  # noqa: E402
+    add_vectors,
+    choose_index_kind,
+    create_index,
+    load_index,
+    rescore,
+    search_index,
+    serialize_index,
+)
+
+QUERIES = 200
+RESCORE_FACTOR = 4
+# (family, quantization, search parameter name, values)
+CONFIGS = [
+    ("flat", "none", None, [None]),
+    ("flat", "fp16", None, [None]),
+    ("flat", "sq8", None, [None]),
+    ("flat", "pq", None, [None]),
+    ("ivf", "none", "nprobe", [4, 16, 64]),
+    ("ivf", "sq8", "nprobe", [16]),
+    ("ivf", "pq", "nprobe", [16]),
+    ("hnsw", "none", "ef_search", [16, 64, 128]),
+    ("hnsw", "sq8", "ef_search", [64]),
+]
+
+
+# resident set size of this process in MB, page cache of mapped files included
+def rss_mb() -> float:
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1e6
+
+
+# runs in a fresh process: rss growth from loading the index file, and after searching it
+def _resident(path, kind, mmap, queries, k, kwargs, out):
+    before = rss_mb()
+    index = load_index(path, mmap=mmap, kind=kind)
+    loaded = rss_mb() - before
+    for q in queries:
+        search_index(index, q.copy(), k, **kwargs)
+    out.put((loaded, rss_mb() - before))
+
+
+# (loaded, after queries) rss growth in MB, with the index read in full or mapped
+def resident(path, kind, mmap, queries, k, kwargs):
+    ctx = multiprocessing.get_context("spawn")
+    out = ctx.Queue()
+    process = ctx.Process(target=_resident, args=(path, kind, mmap, queries, k, kwargs, out))
+    process.start()
+    result = out.get()
+    process.join()
+    return result
+
+
+# n unit vectors around topic centroids, plus queries drawn the same way
+def corpus(n: int, dimension: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    topics = rng.standard_normal((max(1, n // 200), dimension)).astype("float32")
+    vectors = topics[rng.integers(0, len(topics), n)] + 0.6 * rng.standard_normal((n, dimension)).astype("float32")
+    queries = topics[rng.integers(0, len(topics), QUERIES)] + 0.6 * rng.standard_normal((QUERIES, dimension)).astype("float32")
+    return vectors, queries
+
+
+def main():
+    sizes = [int(s) for s in (sys.argv[1] if len(sys.argv) > 1 else "10000,50000").split(",")]
+    dimension = int(sys.argv[2]) if len(sys.argv) > 2 else 1536
+    k = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+
+    workdir = tempfile.mkdtemp(prefix="bench-index-")
+    for n in sizes:
+        vectors, queries = corpus(n, dimension)
+        print(f"\n{n} vectors x {dimension} dims, k={k}, auto picks {choose_index_kind(n, dimension)}")
+        unit = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+        exact = None
+        for kind, quantization, param, values in CONFIGS:
+            start = time.perf_counter()
+            index = create_index(dimension, n, kind, quantization)
+            add_vectors(index, vectors.copy())
+            build = time.perf_counter() - start
+            data = serialize_index(index)
+            size_mb = len(data) / 1e6
+            path = os.path.join(workdir, f"{kind}-{quantization}.index")
+            with open(path, "wb") as f:
+                f.write(data)
+
+            for value in values:
+                kwargs = {param: value} if param else {}
+                full = resident(path, kind, False, queries, k, kwargs)
+                mapped = resident(path, kind, True, queries, k, kwargs)
+                runs = [False, True] if quantization != "none" else [False]
+                for rescoring in runs:
+                    latencies, results = [], []
+                    for q in queries:
+                        t = time.perf_counter()
+                        if rescoring:
+                            _, ids = search_index(index, q.copy(), k * RESCORE_FACTOR, **kwargs)
+                            _, ids = rescore(q, ids, unit[ids], k)
+                        else:
+                            _, ids = search_index(index, q.copy(), k, **kwargs)
+                        latencies.append((time.perf_counter() - t) * 1000)
+                        results.append(set(ids.tolist()))
+                    if exact is None:
+                        exact = results
+                    recall = statistics.mean(len(r & e) / k for r, e in zip(results, exact))
+                    latencies.sort()
+                    label = f"{kind}/{quantization}" + (f" {param}={value}" if param else "")
+                    label += f" +rescore x{RESCORE_FACTOR}" if rescoring else ""
+                    print(
+                        f"  {label:36s} recall@{k} {recall:.3f}  "
+                        f"p50 {latencies[len(latencies) // 2]:7.3f}ms  "
+                        f"p99 {latencies[int(len(latencies) * 0.99) - 1]:7.3f}ms  "
+                        f"size {size_mb:8.1f}MB  rss {full[0]:7.1f}MB  "
+                        f"mmap {mapped[0]:7.1f}MB ({mapped[1]:7.1f}MB after queries)  build {build:6.1f}s"
+                    )
+            os.remove(path)
+    os.rmdir(workdir)
+
+
+if __name__ == "__main__":
+    main()
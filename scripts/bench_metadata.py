@@ -0,0 +1,92 @@
+# load time and memory of chunk metadata: legacy meta.json vs packed meta.bin
+# each variant runs in a fresh interpreter (like a new query container) that
+# opens the metadata of a synthetic session and looks up k search hits
+# usage: python scripts/bench_metadata.py [chunks] [k]
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, ROOT)
+
+from backend.shared.faiss_utils import dumps_metadata  # noqa: E402
+from backend.shared.metadata_store import pack_metadata  # noqa: E402
+
+CHILD = """
+import json, random, sys, time
+sys.path.insert(0, sys.argv[4])
+from backend.shared.faiss_utils import loads_metadata
+from backend.shared.metadata_store import ChunkMetadata
+mode, path, k = sys.argv[1], sys.argv[2], int(sys.argv[3])
+def rss():
+    with open("/proc/self/status") as f:
+        return next(int(line.split()[1]) for line in f if line.startswith("VmRSS")) / 1024
+base = rss()
+start = time.perf_counter()
+if mode == "json":
+    with open(path, "rb") as f:
+        meta = loads_metadata(f)
+elif mode == "mmap":
+    meta = ChunkMetadata.from_file(path)
+else:
+    # ranged reads from a local file stand in for s3 ranged gets
+    reads = []
+    def read(a, b):
+        reads.append(b - a)
+        with open(path, "rb") as f:
+            f.seek(a)
+            return f.read(b - a)
+    meta = ChunkMetadata(read, concurrency=1)
+opened = time.perf_counter() - start
+ids = random.Random(1).sample(range(len(meta)), k)
+rows = [meta.get(str(i)) for i in ids]
+lookup = time.perf_counter() - start - opened
+rss = rss() - base
+extra = f"  read {sum(reads) / 1e6:.2f}MB in {len(reads)} requests" if mode == "ranged" else ""
+print(f"open {opened * 1000:8.1f}ms  lookup {k} rows {lookup * 1000:6.2f}ms  rss +{rss:7.1f}MB{extra}")
+"""
+
+
+# synthetic session: ~800 character chunks across 200 sources, some with pages
+def corpus(n: int):
+    rng = random.Random(0)
+    words = [f"word{i}" for i in range(5000)]
+    meta = {}
+    for i in range(n):
+        text = " ".join(rng.choice(words) for _ in range(110))
+        meta[i] = {
+            "text": text,
+            "source": f"lecture-{i % 200}.pdf",
+            "page": (i // 200) % 300 if i % 2 else None,
+            "start_index": (i // 200) * 700,
+            "end_index": (i // 200) * 700 + len(text),
+        }
+    return meta
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    k = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    meta = corpus(n)
+    directory = tempfile.mkdtemp()
+    files = {}
+    for name, data in (("meta.json", dumps_metadata(meta)), ("meta.bin", pack_metadata(meta))):
+        files[name] = os.path.join(directory, name)
+        with open(files[name], "wb") as f:
+            f.write(data)
+        print(f"{name}: {len(data) / 1e6:.1f}MB for {n} chunks")
+    # the old writer used indent=2
+    print(f"meta.json (indent=2): {len(json.dumps(meta, indent=2)) / 1e6:.1f}MB")
+
+    for mode, name in (("json", "meta.json"), ("mmap", "meta.bin"), ("ranged", "meta.bin")):
+        result = subprocess.run(
+            [sys.executable, "-c", CHILD, mode, files[name], str(k), ROOT], capture_output=True, text=True
+        )
+        print(f"{mode:7s} {result.stdout.strip() or result.stderr.strip()}")
+
+
+if __name__ == "__main__":
+    main()
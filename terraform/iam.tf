@@ -20,7 +20,7 @@ data "aws_iam_policy_document" "lambda_inline" {
   # rag needs to read/write/list files
   statement {
     effect  = "Allow"                                             # grants access
-    actions = ["s3:GetObject", "s3:PutObject", "s3:ListBucket"]   # access to download/read, upload/write, list files
+    actions = ["s3:GetObject", "s3:PutObject", "s3:DeleteObject", "s3:ListBucket"]   # access to download/read, upload/write, delete, list files
     resources = [
       aws_s3_bucket.docs.arn,       # the resource itself - the s3 bucket
       "${aws_s3_bucket.docs.arn}/*" # everything inside the bucket